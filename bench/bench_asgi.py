@@ -0,0 +1,240 @@
+'''
+The WSGI and ASGI entry points, side by side, under many concurrent clients
+
+(c) 2018 simzes
+
+Usage:
+    python3 bench/bench_asgi.py [--clients 1000] [--wsgi-threads 64] [options] [--output run.json]
+
+Runs the workload of bench_webcache.py (same options, and seeds) twice,
+from --clients concurrent clients: once through
+webcache.handle_application, on a pool of --wsgi-threads threads, as a
+mod_wsgi process would serve it (requests beyond the thread count wait
+for a thread), and once through asgi.application, with each request a
+task on the event loop. The origin (mock_origin.py) answers after
+--origin-latency, so that requests spend most of their time waiting on it,
+or on the requests that won the reservation for their url.
+
+Reports, for each entry point, requests per second, latency percentiles
+(including any wait for a thread), origin requests per client request,
+and the most requests in progress at once.
+
+--backend is memory (an InMemoryBackend per run), or memcached:host
+(each run's urls are prefixed with the entry point's name, so the runs
+don't share entries). Requires Python 3.5 or later, and aiohttp.
+'''
+
+import asyncio
+import concurrent.futures
+import json
+import optparse
+import os
+import platform
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webcache'))
+
+import aiobackends
+import asgi
+import backends
+import upstream
+import webcache
+
+import bench_webcache
+import mock_origin
+
+class InFlight(object):
+    '''Counts the requests in progress, and the most at once'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def __enter__(self):
+        with self._lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def __exit__(self, *exc_info):
+        with self._lock:
+            self.current -= 1
+
+def open_backends(spec):
+    '''The (sync, async) backends for a run'''
+    if spec == 'memory':
+        backend = backends.InMemoryBackend()
+        return backend, aiobackends.AsyncInMemoryBackend(backend)
+    if spec.startswith('memcached:'):
+        host, _, port = spec[len('memcached:'):].partition(':')
+        return (bench_webcache.open_backend(spec),
+            aiobackends.AsyncMemcachedBackend(host, int(port or 11211)))
+    raise ValueError("Unknown backend: %s" % (spec,))
+
+def to_scope(environ):
+    '''The ASGI scope of a wsgi environ made by the Workload'''
+    path, _, query = environ['REQUEST_URI'].partition('?')
+    headers = [(b'host', environ['HTTP_HOST'].encode('latin-1'))]
+    if 'HTTP_IF_MODIFIED_SINCE' in environ:
+        headers.append((b'if-modified-since', environ['HTTP_IF_MODIFIED_SINCE'].encode('latin-1')))
+    return {
+        'type': 'http',
+        'method': 'GET',
+        'path': path,
+        'raw_path': path.encode('latin-1'),
+        'query_string': query.encode('latin-1'),
+        'headers': headers,
+    }
+
+def serve_wsgi(environ, in_flight):
+    '''Runs a request through handle_application, on a pool thread'''
+    statuses = []
+    with in_flight:
+        for _ in webcache.handle_application(environ, lambda status, headers: statuses.append(status)):
+            pass
+    return int(statuses[0][:3])
+
+async def serve_asgi(environ, in_flight):
+    '''Runs a request through the ASGI application'''
+    statuses = []
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            statuses.append(message['status'])
+
+    with in_flight:
+        await asgi.application(to_scope(environ), None, send)
+    return statuses[0]
+
+async def drive(entry_point, workload, options):
+    '''Runs the workload from options.clients concurrent clients, returning
+    each request's latency, each response's status, the failed requests'
+    exceptions, and the InFlight counter'''
+    loop = asyncio.get_event_loop()
+    pool = concurrent.futures.ThreadPoolExecutor(options.wsgi_threads)
+    in_flight = InFlight()
+    latencies = []
+    statuses = {}
+    failures = []
+    per_client = options.requests // options.clients
+
+    async def client(index):
+        for environ in workload.requests(index, per_client):
+            environ['REQUEST_URI'] = '/' + entry_point + environ['REQUEST_URI']
+            started = time.time()
+            try:
+                if entry_point == 'wsgi':
+                    status = await loop.run_in_executor(pool, serve_wsgi, environ, in_flight)
+                else:
+                    status = await serve_asgi(environ, in_flight)
+                statuses[status] = statuses.get(status, 0) + 1
+            except Exception as e:
+                failures.append(repr(e))
+            latencies.append(time.time() - started)
+
+    await asyncio.gather(*[client(i) for i in range(options.clients)])
+    pool.shutdown()
+    return latencies, statuses, failures, in_flight
+
+def run(entry_point, workload, origin, options):
+    sync_backend, async_backend = open_backends(options.backend)
+    webcache.STORAGE_BACKEND = sync_backend
+    asgi.STORAGE_BACKEND = async_backend
+    webcache.CONTENT_REAPER = None
+    webcache.EXPIRE_SECS = options.expire_secs
+    webcache.UPSTREAM_POOL = upstream.UpstreamPool([origin.url])
+    asgi.ORIGIN_CONNECTIONS = options.origin_connections
+    origin.reset_counts()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        started = time.time()
+        latencies, statuses, failures, in_flight = loop.run_until_complete(drive(entry_point, workload, options))
+        elapsed = time.time() - started
+        loop.run_until_complete(asgi.close())
+    finally:
+        loop.close()
+
+    ordered = sorted(latencies)
+    return {
+        'requests': len(ordered),
+        'seconds': round(elapsed, 3),
+        'requests_per_sec': round(len(ordered) / elapsed, 1),
+        'latency_ms': dict((name, round(bench_webcache.percentile(ordered, fraction) * 1000, 3))
+            for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))),
+        'statuses': dict((str(status), count) for status, count in statuses.items()),
+        'failures': len(failures),
+        'origin_requests': origin.requests,
+        'origin_per_request': round(float(origin.requests) / len(ordered), 4),
+        'peak_in_flight': in_flight.peak,
+    }
+
+def report(results):
+    wsgi, asgi_results = results['wsgi'], results['asgi']
+    sys.stdout.write("%-16s %14s %14s\n" % ('', 'wsgi', 'asgi'))
+    rows = [
+        ('requests/s', lambda r: r['requests_per_sec']),
+        ('p50 ms', lambda r: r['latency_ms']['p50']),
+        ('p90 ms', lambda r: r['latency_ms']['p90']),
+        ('p99 ms', lambda r: r['latency_ms']['p99']),
+        ('max ms', lambda r: r['latency_ms']['max']),
+        ('origin/request', lambda r: r['origin_per_request']),
+        ('peak in flight', lambda r: r['peak_in_flight']),
+        ('failures', lambda r: r['failures']),
+    ]
+    for name, value in rows:
+        sys.stdout.write("%-16s %14s %14s\n" % (name, value(wsgi), value(asgi_results)))
+    for name, r in (('wsgi', wsgi), ('asgi', asgi_results)):
+        sys.stdout.write("%-16s %s\n" % (name + ' statuses', ' '.join('%s:%d' % item for item in sorted(r['statuses'].items()))))
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--backend', default='memory', help="memory, or memcached:host[:port] [%default]")
+    parser.add_option('--clients', type='int', default=1000, help="concurrent clients [%default]")
+    parser.add_option('--wsgi-threads', type='int', default=64, help="threads serving the wsgi entry point [%default]")
+    parser.add_option('--origin-connections', type='int', default=asgi.ORIGIN_CONNECTIONS,
+        help="ORIGIN_CONNECTIONS for the asgi entry point [%default]")
+    parser.add_option('--requests', type='int', default=20000, help="requests, over all clients [%default]")
+    parser.add_option('--urls', type='int', default=1000, help="distinct urls [%default]")
+    parser.add_option('--zipf', type='float', default=1.0, help="popularity skew [%default]")
+    parser.add_option('--body-sizes', default='1024:0.6,16384:0.3,262144:0.1',
+        help="body sizes, as size:weight pairs [%default]")
+    parser.add_option('--ims', type='float', default=0.2, help="fraction of requests with If-Modified-Since [%default]")
+    parser.add_option('--origin-latency', type='float', default=50, help="origin delay, in ms [%default]")
+    parser.add_option('--origin-jitter', type='float', default=0, help="extra origin delay, up to this many ms at random [%default]")
+    parser.add_option('--expire-secs', type='int', default=webcache.EXPIRE_SECS, help="EXPIRE_SECS for the runs [%default]")
+    parser.add_option('--seed', type='int', default=1, help="workload seed [%default]")
+    parser.add_option('--output', help="file to save the options and results to, as JSON")
+    options, _ = parser.parse_args(argv)
+
+    workload = bench_webcache.Workload(options.urls, options.zipf, bench_webcache.parse_weighted(options.body_sizes),
+        options.ims, options.seed)
+    # paths are /<entry point>/bench/<n>
+    origin = mock_origin.MockOrigin(lambda path: workload.size(path[path.index('/', 1):]),
+        options.origin_latency / 1000.0, options.origin_jitter / 1000.0, options.seed)
+    try:
+        results = dict((entry_point, run(entry_point, workload, origin, options)) for entry_point in ('wsgi', 'asgi'))
+    finally:
+        origin.stop()
+    report(results)
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump({
+                'options': vars(options),
+                'environment': {
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'time': time.time(),
+                },
+                'results': results,
+            }, output, indent=2, sort_keys=True)
+            output.write('\n')
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,76 @@
+'''
+Measures the throughput of each digest algorithm over a range of body sizes
+
+(c) 2018 simzes
+
+Usage:
+    python bench/bench_digest.py [--sizes 1024,65536,1048576,8388608] [--seconds 0.5]
+
+For each algorithm available here (see digests.py) and body size, hashes
+random bodies for about the given time, both in one call and fed in
+ORIGIN_READ_CHUNK blocks, as webcache._issue_server_request does, and
+reports MB/s. Use it to pick DIGEST_ALGORITHM for the bodies an origin
+serves.
+'''
+
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webcache'))
+
+import digests
+
+CHUNK_SIZE = 65536
+
+def measure(fn, seconds):
+    '''Calls fn repeatedly for about the given time; returns calls per second'''
+    calls = 0
+    start = time.time()
+    elapsed = 0
+    while elapsed < seconds:
+        fn()
+        calls += 1
+        elapsed = time.time() - start
+    return calls / elapsed
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--sizes', default='1024,65536,1048576,8388608',
+        help="comma-separated body sizes, in bytes [%default]")
+    parser.add_option('--seconds', type='float', default=0.5,
+        help="time to spend on each measurement [%default]")
+    parser.add_option('--algorithms', default=None,
+        help="comma-separated algorithms to measure [all available: %s]" % (', '.join(digests.available_algorithms()),))
+    options, _ = parser.parse_args(argv)
+
+    sizes = [int(size) for size in options.sizes.split(',')]
+    algorithms = options.algorithms.split(',') if options.algorithms else digests.available_algorithms()
+
+    sys.stdout.write("%-10s %10s %14s %14s\n" % ("algorithm", "size", "one-shot MB/s", "chunked MB/s"))
+    for size in sizes:
+        body = os.urandom(size)
+        chunks = [body[i:i + CHUNK_SIZE] for i in range(0, size, CHUNK_SIZE)]
+
+        for name in algorithms:
+            def one_shot():
+                digests.digest(name, body)
+
+            def chunked():
+                hasher = digests.new(name)
+                for chunk in chunks:
+                    hasher.update(chunk)
+                hasher.digest()
+
+            megabytes = size / 1e6
+            sys.stdout.write("%-10s %10d %14.1f %14.1f\n" % (
+                name, size,
+                measure(one_shot, options.seconds) * megabytes,
+                measure(chunked, options.seconds) * megabytes,
+                ))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
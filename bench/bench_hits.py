@@ -0,0 +1,169 @@
+'''
+The CPU time and memory of a cache hit
+
+(c) 2018 simzes
+
+Usage:
+    python bench/bench_hits.py [--hits 20000]
+
+Serves cache hits through webcache.handle_application, on one thread,
+from an InMemoryBackend, with environs shaped like mod_wsgi's for a
+browser request (a couple of dozen server keys, and a dozen HTTP_
+headers), for entries whose origin sent a dozen headers. Reports the
+CPU time per hit, for plain hits and for hits answered with a 304, and
+the times of the header work inside them: building the request headers
+and reading If-Modified-Since, and building the response from the entry.
+
+Under Python 3.4 or later, also reports the bytes allocated per hit, as
+the peak traced by tracemalloc over a hit.
+'''
+
+import itertools
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webcache'))
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import backends
+import upstream
+import webcache
+
+import mock_origin
+
+URLS = 64
+
+try:
+    cpu_time = time.process_time
+except AttributeError:
+    cpu_time = time.clock
+
+ORIGIN_HEADERS = [
+    ('Cache-Control', 'public, max-age=60'),
+    ('ETag', '"5a49d740-800"'),
+    ('Server', 'Apache/2.4.29 (Ubuntu)'),
+    ('Vary', 'Accept-Encoding'),
+    ('X-Powered-By', 'PHP/7.2.5'),
+    ('Content-Language', 'en'),
+    ('X-Frame-Options', 'SAMEORIGIN'),
+    ('X-Content-Type-Options', 'nosniff'),
+    ('Strict-Transport-Security', 'max-age=31536000'),
+    ('Accept-Ranges', 'bytes'),
+]
+
+def make_environ(url, ims=False):
+    '''An environ with the keys mod_wsgi sets for a browser's request'''
+    environ = {
+        'REQUEST_URI': url,
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': url,
+        'QUERY_STRING': '',
+        'SCRIPT_NAME': '',
+        'SCRIPT_FILENAME': '/usr/local/www/wsgi/webcache.wsgi',
+        'SERVER_NAME': 'bench.example.com',
+        'SERVER_PORT': '80',
+        'SERVER_ADDR': '10.0.0.2',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'SERVER_SOFTWARE': 'Apache/2.4.29 (Ubuntu)',
+        'SERVER_SIGNATURE': '',
+        'SERVER_ADMIN': 'webmaster@example.com',
+        'DOCUMENT_ROOT': '/usr/local/www/htdocs',
+        'CONTEXT_DOCUMENT_ROOT': '/usr/local/www/htdocs',
+        'CONTEXT_PREFIX': '',
+        'REMOTE_ADDR': '10.0.0.9',
+        'REMOTE_PORT': '53412',
+        'GATEWAY_INTERFACE': 'CGI/1.1',
+        'PATH': '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin',
+        'REQUEST_SCHEME': 'http',
+        'mod_wsgi.process_group': 'webcache',
+        'mod_wsgi.application_group': '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+        'HTTP_HOST': 'bench.example.com',
+        'HTTP_CONNECTION': 'keep-alive',
+        'HTTP_CACHE_CONTROL': 'max-age=0',
+        'HTTP_UPGRADE_INSECURE_REQUESTS': '1',
+        'HTTP_USER_AGENT': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/66.0.3359.181 Safari/537.36',
+        'HTTP_ACCEPT': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
+        'HTTP_REFERER': 'http://bench.example.com/',
+        'HTTP_ACCEPT_ENCODING': 'gzip, deflate',
+        'HTTP_ACCEPT_LANGUAGE': 'en-US,en;q=0.9',
+        'HTTP_COOKIE': '_ga=GA1.2.1234567890.1525000000; _gid=GA1.2.987654321.1527000000; session=4f1c2a',
+        'HTTP_DNT': '1',
+    }
+    if ims:
+        environ['HTTP_IF_MODIFIED_SINCE'] = mock_origin.LAST_MODIFIED
+    return environ
+
+def request(environ):
+    body = webcache.handle_application(environ, lambda status, headers: None)
+    for _ in body:
+        pass
+
+def time_call(fn, calls):
+    '''CPU seconds per call'''
+    start = cpu_time()
+    for _ in range(calls):
+        fn()
+    return (cpu_time() - start) / calls
+
+def peak_bytes(fn, calls):
+    '''Most bytes allocated at once during a call, averaged over calls'''
+    total = 0
+    tracemalloc.start()
+    for _ in range(calls):
+        tracemalloc.clear_traces()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        total += peak
+    tracemalloc.stop()
+    return total / float(calls)
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--hits', type='int', default=20000, help="hits per measurement [%default]")
+    options, _ = parser.parse_args(argv)
+
+    origin = mock_origin.MockOrigin(headers=ORIGIN_HEADERS)
+    webcache.STORAGE_BACKEND = backends.InMemoryBackend()
+    webcache.CONTENT_REAPER = None
+    webcache.EXPIRE_SECS = 3600
+    webcache.UPSTREAM_POOL = upstream.UpstreamPool([origin.url])
+    environs = [make_environ('/bench/%d' % (i,)) for i in range(URLS)]
+    ims_environs = [make_environ('/bench/%d' % (i,), ims=True) for i in range(URLS)]
+    for environ in environs:
+        request(environ)
+    origin.stop()
+
+    mc = webcache._open_client()
+    metadata = webcache.EntryMetadata.from_cache_or_none(mc, '/bench/0')
+    metadata.content_entry
+
+    hit = itertools.count()
+    measurements = [
+        ('hit', lambda: request(environs[next(hit) % URLS])),
+        ('304 hit', lambda: request(ims_environs[next(hit) % URLS])),
+        ('request headers', lambda: webcache.get_request_headers(environs[0]).get('If-Modified-Since')),
+        ('response', lambda: webcache.WSGIResponse.from_cache_metadata(metadata)),
+    ]
+
+    sys.stdout.write("%-16s %12s %14s\n" % ('', 'cpu us', 'peak bytes'))
+    for name, fn in measurements:
+        time_call(fn, options.hits // 10)
+        cpu = time_call(fn, options.hits)
+        allocated = '%.0f' % (peak_bytes(fn, options.hits // 10),) if tracemalloc is not None else 'n/a'
+        sys.stdout.write("%-16s %12.2f %14s\n" % (name, cpu * 1e6, allocated))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,137 @@
+'''
+The cost of logging to handle_application, at INFO and DEBUG
+
+(c) 2018 simzes
+
+Usage:
+    python bench/bench_logging.py [--levels INFO,DEBUG] [--sample-rate 0.01] [bench_webcache options] [--output run.json]
+
+Runs the workload of bench_webcache.py (same options, and seeds) once per
+level and way of logging, with the root logger writing to a file in a
+temporary directory:
+
+--none: a logging.NullHandler (the baseline: records are made, but not
+written)
+--file: a logging.FileHandler, writing from the request threads, as
+webcache.wsgi did before requestlog
+--queue: a requestlog.QueueHandler, writing from a background thread
+--sampled: the same, passing the debug records of --sample-rate of urls
+
+and, at each level, once more with --queue and a requestlog.AccessLog.
+Reports requests per second and latency percentiles for each, along with
+the bytes logged, and the records dropped by full queues.
+'''
+
+import json
+import logging
+import optparse
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webcache'))
+
+import requestlog
+import webcache
+
+import bench_webcache
+
+MODES = ('none', 'file', 'queue', 'sampled', 'queue+access')
+
+def configure(mode, level, directory, options):
+    '''Sets up the root logger (and webcache.ACCESS_LOG) for a mode,
+    returning the handlers to flush and close after the run'''
+    path = os.path.join(directory, 'wsgi.log')
+    root = logging.getLogger()
+    root.setLevel(level)
+    if mode == 'none':
+        # without a handler, logging.debug() would add one for stderr
+        handler = logging.NullHandler()
+        root.addHandler(handler)
+        return [handler]
+    if mode == 'file':
+        handler = logging.FileHandler(path)
+        handler.setFormatter(logging.Formatter(requestlog.DEFAULT_FORMAT))
+        root.addHandler(handler)
+        return [handler]
+
+    sample_rate = options.sample_rate if mode == 'sampled' else None
+    handlers = [requestlog.configure(path, level, debug_sample_rate=sample_rate)]
+    if mode == 'queue+access':
+        webcache.ACCESS_LOG = requestlog.AccessLog(os.path.join(directory, 'access.log'))
+        handlers.append(webcache.ACCESS_LOG)
+    return handlers
+
+def run(mode, level, options):
+    directory = tempfile.mkdtemp(prefix='bench_logging')
+    handlers = configure(mode, level, directory, options)
+    try:
+        results = bench_webcache.run(options)
+        for handler in handlers:
+            handler.flush()
+        results['dropped'] = sum(getattr(handler, 'dropped', 0) for handler in handlers)
+        results['bytes_logged'] = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+    finally:
+        root = logging.getLogger()
+        for handler in handlers:
+            if handler in root.handlers:
+                root.removeHandler(handler)
+            handler.close()
+        webcache.ACCESS_LOG = None
+        shutil.rmtree(directory)
+    return results
+
+def report(results):
+    sys.stdout.write("%-20s %12s %10s %10s %10s %14s %10s\n" % ('', 'requests/s', 'p50 ms', 'p99 ms', 'max ms', 'bytes logged', 'dropped'))
+    for name, r in results:
+        sys.stdout.write("%-20s %12s %10s %10s %10s %14s %10s\n" % (name, r['requests_per_sec'],
+            r['latency_ms']['p50'], r['latency_ms']['p99'], r['latency_ms']['max'], r['bytes_logged'], r['dropped']))
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--levels', default='INFO,DEBUG', help="root logger levels to run at [%default]")
+    parser.add_option('--modes', default=','.join(MODES), help="ways of logging to run [%default]")
+    parser.add_option('--sample-rate', type='float', default=0.01, help="debug_sample_rate of the sampled mode [%default]")
+    parser.add_option('--backend', default='memory', help="memory, or memcached:host[:port] [%default]")
+    parser.add_option('--threads', type='int', default=8, help="client threads [%default]")
+    parser.add_option('--requests', type='int', default=20000, help="requests, over all threads [%default]")
+    parser.add_option('--urls', type='int', default=1000, help="distinct urls [%default]")
+    parser.add_option('--zipf', type='float', default=1.0, help="popularity skew [%default]")
+    parser.add_option('--body-sizes', default='1024:0.6,16384:0.3,262144:0.1',
+        help="body sizes, as size:weight pairs [%default]")
+    parser.add_option('--ims', type='float', default=0.2, help="fraction of requests with If-Modified-Since [%default]")
+    parser.add_option('--origin-latency', type='float', default=5, help="origin delay, in ms [%default]")
+    parser.add_option('--origin-jitter', type='float', default=0, help="extra origin delay, up to this many ms at random [%default]")
+    parser.add_option('--expire-secs', type='int', default=webcache.EXPIRE_SECS, help="EXPIRE_SECS for the runs [%default]")
+    parser.add_option('--seed', type='int', default=1, help="workload seed [%default]")
+    parser.add_option('--output', help="file to save the options and results to, as JSON")
+    options, _ = parser.parse_args(argv)
+
+    results = []
+    for level in options.levels.split(','):
+        for mode in options.modes.split(','):
+            if mode not in MODES:
+                parser.error("unknown mode: %s" % (mode,))
+            results.append(('%s %s' % (level, mode), run(mode, getattr(logging, level), options)))
+    report(results)
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump({
+                'options': vars(options),
+                'environment': {
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'time': time.time(),
+                },
+                'results': dict(results),
+            }, output, indent=2, sort_keys=True)
+            output.write('\n')
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,101 @@
+'''
+Measures what recording metrics adds to each request
+
+(c) 2018 simzes
+
+Usage:
+    python bench/bench_metrics.py [--requests 20000] [--threads 1,4]
+
+Serves cache hits through webcache.handle_application, from an
+InMemoryBackend, with METRICS off and then on, on each number of threads,
+and reports requests per second and the time metrics add per request.
+Also times the individual recording calls. The origin (mock_origin.py)
+only sees the first request for each url.
+'''
+
+import optparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webcache'))
+
+import backends
+import upstream
+import webcache
+
+import mock_origin
+
+URLS = 64
+
+def request(url):
+    environ = {'REQUEST_URI': url, 'HTTP_HOST': 'bench.example.com'}
+    body = webcache.handle_application(environ, lambda status, headers: None)
+    for _ in body:
+        pass
+
+def serve(requests, threads):
+    '''Serves requests hits, spread over threads; returns the elapsed time'''
+    per_thread = requests // threads
+
+    def run(offset):
+        for i in range(per_thread):
+            request('/bench/%d' % ((offset + i) % URLS,))
+
+    workers = [threading.Thread(target=run, args=(t * 7,)) for t in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.time() - start
+
+def time_call(fn, calls):
+    start = time.time()
+    for _ in range(calls):
+        fn()
+    return (time.time() - start) / calls
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--requests', type='int', default=20000,
+        help="requests per measurement [%default]")
+    parser.add_option('--threads', default='1,4',
+        help="comma-separated thread counts [%default]")
+    options, _ = parser.parse_args(argv)
+
+    webcache.STORAGE_BACKEND = backends.InMemoryBackend()
+    webcache.CONTENT_REAPER = None
+    webcache.EXPIRE_SECS = 3600
+    webcache.UPSTREAM_POOL = upstream.UpstreamPool([mock_origin.MockOrigin().url])
+    for i in range(URLS):
+        request('/bench/%d' % (i,))
+
+    sys.stdout.write("%8s %16s %16s %14s\n" % ("threads", "off req/s", "on req/s", "added us/req"))
+    for threads in [int(t) for t in options.threads.split(',')]:
+        webcache.METRICS = None
+        serve(options.requests // 10, threads)
+        off = serve(options.requests, threads)
+
+        webcache.start_metrics()
+        serve(options.requests // 10, threads)
+        on = serve(options.requests, threads)
+
+        sys.stdout.write("%8d %16.0f %16.0f %14.2f\n" % (
+            threads, options.requests / off, options.requests / on,
+            (on - off) / options.requests * 1e6))
+
+    registry = webcache.new_metrics()
+    labels = (('source', 'hit'),)
+    calls = 200000
+    sys.stdout.write("\nper call: inc %.3f us, observe %.3f us, note_url %.3f us\n" % (
+        time_call(lambda: registry.inc('webcache_responses_total', 1, labels), calls) * 1e6,
+        time_call(lambda: registry.observe('webcache_request_seconds', 0.0012), calls) * 1e6,
+        time_call(lambda: registry.note_url('/bench/1'), calls) * 1e6,
+        ))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
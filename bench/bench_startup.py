@@ -0,0 +1,234 @@
+'''
+The startup cost of a new webcache process
+
+(c) 2018 simzes
+
+Usage:
+    python bench/bench_startup.py [--runs 5] [--server 127.0.0.1:11211]
+
+Starts new Python processes, as mod_wsgi does when it spawns or recycles
+a daemon process, and times each from its start to its first served
+hit, and the parts of that: importing the webcache, warming up, and the
+first hit and first miss served. Each run starts one process that warms
+up (webcache.warm_up, as webcache.wsgi does) and one that doesn't.
+Reports the median and worst of the runs, and the import time of the
+libraries loaded as the webcache starts, each imported alone.
+
+Warm processes take longer from their start to their first hit, having
+warmed up first; under mod_wsgi, with WSGIImportScript, that is done
+before the process is passed requests, so the first hit and first miss
+are what clients see.
+
+Entries are held in memcached with --server, or otherwise in each
+process's InMemoryBackend, loaded from a snapshot before the clock
+starts (as a memcached already holding them would be). The hit is
+on one of --urls urls, fetched from a mock origin beforehand; each
+process maps a new shared cache table, as the first process on a host
+would, so warming up loads it with the hot urls' bodies.
+'''
+
+import json
+import optparse
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+PHASES = ('import webcache', 'warm up', 'first hit', 'first miss', 'start to first hit')
+LIBRARIES = ('dateutil.tz', 'pylibmc', 'requests', 'webcache')
+
+def make_environ(url):
+    return {
+        'REQUEST_URI': url,
+        'REQUEST_METHOD': 'GET',
+        'PATH_INFO': url,
+        'QUERY_STRING': '',
+        'SCRIPT_NAME': '',
+        'SERVER_NAME': 'bench.example.com',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '10.0.0.9',
+        'wsgi.url_scheme': 'http',
+        'HTTP_HOST': 'bench.example.com',
+        'HTTP_ACCEPT_ENCODING': 'gzip, deflate',
+    }
+
+def request(webcache, url):
+    '''Serves url, returning the seconds taken and the status'''
+    statuses = []
+    started = time.time()
+    body = webcache.handle_application(make_environ(url), lambda status, headers: statuses.append(status))
+    for _ in body:
+        pass
+    return time.time() - started, statuses[0]
+
+def child(options, spawned):
+    '''Runs in a new process; writes its timings to stdout, as JSON'''
+    started = time.time()
+    import webcache
+    imported = time.time()
+
+    import backends
+    import logging
+    import shmcache
+    import upstream
+
+    logging.getLogger().addHandler(logging.NullHandler())
+    webcache.CONTENT_REAPER = None
+    webcache.EXPIRE_SECS = 3600
+    webcache.UPSTREAM_POOL = upstream.UpstreamPool([options.origin])
+    if options.server:
+        webcache.STORAGE_BACKEND = backends.MemcachedBackend([options.server])
+    else:
+        webcache.STORAGE_BACKEND = backends.InMemoryBackend()
+        webcache.restore_snapshot(options.snapshot, webcache.STORAGE_BACKEND)
+        webcache.STORAGE_BACKEND.set(webcache.HOT_URLS_KEY, hot_urls(options))
+    webcache.SHARED_CACHE = shmcache.SharedCache(os.path.join(options.dir, 'table-%d' % (os.getpid(),)),
+        sets=1024, slot_bytes=options.body_size * 2)
+    setup_secs = time.time() - imported
+
+    timings = {'import webcache': imported - started, 'warm up': 0.0}
+    if options.child == 'warm':
+        warm_started = time.time()
+        webcache.warm_up()
+        timings['warm up'] = time.time() - warm_started
+
+    timings['first hit'], status = request(webcache, hot_urls(options)[0])
+    assert status.startswith('200'), status
+    # the time from the process starting to the hit served, without the
+    # snapshot loading standing in for memcached
+    timings['start to first hit'] = time.time() - spawned - setup_secs
+    timings['first miss'], status = request(webcache, '/startup/miss-%d' % (os.getpid(),))
+    assert status.startswith('200'), status
+
+    webcache.SHARED_CACHE.close()
+    sys.stdout.write(json.dumps(timings) + '\n')
+
+def import_time(module):
+    '''Seconds taken to import module, in a new process; None if it isn't
+    installed'''
+    script = 'import time; started = time.time(); import %s; print(time.time() - started)' % (module,)
+    try:
+        output = subprocess.check_output([sys.executable, '-c', script], stderr=open(os.devnull, 'w'),
+            env=dict(os.environ, PYTHONPATH=webcache_dir()))
+    except subprocess.CalledProcessError:
+        return None
+    return float(output)
+
+def webcache_dir():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webcache')
+
+def hot_urls(options):
+    return ['/startup/hot-%d' % (i,) for i in range(options.urls)]
+
+def spawn(mode, argv):
+    '''Starts a process in mode (cold or warm); returns its timings'''
+    spawned = time.time()
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', mode,
+        '--spawned', repr(spawned)] + argv)
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+def populate(options, directory):
+    '''Fetches the hot urls into the cache; returns the child options'''
+    sys.path.insert(0, webcache_dir())
+    import backends
+    import upstream
+    import webcache
+
+    webcache.CONTENT_REAPER = None
+    webcache.EXPIRE_SECS = 3600
+    webcache.UPSTREAM_POOL = upstream.UpstreamPool([options.origin])
+    argv = ['--origin', options.origin, '--urls', str(options.urls), '--body-size', str(options.body_size),
+        '--dir', directory]
+    if options.server:
+        webcache.STORAGE_BACKEND = backends.MemcachedBackend([options.server])
+        argv += ['--server', options.server]
+    else:
+        webcache.STORAGE_BACKEND = backends.InMemoryBackend()
+    for url in hot_urls(options):
+        request(webcache, url)
+    # published under webcache.HOT_URLS_KEY, and loaded by processes
+    # without memcached
+    snapshot_path = os.path.join(directory, 'snapshot')
+    webcache.save_snapshot(hot_urls(options), snapshot_path, webcache.STORAGE_BACKEND)
+    return argv + ['--snapshot', snapshot_path]
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--runs', type='int', default=5, help="processes started of each kind [%default]")
+    parser.add_option('--urls', type='int', default=100, help="hot urls cached beforehand [%default]")
+    parser.add_option('--body-size', type='int', default=1024, help="bytes in each body [%default]")
+    parser.add_option('--server', help="memcached instance to keep entries in, rather than in each process")
+    parser.add_option('--output', help="file to save the options and results to, as JSON")
+    # set for the processes started
+    parser.add_option('--child', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--spawned', type='float', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--origin', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--snapshot', help=optparse.SUPPRESS_HELP)
+    parser.add_option('--dir', help=optparse.SUPPRESS_HELP)
+    options, _ = parser.parse_args(argv)
+
+    if options.child:
+        sys.path.insert(0, webcache_dir())
+        child(options, options.spawned)
+        return 0
+
+    import mock_origin
+
+    imports = {}
+    sys.stdout.write("%-20s %10s\n" % ('import, alone', 'ms'))
+    for module in LIBRARIES:
+        times = [import_time(module) for _ in range(options.runs)]
+        imports[module] = median(times) if None not in times else None
+        sys.stdout.write("%-20s %10s\n" % (module, '%.1f' % (imports[module] * 1e3,) if imports[module] is not None else 'n/a'))
+
+    origin = mock_origin.MockOrigin(size_fn=lambda path: options.body_size)
+    options.origin = origin.url
+    directory = tempfile.mkdtemp()
+    try:
+        child_argv = populate(options, directory)
+        runs = {'cold': [], 'warm': []}
+        for _ in range(options.runs):
+            for mode in ('cold', 'warm'):
+                runs[mode].append(spawn(mode, child_argv))
+    finally:
+        origin.stop()
+        shutil.rmtree(directory)
+
+    results = {}
+    sys.stdout.write("\n%-20s %12s %12s %12s %12s\n" % ('', 'cold median', 'cold worst', 'warm median', 'warm worst'))
+    for phase in PHASES:
+        row = {}
+        for mode in ('cold', 'warm'):
+            values = [timings[phase] for timings in runs[mode]]
+            row[mode] = {'median': median(values), 'worst': max(values)}
+        results[phase] = row
+        sys.stdout.write("%-20s %12.1f %12.1f %12.1f %12.1f\n" % (phase, row['cold']['median'] * 1e3,
+            row['cold']['worst'] * 1e3, row['warm']['median'] * 1e3, row['warm']['worst'] * 1e3))
+    sys.stdout.write("(ms)\n")
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump({
+                'options': vars(options),
+                'environment': {
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'time': time.time(),
+                },
+                'imports': imports,
+                'results': results,
+            }, output, indent=2, sort_keys=True)
+            output.write('\n')
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
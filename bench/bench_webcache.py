@@ -0,0 +1,234 @@
+'''
+Throughput and latency of webcache.handle_application under a workload
+
+(c) 2018 simzes
+
+Usage:
+    python bench/bench_webcache.py [options] [--output run.json] [--compare base.json]
+
+Drives handle_application directly (no Apache) from a number of threads,
+against a storage backend and a mock origin (mock_origin.py) with an
+injectable delay. The workload is generated from a seed, so runs with the
+same options make the same requests:
+
+--urls, --zipf: the number of distinct urls, and the skew of their
+popularity (url k is requested in proportion to 1 / k ** zipf)
+--body-sizes: the distribution of body sizes, as size:weight pairs; each
+url keeps the size drawn for it
+--ims: the fraction of requests sent with If-Modified-Since, for the
+origin's Last-Modified (answered with a 304 when cached)
+--threads, --requests: the number of client threads, and of requests they
+make in all
+
+--backend is memory (backends.InMemoryBackend), or memcached:host[:port]
+(backends.MemcachedBackend; the server should be started empty).
+
+Reports requests per second, latency percentiles, origin requests per
+client request, and the bytes the backend holds at the end. --output saves
+the options and results as JSON; --compare prints the change from a saved
+run.
+'''
+
+import bisect
+import json
+import optparse
+import os
+import platform
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webcache'))
+
+import backends
+import upstream
+import webcache
+
+import mock_origin
+
+def parse_weighted(spec):
+    '''"value:weight,value:weight" -> [(value, weight)]'''
+    pairs = []
+    for item in spec.split(','):
+        value, _, weight = item.partition(':')
+        pairs.append((int(value), float(weight or 1)))
+    return pairs
+
+class Workload(object):
+    '''The requests of a benchmark run, generated from a seed'''
+
+    def __init__(self, urls, zipf, body_sizes, ims, seed):
+        self.urls = ['/bench/%d' % (i,) for i in range(urls)]
+        self.ims = ims
+        self.seed = seed
+
+        self._cumulative = []
+        total = 0.0
+        for rank in range(1, urls + 1):
+            total += 1.0 / rank ** zipf
+            self._cumulative.append(total)
+
+        sizes = random.Random(seed)
+        size_total = sum(weight for _, weight in body_sizes)
+        self.sizes = {}
+        for url in self.urls:
+            pick = sizes.random() * size_total
+            for size, weight in body_sizes:
+                pick -= weight
+                if pick < 0:
+                    break
+            self.sizes[url] = size
+
+    def size(self, path):
+        return self.sizes.get(path, 0)
+
+    def requests(self, thread_index, count):
+        '''The wsgi environs of one client thread's requests'''
+        rng = random.Random('%s-%d' % (self.seed, thread_index))
+        total = self._cumulative[-1]
+        for _ in range(count):
+            url = self.urls[min(bisect.bisect_left(self._cumulative, rng.random() * total), len(self.urls) - 1)]
+            environ = {'REQUEST_URI': url, 'HTTP_HOST': 'bench.example.com'}
+            if rng.random() < self.ims:
+                environ['HTTP_IF_MODIFIED_SINCE'] = mock_origin.LAST_MODIFIED
+            yield environ
+
+def open_backend(spec):
+    if spec == 'memory':
+        return backends.InMemoryBackend()
+    if spec.startswith('memcached:'):
+        return backends.MemcachedBackend([spec[len('memcached:'):]], binary=True, behaviors={"tcp_nodelay": True, "cas": True})
+    raise ValueError("Unknown backend: %s" % (spec,))
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+def run(options):
+    workload = Workload(options.urls, options.zipf, parse_weighted(options.body_sizes), options.ims, options.seed)
+    origin = mock_origin.MockOrigin(workload.size, options.origin_latency / 1000.0, options.origin_jitter / 1000.0, options.seed)
+
+    backend = open_backend(options.backend)
+    webcache.STORAGE_BACKEND = backend
+    webcache.EXPIRE_SECS = options.expire_secs
+    webcache.UPSTREAM_POOL = upstream.UpstreamPool([origin.url])
+
+    per_thread = options.requests // options.threads
+    latencies = [[] for _ in range(options.threads)]
+    statuses = [{} for _ in range(options.threads)]
+    failures = []
+
+    def client(index):
+        thread_latencies = latencies[index]
+        thread_statuses = statuses[index]
+
+        def start_response(status, headers):
+            thread_statuses[status[:3]] = thread_statuses.get(status[:3], 0) + 1
+
+        for environ in workload.requests(index, per_thread):
+            started = time.time()
+            try:
+                for _ in webcache.handle_application(environ, start_response):
+                    pass
+            except Exception as e:
+                failures.append(repr(e))
+            thread_latencies.append(time.time() - started)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(options.threads)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    origin.stop()
+
+    ordered = sorted(latency for thread_latencies in latencies for latency in thread_latencies)
+    requests = len(ordered)
+    status_counts = {}
+    for thread_statuses in statuses:
+        for status, count in thread_statuses.items():
+            status_counts[status] = status_counts.get(status, 0) + count
+    stored = backend.stats()
+
+    return {
+        'requests': requests,
+        'seconds': round(elapsed, 3),
+        'requests_per_sec': round(requests / elapsed, 1),
+        'latency_ms': dict((name, round(percentile(ordered, fraction) * 1000, 3))
+            for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))),
+        'statuses': status_counts,
+        'failures': len(failures),
+        'origin_requests': origin.requests,
+        'origin_per_request': round(float(origin.requests) / requests, 4),
+        'origin_bytes': origin.bytes_sent,
+        'items_stored': stored['items'],
+        'bytes_stored': stored['bytes'],
+    }
+
+def report(results, base=None):
+    rows = [
+        ('requests/s', results['requests_per_sec'], base and base['requests_per_sec']),
+        ('p50 ms', results['latency_ms']['p50'], base and base['latency_ms']['p50']),
+        ('p90 ms', results['latency_ms']['p90'], base and base['latency_ms']['p90']),
+        ('p99 ms', results['latency_ms']['p99'], base and base['latency_ms']['p99']),
+        ('max ms', results['latency_ms']['max'], base and base['latency_ms']['max']),
+        ('origin/request', results['origin_per_request'], base and base['origin_per_request']),
+        ('bytes stored', results['bytes_stored'], base and base['bytes_stored']),
+        ('items stored', results['items_stored'], base and base['items_stored']),
+    ]
+    for name, value, base_value in rows:
+        line = "%-16s %14s" % (name, value)
+        if base_value is not None:
+            change = (float(value) - base_value) / base_value * 100 if base_value else 0
+            line += " %14s %+8.1f%%" % (base_value, change)
+        sys.stdout.write(line + "\n")
+    sys.stdout.write("%-16s %14s\n" % ('statuses', ' '.join('%s:%d' % item for item in sorted(results['statuses'].items()))))
+    if results['failures']:
+        sys.stdout.write("%-16s %14d\n" % ('failures', results['failures']))
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--backend', default='memory', help="memory, or memcached:host[:port] [%default]")
+    parser.add_option('--threads', type='int', default=4, help="client threads [%default]")
+    parser.add_option('--requests', type='int', default=20000, help="requests, over all threads [%default]")
+    parser.add_option('--urls', type='int', default=1000, help="distinct urls [%default]")
+    parser.add_option('--zipf', type='float', default=1.0, help="popularity skew [%default]")
+    parser.add_option('--body-sizes', default='1024:0.6,16384:0.3,262144:0.1',
+        help="body sizes, as size:weight pairs [%default]")
+    parser.add_option('--ims', type='float', default=0.2, help="fraction of requests with If-Modified-Since [%default]")
+    parser.add_option('--origin-latency', type='float', default=5, help="origin delay, in ms [%default]")
+    parser.add_option('--origin-jitter', type='float', default=0, help="extra origin delay, up to this many ms at random [%default]")
+    parser.add_option('--expire-secs', type='int', default=webcache.EXPIRE_SECS, help="EXPIRE_SECS for the run [%default]")
+    parser.add_option('--seed', type='int', default=1, help="workload seed [%default]")
+    parser.add_option('--output', help="file to save the options and results to, as JSON")
+    parser.add_option('--compare', help="saved run to compare against")
+    options, _ = parser.parse_args(argv)
+
+    results = run(options)
+    base = None
+    if options.compare:
+        with open(options.compare) as saved:
+            base = json.load(saved)['results']
+    report(results, base)
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump({
+                'options': vars(options),
+                'environment': {
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'time': time.time(),
+                },
+                'results': results,
+            }, output, indent=2, sort_keys=True)
+            output.write('\n')
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
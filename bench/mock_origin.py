@@ -0,0 +1,81 @@
+'''
+A mock origin server for benchmarks
+
+(c) 2018 simzes
+
+Serves every path with a body of a fixed size per path, a fixed
+Last-Modified, and an optional delay, from a WSGI application on a
+local port, with a thread per request. Counts the requests it serves,
+and records when each arrived.
+'''
+
+import random
+import threading
+import time
+import wsgiref.simple_server
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+LAST_MODIFIED = 'Mon, 01 Jan 2018 00:00:00 GMT'
+
+class QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+class MockOrigin(object):
+    '''size_fn maps a path to its body size; latency_secs (plus up to
+    jitter_secs, at random) delays each response; headers are sent with
+    every response, after the usual ones'''
+
+    def __init__(self, size_fn=lambda path: 2048, latency_secs=0, jitter_secs=0, seed=0, headers=()):
+        self.size_fn = size_fn
+        self.headers = list(headers)
+        self.latency_secs = latency_secs
+        self.jitter_secs = jitter_secs
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.times = []
+
+        self._server = wsgiref.simple_server.make_server('127.0.0.1', 0, self.application,
+            server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+        self.url = 'http://127.0.0.1:%d' % (self._server.server_port,)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def application(self, environ, start_response):
+        size = self.size_fn(environ['PATH_INFO'])
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += size
+            self.times.append(time.time())
+            delay = self.latency_secs + (self._random.random() * self.jitter_secs if self.jitter_secs else 0)
+        if delay:
+            time.sleep(delay)
+
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', str(size)),
+            ('Last-Modified', LAST_MODIFIED),
+            ] + self.headers)
+        return [b'x' * size]
+
+    def reset_counts(self):
+        with self._lock:
+            self.requests = 0
+            self.bytes_sent = 0
+            self.times = []
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,290 @@
+'''
+Stress test of the reservation protocol, with many threads on few urls
+
+(c) 2018 simzes
+
+Usage:
+    python bench/stress_contention.py [--threads 200] [--duration 20] [--expire-secs 2] [faults]
+
+Runs many client threads through webcache.handle_application, all
+requesting the same url (or a few), while its entry expires every
+--expire-secs, so that every expiry sets off a contest for the update.
+Entries are kept in an InMemoryBackend, which is thread-safe and
+CAS-correct as memcached is, and the origin is mock_origin.py. Reports:
+
+--origin fetches per expiry window: 1 is ideal; more is amplification
+--ConsistencyError rate: requests that gave up on updating the entry
+--wake-up latency of losers: from the winner storing the updated entry
+to each waiting loser returning from its backoff; losers whose backoff
+ran out with no update are counted as timed out
+--request time percentiles, and the worst case
+
+Faults can be injected:
+
+--evict-rate: the chance that each get/gets finds its key evicted
+--origin-latency, --origin-jitter: a slow origin (in ms)
+--crash-rate: the chance that a winner fails after winning its
+reservation, without fetching or updating anything
+'''
+
+import bisect
+import json
+import optparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webcache'))
+
+import backends
+import upstream
+import webcache
+
+import mock_origin
+
+class WinnerCrash(Exception):
+    '''Raised in place of a winner's origin request'''
+    pass
+
+class EvictingBackend(object):
+    '''Wraps a backend, dropping each key read with probability rate
+    before reading it, as memcached might evict it'''
+
+    def __init__(self, backend, rate, seed):
+        self.backend = backend
+        self.rate = rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _maybe_evict(self, key):
+        with self._lock:
+            evict = self.rate and self._random.random() < self.rate
+        if evict and self.backend.delete(key):
+            with self._lock:
+                self.evictions += 1
+
+    def get(self, key):
+        self._maybe_evict(key)
+        return self.backend.get(key)
+
+    def gets(self, key):
+        self._maybe_evict(key)
+        return self.backend.gets(key)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+class Recorder(object):
+    '''Wraps the webcache's contest and update functions, to record when
+    updates are stored, and when losers wake up'''
+
+    def __init__(self, crash_rate, seed):
+        self.crash_rate = crash_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+        self.published = []
+        # (contest started, woke up) for each loser
+        self.losers = []
+        self.crashes = 0
+
+        self._compete = webcache.compete_for_cache_update
+        self._update = webcache.update_cache
+        self._issue = webcache._issue_server_request
+        self._local = threading.local()
+
+    def install(self):
+        webcache.compete_for_cache_update = self.compete_for_cache_update
+        webcache.update_cache = self.update_cache
+        webcache._issue_server_request = self.issue_server_request
+
+    def uninstall(self):
+        webcache.compete_for_cache_update = self._compete
+        webcache.update_cache = self._update
+        webcache._issue_server_request = self._issue
+
+    def compete_for_cache_update(self, wsgi_request, mc_client):
+        started = time.time()
+        won, token = self._compete(wsgi_request, mc_client)
+        self._local.won = won
+        if not won:
+            with self._lock:
+                self.losers.append((started, time.time()))
+        return won, token
+
+    def issue_server_request(self, wsgi_request):
+        if getattr(self._local, 'won', False) and self.crash_rate:
+            self._local.won = False
+            with self._lock:
+                crash = self._random.random() < self.crash_rate
+                if crash:
+                    self.crashes += 1
+            if crash:
+                raise WinnerCrash()
+        return self._issue(wsgi_request)
+
+    def update_cache(self, *args, **kwargs):
+        cache_metadata = self._update(*args, **kwargs)
+        with self._lock:
+            self.published.append(time.time())
+        return cache_metadata
+
+    def wake_latencies(self):
+        '''Wake-up latencies of the losers woken by an update stored while
+        they waited, and the number that woke with no update'''
+        published = sorted(self.published)
+        latencies = []
+        timed_out = 0
+        for started, woke in self.losers:
+            index = bisect.bisect_right(published, woke) - 1
+            if index >= 0 and published[index] >= started:
+                latencies.append(woke - published[index])
+            else:
+                timed_out += 1
+        return sorted(latencies), timed_out
+
+def percentiles(ordered):
+    if not ordered:
+        return {}
+    pick = lambda fraction: round(ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] * 1000, 3)
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': pick(1.0)}
+
+def run(options):
+    origin = mock_origin.MockOrigin(lambda path: options.body_size,
+        options.origin_latency / 1000.0, options.origin_jitter / 1000.0, options.seed)
+    backend = EvictingBackend(backends.InMemoryBackend(), options.evict_rate, options.seed)
+
+    webcache.STORAGE_BACKEND = backend
+    webcache.CONTENT_REAPER = None
+    webcache.EXPIRE_SECS = options.expire_secs
+    webcache.SLEEP_POLL_INTERVAL = options.poll_interval
+    webcache.UPSTREAM_POOL = upstream.UpstreamPool([origin.url])
+    registry = webcache.start_metrics()
+
+    recorder = Recorder(options.crash_rate, options.seed)
+    recorder.install()
+
+    urls = ['/stress/%d' % (i,) for i in range(options.urls)]
+    stop = time.time() + options.duration
+    latencies = [[] for _ in range(options.threads)]
+    outcomes = [{} for _ in range(options.threads)]
+
+    def client(index):
+        rng = random.Random('%s-%d' % (options.seed, index))
+        thread_latencies = latencies[index]
+        thread_outcomes = outcomes[index]
+
+        def start_response(status, headers):
+            thread_outcomes[status[:3]] = thread_outcomes.get(status[:3], 0) + 1
+
+        while time.time() < stop:
+            environ = {'REQUEST_URI': rng.choice(urls), 'HTTP_HOST': 'stress.example.com'}
+            started = time.time()
+            try:
+                for _ in webcache.handle_application(environ, start_response):
+                    pass
+            except WinnerCrash:
+                thread_outcomes['crash'] = thread_outcomes.get('crash', 0) + 1
+            thread_latencies.append(time.time() - started)
+            if options.think:
+                time.sleep(rng.random() * options.think / 1000.0)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(options.threads)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    recorder.uninstall()
+    origin.stop()
+
+    windows = {}
+    for fetched in origin.times:
+        window = int((fetched - started) // options.expire_secs)
+        windows[window] = windows.get(window, 0) + 1
+    window_count = max(1, int(elapsed // options.expire_secs))
+    per_window = [windows.get(i, 0) for i in range(window_count)]
+
+    requests = sum(len(l) for l in latencies)
+    status_counts = {}
+    for thread_outcomes in outcomes:
+        for outcome, count in thread_outcomes.items():
+            status_counts[outcome] = status_counts.get(outcome, 0) + count
+    consistency_errors = registry.value('webcache_consistency_errors_total')
+    wake, timed_out = recorder.wake_latencies()
+
+    return {
+        'requests': requests,
+        'seconds': round(elapsed, 3),
+        'requests_per_sec': round(requests / elapsed, 1),
+        'statuses': status_counts,
+        'origin_requests': origin.requests,
+        'origin_per_window': {
+            'mean': round(float(sum(per_window)) / len(per_window), 2),
+            'max': max(per_window),
+            'windows': window_count,
+        },
+        'consistency_errors': consistency_errors,
+        'consistency_error_rate': round(float(consistency_errors) / requests, 5) if requests else 0,
+        'cas_retries': {
+            'reservation': registry.value('webcache_cas_retries_total', (('operation', 'reservation'),)),
+            'update': registry.value('webcache_cas_retries_total', (('operation', 'update'),)),
+        },
+        'reservations_lost': registry.value('webcache_reservations_total', (('result', 'lost'),)),
+        'loser_wake_ms': percentiles(wake),
+        'losers_timed_out': timed_out,
+        'request_ms': percentiles(sorted(l for thread_latencies in latencies for l in thread_latencies)),
+        'evictions': backend.evictions,
+        'winner_crashes': recorder.crashes,
+    }
+
+def report(results):
+    write = lambda name, value: sys.stdout.write("%-24s %s\n" % (name, value))
+    write('requests', '%d in %.1fs (%.0f/s)' % (results['requests'], results['seconds'], results['requests_per_sec']))
+    write('statuses', ' '.join('%s:%d' % item for item in sorted(results['statuses'].items())))
+    window = results['origin_per_window']
+    write('origin fetches/window', 'mean %.2f, max %d, over %d windows' % (window['mean'], window['max'], window['windows']))
+    write('consistency errors', '%d (%.3f%%)' % (results['consistency_errors'], results['consistency_error_rate'] * 100))
+    write('cas retries', 'reservation %(reservation)d, update %(update)d' % results['cas_retries'])
+    write('reservations lost', results['reservations_lost'])
+    write('loser wake-up ms', ', '.join('%s %s' % (k, results['loser_wake_ms'][k]) for k in ('p50', 'p90', 'p99', 'max') if k in results['loser_wake_ms']))
+    write('losers timed out', results['losers_timed_out'])
+    write('request ms', ', '.join('%s %s' % (k, results['request_ms'][k]) for k in ('p50', 'p90', 'p99', 'max') if k in results['request_ms']))
+    write('evictions injected', results['evictions'])
+    write('winner crashes', results['winner_crashes'])
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--threads', type='int', default=200, help="client threads [%default]")
+    parser.add_option('--duration', type='float', default=20, help="seconds to run for [%default]")
+    parser.add_option('--urls', type='int', default=1, help="distinct urls requested [%default]")
+    parser.add_option('--expire-secs', type='int', default=2, help="EXPIRE_SECS for the run [%default]")
+    parser.add_option('--poll-interval', type='float', default=webcache.SLEEP_POLL_INTERVAL,
+        help="SLEEP_POLL_INTERVAL for the run [%default]")
+    parser.add_option('--think', type='float', default=10, help="pause between a thread's requests, up to this many ms [%default]")
+    parser.add_option('--body-size', type='int', default=16384, help="origin body size [%default]")
+    parser.add_option('--origin-latency', type='float', default=50, help="origin delay, in ms [%default]")
+    parser.add_option('--origin-jitter', type='float', default=0, help="extra origin delay, up to this many ms at random [%default]")
+    parser.add_option('--evict-rate', type='float', default=0, help="chance of evicting each key read [%default]")
+    parser.add_option('--crash-rate', type='float', default=0, help="chance of a winner crashing [%default]")
+    parser.add_option('--seed', type='int', default=1, help="seed for the workload and faults [%default]")
+    parser.add_option('--output', help="file to save the options and results to, as JSON")
+    options, _ = parser.parse_args(argv)
+
+    results = run(options)
+    report(results)
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump({'options': vars(options), 'results': results}, output, indent=2, sort_keys=True)
+            output.write('\n')
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
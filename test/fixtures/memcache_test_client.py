@@ -109,7 +109,7 @@ class MockPylibmcClient(object):
 		'''Retrieves the value from the store, or the default or None
 		if there is no entry'''
 
-		if key in self.__store:
+		if key in self.__store and not self.__store[key].expired:
 			entry = self.__store[key]
 
 			logger.debug("GET '%s', %s", str(key), str(entry))
@@ -120,11 +120,42 @@ class MockPylibmcClient(object):
 
 		return default or None
 
+	def get_multi(self, keys):
+		'''Retrieves a table of key -> value for the keys present in the store'''
+		result = {}
+		for key in keys:
+			entry = self.__store.get(key)
+			if entry is not None and not entry.expired:
+				result[key] = entry.value
+
+		logger.debug("GET_MULTI %s, %d found", str(keys), len(result))
+
+		return result
+
+	def set_multi(self, mapping, time=None):
+		'''Stores each key -> value in mapping; returns the keys that failed'''
+		for key, value in mapping.items():
+			self.set(key, value, time=time)
+
+		return []
+
+	def incr(self, key, delta=1):
+		'''Increments the integer value under key, returning the new value'''
+		entry = self.__store.get(key)
+		if entry is None or entry.expired:
+			logger.debug("INCR '%s' MISS", key)
+			raise pylibmc.NotFound()
+
+		entry.value += delta
+		logger.debug("INCR '%s' = %s", key, str(entry.value))
+
+		return entry.value
+
 	def gets(self, key):
 		'''Retrieves tuple of (value, cas token) from store,
 		or (None, None) if there is no entry'''
 
-		if key in self.__store:
+		if key in self.__store and not self.__store[key].expired:
 			entry = self.__store[key]
 
 			logger.debug("GETs '%s', %s (%s)", str(key), str(entry), str(entry.etag))
@@ -0,0 +1,44 @@
+'''Fixture for running mock origin servers: WSGI applications served on
+local ports, in background threads'''
+
+import threading
+import time
+import wsgiref.simple_server
+
+class QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+
+	def log_message(self, *args):
+		pass
+
+class MockOrigin(object):
+	'''A WSGI origin on 127.0.0.1, answering every request with status and
+	a body naming the origin, after delay_secs. Records the Host header of
+	each request'''
+
+	def __init__(self, name, status='200 OK', delay_secs=0):
+		self.name = name
+		self.status = status
+		self.delay_secs = delay_secs
+		self.hosts = []
+
+		self._server = wsgiref.simple_server.make_server('127.0.0.1', 0, self.application, handler_class=QuietHandler)
+		self.url = 'http://127.0.0.1:%d' % (self._server.server_port,)
+		self._thread = threading.Thread(target=self._server.serve_forever)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def application(self, environ, start_response):
+		self.hosts.append(environ.get('HTTP_HOST'))
+		if self.delay_secs:
+			time.sleep(self.delay_secs)
+		body = ('%s %s' % (self.name, environ['PATH_INFO'])).encode('utf-8')
+		start_response(self.status, [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))])
+		return [body]
+
+	@property
+	def requests(self):
+		return len(self.hosts)
+
+	def stop(self):
+		self._server.shutdown()
+		self._server.server_close()
@@ -0,0 +1,39 @@
+import unittest
+import admission
+
+class TestFrequencyAdmission(unittest.TestCase):
+
+	def test_threshold(self):
+		'''tests that a key is admitted only once it reaches the threshold'''
+		policy = admission.FrequencyAdmission(threshold=3, width=1024)
+
+		for _ in range(2):
+			policy.record('/page')
+			self.assertFalse(policy.admit('/page'))
+		policy.record('/page')
+		self.assertTrue(policy.admit('/page'))
+
+		self.assertEqual(policy.stats()['admitted'], 1)
+		self.assertEqual(policy.stats()['rejected'], 2)
+
+	def test_beats_victim(self):
+		'''tests that a key below the threshold is admitted when it is
+		more frequent than a resident entry, and not otherwise'''
+		policy = admission.FrequencyAdmission(threshold=5, width=1024)
+
+		# becomes resident by reaching the threshold, then ages down
+		for _ in range(5):
+			policy.record('/resident')
+		self.assertTrue(policy.admit('/resident'))
+		policy._sketch.reset()
+		policy._sketch.reset()
+
+		policy.record('/one-hit')
+		self.assertFalse(policy.admit('/one-hit'))
+
+		for _ in range(3):
+			policy.record('/rising')
+		self.assertTrue(policy.admit('/rising'))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,164 @@
+import logging
+import random
+import time
+import unittest
+
+import backends
+import requestlog
+import upstream
+import webcache
+
+import fixtures.origin_mockout
+
+# the ASGI application needs Python 3.5, and aiohttp
+try:
+	import aiohttp
+	import asyncio
+
+	import aiobackends
+	import asgi
+except (ImportError, SyntaxError):
+	asgi = None
+
+def make_scope(path, headers=()):
+	return {
+		'type': 'http',
+		'method': 'GET',
+		'path': path,
+		'raw_path': path.encode('latin-1'),
+		'query_string': b'',
+		'headers': [(b'host', b'cache.example.com')] + [(n.lower().encode('latin-1'), v.encode('latin-1')) for n, v in headers],
+	}
+
+@unittest.skipIf(asgi is None, "requires Python 3.5 and aiohttp")
+class TestASGI(unittest.TestCase):
+
+	def setUp(self):
+		self.loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(self.loop)
+		self.addCleanup(self.loop.close)
+
+		self.origin = fixtures.origin_mockout.MockOrigin('origin', delay_secs=0.2)
+		self.addCleanup(self.origin.stop)
+
+		self.backend = backends.InMemoryBackend()
+		self.patch(asgi, 'STORAGE_BACKEND', aiobackends.AsyncInMemoryBackend(self.backend))
+		self.patch(webcache, 'STORAGE_BACKEND', self.backend)
+		self.patch(webcache, 'CONTENT_REAPER', None)
+		self.patch(webcache, 'UPSTREAM_POOL', upstream.UpstreamPool([self.origin.url]))
+		self.addCleanup(lambda: self.run_async(asgi.close()))
+
+	def patch(self, module, name, value):
+		'''sets a module setting for the duration of the test'''
+		self.addCleanup(setattr, module, name, getattr(module, name))
+		setattr(module, name, value)
+
+	def run_async(self, awaitable):
+		return self.loop.run_until_complete(awaitable)
+
+	def request(self, path, headers=()):
+		'''Runs a request through the application, returning the status,
+		headers and body sent'''
+		return self.run_async(self.start_request(path, headers))
+
+	def start_request(self, path, headers=()):
+		'''Starts a request through the application, returning a future of
+		its status, headers and body'''
+		messages = []
+		result = self.loop.create_future()
+
+		def send(message):
+			messages.append(message)
+			return asyncio.sleep(0)
+
+		def finish(task):
+			if task.exception() is not None:
+				result.set_exception(task.exception())
+				return
+			start, body = messages
+			headers = dict((n.decode('latin-1'), v.decode('latin-1')) for n, v in start['headers'])
+			result.set_result((start['status'], headers, body['body']))
+
+		task = self.loop.create_task(asgi.application(make_scope(path, headers), None, send))
+		task.add_done_callback(finish)
+		return result
+
+	def test_miss_then_hit(self):
+		'''tests that a miss is fetched from the origin and stored, and then
+		served from the cache'''
+		status, headers, body = self.request('/page')
+		self.assertEqual((status, body), (200, b'origin /page'))
+		self.assertEqual(headers['Content-Type'], 'text/plain')
+		self.assertEqual(self.origin.hosts, ['cache.example.com'])
+
+		status, headers, body = self.request('/page')
+		self.assertEqual((status, body), (200, b'origin /page'))
+		self.assertEqual(self.origin.requests, 1)
+
+	def test_not_modified(self):
+		'''tests that If-Modified-Since is answered from the cache'''
+		status, headers, body = self.request('/page')
+		status, headers, body = self.request('/page', [('If-Modified-Since', headers['Last-Modified'])])
+		self.assertEqual((status, body), (304, b''))
+		self.assertEqual(self.origin.requests, 1)
+
+	def test_losers_woken_by_update(self):
+		'''tests that concurrent misses for a url wait for the winner's update,
+		and are woken as soon as it is stored rather than at their next poll'''
+		random.seed(3)
+		self.patch(webcache, 'SLEEP_POLL_INTERVAL', 10)
+		self.patch(webcache, 'SLEEP_MULTIPLY_INTERVAL', 100)
+
+		started = time.time()
+		results = self.run_async(asyncio.gather(*[self.start_request('/contested') for _ in range(20)]))
+		self.assertLess(time.time() - started, 5)
+
+		self.assertEqual(set((status, body) for status, _, body in results), set([(200, b'origin /contested')]))
+		self.assertLess(self.origin.requests, 5)
+		self.assertEqual(len(asgi._notifier), 0)
+
+	def test_unsupported_settings(self):
+		'''tests that startup fails with a setting the application can't
+		serve'''
+		self.patch(webcache, 'TRACER', object())
+		messages = []
+
+		def receive():
+			return asyncio.sleep(0, {'type': 'lifespan.startup'})
+
+		def send(message):
+			messages.append(message)
+			return asyncio.sleep(0)
+
+		self.run_async(asgi.application({'type': 'lifespan'}, receive, send))
+		self.assertEqual(messages[0]['type'], 'lifespan.startup.failed')
+		self.assertIn('TRACER', messages[0]['message'])
+
+	@unittest.skipIf(requestlog._task_url is None, "requires Python 3.7")
+	def test_debug_sampled_by_url(self):
+		'''tests that concurrent requests on the event loop have their debug
+		records sampled each by its own url'''
+		sampler = requestlog.UrlSampler(0.5)
+		paths = ['/page/%d' % (i,) for i in range(4)]
+		sampled = [path for path in paths if sampler.sampled(path)]
+		self.assertTrue(0 < len(sampled) < len(paths))
+
+		messages = []
+		handler = logging.Handler()
+		handler.emit = lambda record: messages.append(record.getMessage())
+		handler.addFilter(sampler)
+		root = logging.getLogger()
+		self.addCleanup(root.setLevel, root.level)
+		self.addCleanup(root.removeHandler, handler)
+		root.setLevel(logging.DEBUG)
+		root.addHandler(handler)
+
+		self.run_async(asyncio.gather(*[self.start_request(path) for path in paths]))
+		received = [m.split('url: ')[1].split(',')[0] for m in messages if m.startswith("Received request")]
+		self.assertEqual(sorted(received), sampled)
+		# logged once the origin has answered, with the other requests'
+		# tasks run in between
+		self.assertEqual(len([m for m in messages if m.startswith("Issuing response")]), len(sampled))
+
+if __name__ == "__main__":
+	unittest.main()
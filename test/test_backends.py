@@ -0,0 +1,178 @@
+import threading
+import unittest
+
+import backends
+
+class FakeClock(object):
+
+	def __init__(self):
+		self.now = 1000.0
+
+	def __call__(self):
+		return self.now
+
+class TestInMemoryBackend(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = FakeClock()
+		self.backend = backends.InMemoryBackend(clock=self.clock)
+
+	def test_get_set_add_delete(self):
+		'''tests the basic operations'''
+		self.assertIsNone(self.backend.get('a'))
+		self.assertTrue(self.backend.set('a', {'field': 1}))
+		self.assertEqual(self.backend.get('a'), {'field': 1})
+
+		self.assertFalse(self.backend.add('a', 2))
+		self.assertTrue(self.backend.add('b', 2))
+
+		self.assertEqual(self.backend.get_multi(['a', 'b', 'c']), {'a': {'field': 1}, 'b': 2})
+		self.assertEqual(self.backend.set_multi({'c': 3, 'd': 4}), [])
+		self.assertEqual(self.backend.get('d'), 4)
+
+		self.assertTrue(self.backend.delete('a'))
+		self.assertFalse(self.backend.delete('a'))
+		self.assertIsNone(self.backend.get('a'))
+
+	def test_values_copied(self):
+		'''tests that mutating a value read doesn't change the stored one'''
+		self.backend.set('a', {'field': 1})
+		self.backend.get('a')['field'] = 2
+		self.assertEqual(self.backend.get('a'), {'field': 1})
+
+	def test_cas(self):
+		'''tests that cas only succeeds with the current token'''
+		self.backend.set('a', 1)
+		value, token = self.backend.gets('a')
+		self.backend.set('a', 2)
+
+		self.assertFalse(self.backend.cas('a', 3, token))
+		value, token = self.backend.gets('a')
+		self.assertTrue(self.backend.cas('a', value + 1, token))
+		self.assertEqual(self.backend.get('a'), 3)
+
+		self.backend.delete('a')
+		self.assertRaises(backends.NotFound, self.backend.cas, 'a', 4, token)
+		self.assertEqual(self.backend.gets('a'), (None, None))
+
+	def test_expiry(self):
+		'''tests relative and absolute lifetimes'''
+		self.backend.set('relative', 1, time=10)
+		self.backend.set('absolute', 1, time=int(self.clock.now) + 40 * 24 * 3600)
+		self.backend.set('forever', 1)
+
+		self.clock.now += 11
+		self.assertIsNone(self.backend.get('relative'))
+		self.assertTrue(self.backend.add('relative', 2))
+		self.assertEqual(self.backend.get_multi(['absolute', 'forever']), {'absolute': 1, 'forever': 1})
+
+	def test_incr(self):
+		'''tests that incr counts up, and misses on missing keys'''
+		self.assertRaises(backends.NotFound, self.backend.incr, 'n')
+		self.backend.add('n', 5)
+		self.assertEqual(self.backend.incr('n'), 6)
+		self.assertEqual(self.backend.incr('n', 4), 10)
+
+	def test_lru_eviction(self):
+		'''tests that the least recently used entries are evicted'''
+		backend = backends.InMemoryBackend(max_items=2)
+		backend.set('a', 1)
+		backend.set('b', 2)
+		backend.get('a')
+		backend.set('c', 3)
+
+		self.assertEqual(backend.get_multi(['a', 'b', 'c']), {'a': 1, 'c': 3})
+		self.assertEqual(backend.evictions, 1)
+
+	def test_byte_eviction(self):
+		'''tests that the least recently used entries are evicted beyond
+		max_bytes, as counted by size_fn'''
+		backend = backends.InMemoryBackend(max_bytes=250, size_fn=lambda key, value, pickled: len(value))
+		backend.set('a', 'x' * 100)
+		backend.set('b', 'x' * 100)
+		backend.get('a')
+		backend.set('c', 'x' * 100)
+
+		self.assertEqual(sorted(backend.get_multi(['a', 'b', 'c'])), ['a', 'c'])
+		self.assertEqual(backend.stats(), {'items': 2, 'bytes': 200, 'evictions': 1})
+
+		backend.delete('a')
+		backend.set('d', 'x' * 150)
+		self.assertEqual(backend.stats()['bytes'], 250)
+
+	def test_stats(self):
+		'''tests that stats count the live entries and their sizes'''
+		self.backend.set('a', 'x' * 100)
+		self.backend.set('b', 'y' * 50, time=10)
+		stats = self.backend.stats()
+		self.assertEqual(stats['items'], 2)
+		self.assertTrue(152 < stats['bytes'] < 250)
+
+		self.clock.now += 11
+		self.assertEqual(self.backend.stats()['items'], 1)
+
+	def test_concurrent_cas(self):
+		'''tests that concurrent gets/cas loops lose no updates'''
+		self.backend.set('counter', 0)
+
+		def run():
+			for _ in range(500):
+				while True:
+					value, token = self.backend.gets('counter')
+					if self.backend.cas('counter', value + 1, token):
+						break
+
+		threads = [threading.Thread(target=run) for _ in range(8)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(self.backend.get('counter'), 4000)
+
+class FakeClient(object):
+
+	def __init__(self):
+		self.keys_read = []
+
+	def get(self, key):
+		self.keys_read.append(key)
+
+class FakeMemcachedBackend(backends.MemcachedBackend):
+	'''Hands out FakeClients rather than pylibmc clients'''
+
+	def __init__(self):
+		backends.MemcachedBackend.__init__(self, ['127.0.0.1'])
+		self.opened = []
+
+	def _new_client(self):
+		client = FakeClient()
+		self.opened.append(client)
+		return client
+
+class TestMemcachedBackend(unittest.TestCase):
+
+	def test_warm_clients_handed_out(self):
+		'''tests that clients opened ahead of time are connected, and handed
+		to the first threads needing one, before new ones are opened'''
+		backend = FakeMemcachedBackend()
+		self.assertEqual(backend.warm(2), 2)
+		self.assertTrue(all(client.keys_read for client in backend.opened))
+
+		clients = []
+		def run():
+			clients.append(backend.client)
+			clients.append(backend.client)
+
+		for _ in range(3):
+			thread = threading.Thread(target=run)
+			thread.start()
+			thread.join()
+
+		# each thread keeps its client; the third opens one
+		self.assertEqual([id(client) for client in clients[::2]], [id(client) for client in clients[1::2]])
+		self.assertEqual(len(backend.opened), 3)
+		self.assertEqual(set(map(id, clients)), set(map(id, backend.opened)))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+
+import changedetect
+
+class TestNormalizers(unittest.TestCase):
+
+	def test_regex_strip(self):
+		'''tests that matches are removed from text and byte strings'''
+		strip = changedetect.RegexStrip(r'<p>\d+\.\d+</p>')
+		self.assertEqual(strip('<p>1530000000.12</p><p>body</p>'), '<p>body</p>')
+		self.assertEqual(strip(b'<p>1530000000.12</p><p>body</p>'), b'<p>body</p>')
+
+	def test_byte_ranges(self):
+		'''tests removing overlapping and end-relative ranges'''
+		ranges = changedetect.ByteRanges([(0, 3), (2, 5), (-2, None)])
+		self.assertEqual(ranges(b'0123456789'), b'567')
+		self.assertEqual(changedetect.ByteRanges([(20, 30)])(b'short'), b'short')
+
+	def test_html_elements(self):
+		'''tests removing elements by tag and attribute'''
+		html = ('<div class="ad-slot">ad 1</div><div class="content">body</div>'
+			'<input type="hidden" name="csrf_token" value="abc123"><input name="q">')
+
+		self.assertEqual(changedetect.HtmlElements('div', 'class', 'ad-slot')(html),
+			'<div class="content">body</div><input type="hidden" name="csrf_token" value="abc123"><input name="q">')
+		self.assertEqual(changedetect.HtmlElements('input', 'name', 'csrf_token')(html),
+			'<div class="ad-slot">ad 1</div><div class="content">body</div><input name="q">')
+		self.assertEqual(changedetect.HtmlElements('div')(html),
+			'<input type="hidden" name="csrf_token" value="abc123"><input name="q">')
+
+class TestChangeDetector(unittest.TestCase):
+
+	def test_first_matching_rule(self):
+		'''tests that only the first matching rule applies'''
+		detector = changedetect.ChangeDetector([
+			(r'^/news/', [changedetect.RegexStrip(r'\d+')]),
+			(r'^/', [changedetect.RegexStrip(r'[a-z]+')]),
+			])
+
+		self.assertEqual(detector.normalize('/news/1', 'story 17'), 'story ')
+		self.assertEqual(detector.normalize('/other', 'story 17'), ' 17')
+		self.assertEqual(changedetect.ChangeDetector([]).normalize('/other', 'story 17'), 'story 17')
+
+if __name__ == "__main__":
+	unittest.main()
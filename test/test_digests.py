@@ -0,0 +1,25 @@
+import hashlib
+import unittest
+
+import digests
+
+class TestDigests(unittest.TestCase):
+
+	def test_incremental(self):
+		'''tests that hashing in pieces matches hashing at once, for every
+		available algorithm'''
+		content = b'0123456789' * 1000
+		for name in digests.available_algorithms():
+			hasher = digests.new(name)
+			for start in range(0, len(content), 333):
+				hasher.update(content[start:start + 333])
+			self.assertEqual(hasher.digest(), digests.digest(name, content), name)
+
+	def test_algorithms(self):
+		'''tests the standard algorithms, and unknown names'''
+		self.assertEqual(digests.digest('sha256', b'body'), hashlib.sha256(b'body').digest())
+		self.assertTrue(set(['sha256', 'sha1', 'md5']) <= set(digests.available_algorithms()))
+		self.assertRaises(ValueError, digests.new, 'rot13')
+
+if __name__ == "__main__":
+	unittest.main()
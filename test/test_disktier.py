@@ -0,0 +1,104 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import disktier
+
+class TestDiskTier(unittest.TestCase):
+
+	def setUp(self):
+		self.root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.root)
+
+	def make_tier(self, **options):
+		tier = disktier.DiskTier(self.root, min_body_bytes=0, **options)
+		self.addCleanup(tier._lock_file.close)
+		return tier
+
+	def test_put_get(self):
+		'''tests that a stored body reads back through its location'''
+		tier = self.make_tier()
+		location = tier.put('body_/a', b'x' * 1000)
+
+		body = tier.get(location)
+		self.assertEqual(len(body), 1000)
+		self.assertEqual(body.tobytes(), b'x' * 1000)
+		self.assertEqual(bytes(body.view()), b'x' * 1000)
+		self.assertEqual(b''.join(body.chunks(300)), b'x' * 1000)
+
+		body_file = body.open_file()
+		self.assertEqual(body_file.read(), b'x' * 1000)
+		self.assertEqual(body_file.read(), b'')
+		body_file.close()
+
+	def test_location_checked(self):
+		'''tests that locations from other hosts or for other keys miss'''
+		tier = self.make_tier()
+		location = tier.put('body_/a', b'content')
+
+		self.assertIsNone(tier.get(dict(location, host='elsewhere')))
+		self.assertIsNone(tier.get(dict(location, key='body_/b')))
+		self.assertIsNone(tier.get(dict(location, segment=location['segment'] + 5)))
+
+	def test_slots_shared(self):
+		'''tests that a second store on the host claims its own slot, and
+		reads bodies from the first'''
+		first = self.make_tier()
+		second = self.make_tier()
+		self.assertNotEqual(first.slot, second.slot)
+
+		location = first.put('body_/a', b'content')
+		self.assertEqual(second.get(location).tobytes(), b'content')
+
+	def test_oldest_segment_reclaimed(self):
+		'''tests that the oldest segment is deleted once the store is full'''
+		tier = self.make_tier(segment_bytes=100, max_segments=2)
+		first = tier.put('body_/1', b'a' * 80)
+		tier.put('body_/2', b'b' * 80)
+		third = tier.put('body_/3', b'c' * 80)
+
+		self.assertIsNone(tier.get(first))
+		self.assertEqual(tier.get(third).tobytes(), b'c' * 80)
+		self.assertEqual(tier.stats()['segments'], 2)
+		self.assertEqual(tier.stats()['reclaimed_segments'], 1)
+
+	def test_reclaimed_location_misses(self):
+		'''tests that a location read before its segment was reclaimed misses
+		afterwards, for the slot's owner and for other readers'''
+		tier = self.make_tier(segment_bytes=100, max_segments=2)
+		reader = self.make_tier()
+		first = tier.put('body_/1', b'a' * 80)
+		self.assertEqual(tier.get(first).tobytes(), b'a' * 80)
+		self.assertEqual(reader.get(first).tobytes(), b'a' * 80)
+
+		tier.put('body_/2', b'b' * 80)
+		tier.put('body_/3', b'c' * 80)
+		self.assertIsNone(tier.get(first))
+		self.assertIsNone(reader.get(first))
+
+	def test_recovery(self):
+		'''tests that a restarted store rebuilds its index, ignores a damaged
+		tail, and appends to a new segment'''
+		tier = self.make_tier()
+		location = tier.put('body_/a', b'content')
+		tier.put('body_/b', b'more content')
+		tier._lock_file.close()
+
+		# a write cut short by a crash
+		path = tier._segment_path(location['segment'])
+		with open(path, 'r+b') as segment:
+			segment.truncate(os.path.getsize(path) - 3)
+
+		restarted = self.make_tier()
+		self.assertEqual(restarted.slot, tier.slot)
+		self.assertEqual(restarted.recovered_records, 1)
+		self.assertEqual(restarted.stats()['entries'], 1)
+		self.assertEqual(restarted.get(location).tobytes(), b'content')
+
+		new_location = restarted.put('body_/b', b'more content')
+		self.assertNotEqual(new_location['segment'], location['segment'])
+		self.assertEqual(restarted.get(new_location).tobytes(), b'more content')
+
+if __name__ == "__main__":
+	unittest.main()
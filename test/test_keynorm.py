@@ -0,0 +1,81 @@
+import unittest
+import keynorm
+
+class TestKeyNormalizer(unittest.TestCase):
+
+	def setUp(self):
+		self.normalizer = keynorm.KeyNormalizer()
+
+	def test_plain_path_unchanged(self):
+		'''tests that a url without a query or escapes is left alone'''
+		self.assertEqual(self.normalizer.normalize('/url1'), '/url1')
+
+	def test_query_sorted(self):
+		'''tests that reordered parameters map onto the same url, and that
+		repeated parameters keep their order'''
+		self.assertEqual(
+			self.normalizer.normalize('/page?b=2&a=1&b=1'),
+			'/page?a=1&b=2&b=1'
+			)
+		self.assertEqual(
+			self.normalizer.normalize('/page?a=1&b=2'),
+			self.normalizer.normalize('/page?b=2&a=1')
+			)
+
+	def test_tracking_params_dropped(self):
+		'''tests that tracking parameters are removed, along with an empty query'''
+		self.assertEqual(
+			self.normalizer.normalize('/page?utm_source=x&UTM_medium=y&fbclid=z'),
+			'/page'
+			)
+		self.assertEqual(
+			self.normalizer.normalize('/page?id=3&utm_campaign=spring'),
+			'/page?id=3'
+			)
+
+	def test_keep_params(self):
+		'''tests that only allowed parameters are retained when an allowlist is given'''
+		normalizer = keynorm.KeyNormalizer(keep_params=['id', 'page*'])
+		self.assertEqual(
+			normalizer.normalize('/list?session=abc&page_size=10&id=4'),
+			'/list?id=4&page_size=10'
+			)
+
+	def test_encoding_canonicalized(self):
+		'''tests that equivalent percent-encodings map onto the same url'''
+		self.assertEqual(
+			self.normalizer.normalize('/%7euser/a%2fb?q=%7e%2f'),
+			'/~user/a%2Fb?q=~%2F'
+			)
+		self.assertEqual(
+			self.normalizer.normalize('/a b?q=1 2'),
+			'/a%20b?q=1%202'
+			)
+		self.assertEqual(
+			self.normalizer.normalize('/100%'),
+			'/100%25'
+			)
+
+	def test_host_lowercased(self):
+		'''tests that the host and scheme of absolute urls are lowercased,
+		and default ports removed'''
+		self.assertEqual(
+			self.normalizer.normalize('HTTP://Example.COM:80/Path'),
+			'http://example.com/Path'
+			)
+		normalizer = keynorm.KeyNormalizer(lowercase_path=True)
+		self.assertEqual(normalizer.normalize('/Path/To'), '/path/to')
+
+	def test_long_key_hashed(self):
+		'''tests that keys memcached would reject are hashed, keeping their namespace'''
+		self.assertEqual(keynorm.hash_long_key('metadata_/url1'), 'metadata_/url1')
+
+		long_key = keynorm.hash_long_key('metadata_/' + 'a' * 300)
+		self.assertTrue(long_key.startswith('metadata_~'))
+		self.assertTrue(len(long_key) <= keynorm.MAX_KEY_LENGTH)
+		self.assertNotEqual(long_key, keynorm.hash_long_key('metadata_/' + 'a' * 301))
+
+		self.assertTrue(keynorm.hash_long_key('body_/a b_1.0-1').startswith('body_~'))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+import threading
+
+import metrics
+
+class TestMetrics(unittest.TestCase):
+
+	def setUp(self):
+		self.registry = metrics.Metrics(top_urls=2, top_capacity=8)
+		self.registry.counter('requests_total', 'Requests')
+		self.registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1))
+
+	def test_threads_aggregated(self):
+		'''tests that counts recorded on several threads are summed'''
+		def record():
+			for _ in range(1000):
+				self.registry.inc('requests_total', labels=(('source', 'hit'),))
+				self.registry.observe('latency_seconds', 0.05)
+
+		threads = [threading.Thread(target=record) for _ in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(self.registry.value('requests_total', (('source', 'hit'),)), 4000)
+		self.assertEqual(self.registry.value('latency_seconds'), 4000)
+		self.assertEqual(self.registry.value('requests_total'), 0)
+
+	def test_render(self):
+		'''tests the Prometheus text format of counters and histograms'''
+		self.registry.inc('requests_total', 2, (('source', 'miss'),))
+		for value in (0.05, 0.1, 0.5, 3):
+			self.registry.observe('latency_seconds', value, (('phase', 'origin'),))
+
+		lines = self.registry.render().splitlines()
+		self.assertEqual(lines[:11], [
+			'# HELP requests_total Requests',
+			'# TYPE requests_total counter',
+			'requests_total{source="miss"} 2',
+			'# HELP latency_seconds Latency',
+			'# TYPE latency_seconds histogram',
+			'latency_seconds_bucket{phase="origin",le="0.1"} 2',
+			'latency_seconds_bucket{phase="origin",le="1"} 3',
+			'latency_seconds_bucket{phase="origin",le="+Inf"} 4',
+			'latency_seconds_sum{phase="origin"} 3.65',
+			'latency_seconds_count{phase="origin"} 4',
+			'# HELP webcache_hot_url_requests Estimated requests for the most requested urls',
+			])
+
+	def test_hot_urls(self):
+		'''tests that the most requested urls are merged across threads and
+		ranked, with label values escaped'''
+		for _ in range(3):
+			self.registry.note_url('/a"b')
+		thread = threading.Thread(target=lambda: [self.registry.note_url(url) for url in ('/c', '/c', '/a"b', '/d')])
+		thread.start()
+		thread.join()
+
+		self.assertEqual(self.registry.hot_urls(), [('/a"b', 4), ('/c', 2)])
+		self.assertTrue('webcache_hot_url_requests{url="/a\\"b"} 4' in self.registry.render())
+
+if __name__ == "__main__":
+	unittest.main()
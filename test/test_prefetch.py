@@ -0,0 +1,57 @@
+import unittest
+
+import prefetch
+
+class FakeRequest(object):
+
+	def __init__(self, url, headers=None):
+		self.url = url
+		self.headers = headers or {}
+
+class TestFindReferences(unittest.TestCase):
+
+	def test_attribute_forms(self):
+		'''tests quoted, unquoted and relative references'''
+		html = '''<img src="/a.png"><script SRC='/b.js'></script><embed src=/cacheme/c>
+			<link href = "style.css"><a href="/a.png">again</a>'''
+		self.assertEqual(prefetch.find_references(html, '/pages/index.html'),
+			['/a.png', '/b.js', '/cacheme/c', '/pages/style.css'])
+
+	def test_same_origin_only(self):
+		'''tests that references to other hosts and schemes are skipped'''
+		html = '''<img src="http://other.example/x.png"><img src="//other.example/y.png">
+			<img src="http://myhost/z.png?v=2"><a href="mailto:a@b"><a href="#top">
+			<img src="data:image/png;base64,AAAA">'''
+		self.assertEqual(prefetch.find_references(html, '/', host='myhost'), ['/z.png?v=2'])
+
+class TestPrefetcher(unittest.TestCase):
+
+	def test_warms_missing(self):
+		'''tests that only the missing, matching references of a page are
+		warmed, each once'''
+		checked = []
+		warmed = []
+		prefetcher = prefetch.Prefetcher(
+			lambda request, urls: checked.append(urls) or [u for u in urls if u != '/cacheme/hot'],
+			lambda request, url: warmed.append(url),
+			patterns=[r'^/cacheme/'],
+			)
+
+		html = '<a href="/b"><embed src=/cacheme/c><img src=/cacheme/hot><img src=/cacheme/d>'
+		prefetcher.page_fetched(FakeRequest('/a'), html)
+		prefetcher.page_fetched(FakeRequest('/a'), html)
+		prefetcher.run_pending()
+
+		self.assertEqual(checked, [['/cacheme/c', '/cacheme/hot', '/cacheme/d']] * 2)
+		self.assertEqual(sorted(warmed), ['/cacheme/c', '/cacheme/d'])
+		self.assertEqual(prefetcher.pages, 2)
+
+	def test_bounded_queue(self):
+		'''tests that pages beyond max_pending are dropped'''
+		prefetcher = prefetch.Prefetcher(lambda r, u: u, lambda r, u: None, patterns=['.'], max_pending=1)
+		prefetcher.page_fetched(FakeRequest('/a'), '')
+		prefetcher.page_fetched(FakeRequest('/b'), '')
+		self.assertEqual(prefetcher.dropped, 1)
+
+if __name__ == "__main__":
+	unittest.main()
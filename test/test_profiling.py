@@ -0,0 +1,137 @@
+import os
+import pstats
+import random
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import unittest
+
+import profiling
+
+def busy_loop(stop):
+	while not stop.is_set():
+		sum(range(100))
+
+def work():
+	return sum(range(1000))
+
+class TestProfiling(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.dir)
+
+	def start_busy_thread(self):
+		stop = threading.Event()
+		thread = threading.Thread(target=busy_loop, args=(stop,))
+		thread.start()
+		self.addCleanup(thread.join)
+		self.addCleanup(stop.set)
+
+	def test_sampled_stacks(self):
+		'''tests that the sampler counts the stacks of other threads, and
+		writes them as collapsed stacks, root first'''
+		self.start_busy_thread()
+		profiler = profiling.Profiler(self.dir, mode='sample', interval=0.001)
+		self.assertTrue(profiler.start(seconds=0))
+		self.assertFalse(profiler.start())
+		time.sleep(0.2)
+		self.assertTrue(profiler.status()['samples'] > 0)
+		path = profiler.stop()
+
+		self.assertTrue(path.endswith('.collapsed'))
+		with open(path) as collapsed:
+			lines = [line.rsplit(' ', 1) for line in collapsed]
+		busy = [(stack.split(';'), int(count)) for stack, count in lines if 'busy_loop' in stack]
+		self.assertTrue(busy)
+		for frames, count in busy:
+			# root first: the thread's run() calls busy_loop
+			labels = [frame.split(' ')[0] for frame in frames]
+			self.assertEqual(labels[labels.index('busy_loop') - 1], 'run')
+			self.assertTrue(count > 0)
+		self.assertFalse([stack for stack, _ in lines if 'stack-sampler' in stack or '_run (profiling.py' in stack])
+		self.assertFalse(profiler.status()['running'])
+
+	def test_sampler_overhead_bounded(self):
+		'''tests that the sampler spaces out its samples to keep the time
+		spent sampling under max_overhead'''
+		self.start_busy_thread()
+		sampler = profiling.StackSampler(interval=0, max_overhead=0.05)
+		sampler.start()
+		time.sleep(0.5)
+		sampler.stop()
+
+		self.assertTrue(sampler.samples > 0)
+		self.assertTrue(sampler.overhead < 0.1, sampler.overhead)
+
+	def test_sampled_calls_profiled(self):
+		'''tests that a fraction of calls are run under cProfile, and their
+		profiles, from any thread, are written as one pstats file'''
+		profiler = profiling.Profiler(self.dir, mode='cprofile', sample_rate=0.5, rng=random.Random(3))
+		self.assertIsNone(profiler.begin())
+		profiler.start(seconds=0)
+
+		def calls():
+			for _ in range(50):
+				profiled = profiler.begin()
+				work()
+				profiler.finish(profiled, 0.001)
+
+		threads = [threading.Thread(target=calls) for _ in range(2)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		status = profiler.status()
+		self.assertEqual(status['calls'], 100)
+		self.assertTrue(20 < status['profiled_calls'] < 80, status)
+		path = profiler.stop()
+
+		self.assertTrue(path.endswith('.pstats'))
+		stats = pstats.Stats(path)
+		work_calls = [stats.stats[f][1] for f in stats.stats if f[2] == 'work']
+		self.assertEqual(work_calls, [status['profiled_calls']])
+
+	def test_call_overhead_bounded(self):
+		'''tests that the rate of profiled calls is lowered when they add more
+		than max_overhead to the time of all calls'''
+		calls = profiling.CallProfiler(sample_rate=0.5, max_overhead=0.05, rng=random.Random(3))
+		for _ in range(200):
+			profiled = calls.begin()
+			# profiled calls take three times as long
+			calls.finish(profiled, 0.003 if profiled is not None else 0.001)
+
+		# each profiled call adds twice a call's time
+		self.assertAlmostEqual(calls.slowdown, 2)
+		self.assertAlmostEqual(calls.sample_rate, 0.025)
+		self.assertTrue(calls.overhead < 0.2, calls.overhead)
+
+	def test_signal_toggles_without_lock(self):
+		'''tests that the signal handler returns even with the profiler's
+		lock held, and leaves the toggling to a thread of its own'''
+		profiler = profiling.Profiler(self.dir, mode='cprofile', seconds=0)
+		self.addCleanup(signal.signal, signal.SIGUSR2, signal.getsignal(signal.SIGUSR2))
+		profiler.toggle_on(signal.SIGUSR2)
+
+		with profiler._lock:
+			os.kill(os.getpid(), signal.SIGUSR2)
+			# the handler has run by now, in this thread
+			time.sleep(0.1)
+			self.assertFalse(profiler.running)
+		for _ in range(100):
+			if profiler.running:
+				break
+			time.sleep(0.01)
+		self.assertTrue(profiler.running)
+
+		os.kill(os.getpid(), signal.SIGUSR2)
+		for _ in range(100):
+			if not profiler.running:
+				break
+			time.sleep(0.01)
+		self.assertFalse(profiler.running)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,129 @@
+import unittest
+import refresh
+
+class FakeClock(object):
+	def __init__(self):
+		self.now = 1000.0
+
+	def __call__(self):
+		return self.now
+
+class FakeRequest(object):
+	def __init__(self, url):
+		self.url = url
+
+class TestRefreshAhead(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = FakeClock()
+		self.refreshed = []
+		self.refresher = refresh.RefreshAhead(
+			self.record_refresh,
+			clock=self.clock,
+			lead_secs=5,
+			min_hits=3,
+			rate=100,
+			concurrency=2,
+			)
+
+	def record_refresh(self, request, expires):
+		self.refreshed.append((request.url, expires))
+		return True
+
+	def hit(self, url, expires, times=1):
+		for _ in range(times):
+			self.refresher.note_access(url, FakeRequest(url), expires)
+
+	def test_only_hot_urls_refreshed(self):
+		'''tests that urls below min_hits are never scheduled'''
+		self.hit('/hot', 1030, times=3)
+		self.hit('/cold', 1030, times=2)
+
+		self.clock.now = 1026
+		self.assertEqual(self.refresher.run_pending(), 1)
+		self.assertEqual(self.refreshed, [('/hot', 1030)])
+
+	def test_refresh_waits_for_lead_time(self):
+		'''tests that a refresh runs lead_secs before expiry, and not after expiry'''
+		self.hit('/hot', 1030, times=3)
+
+		self.clock.now = 1024
+		self.assertEqual(self.refresher.run_pending(), 0)
+		self.clock.now = 1025
+		self.assertEqual(self.refresher.run_pending(), 1)
+
+		self.hit('/hot', 1060)
+		self.clock.now = 1061
+		self.assertEqual(self.refresher.run_pending(), 0)
+		self.assertEqual(self.refresher.skipped, 1)
+
+	def test_budget(self):
+		'''tests that due refreshes are limited by the rate and concurrency budget'''
+		self.refresher = refresh.RefreshAhead(
+			self.record_refresh,
+			clock=self.clock,
+			lead_secs=5,
+			min_hits=1,
+			rate=2,
+			concurrency=10,
+			)
+		for i in range(5):
+			self.hit('/page%d' % (i,), 1030)
+
+		self.clock.now = 1026
+		self.assertEqual(self.refresher.run_pending(), 2)
+		self.assertEqual(self.refresher.run_pending(), 0)
+		self.clock.now = 1027
+		self.assertEqual(self.refresher.run_pending(), 2)
+
+		# concurrency: refreshes handed out but not finished hold their slots
+		self.refresher.concurrency = 1
+		self.refresher._slots = refresh.threading.Semaphore(1)
+		self.clock.now = 1029
+		due = self.refresher.due_requests()
+		self.assertEqual(len(due), 1)
+		self.clock.now = 1029.9
+		self.assertEqual(self.refresher.due_requests(), [])
+
+	def test_top_urls(self):
+		'''tests that the most requested urls are reported in order'''
+		self.hit('/a', 1030, times=2)
+		self.hit('/b', 1030, times=5)
+		self.hit('/c', 1030, times=1)
+
+		self.assertEqual(
+			[url for url, _, _ in self.refresher.top_urls(2)],
+			['/b', '/a']
+			)
+
+	def test_outcomes_counted(self):
+		'''tests that refreshes run by several workers at once are each counted
+		as refreshed, skipped or failed'''
+		import logging
+		import threading
+
+		def refresh_fn(request, expires):
+			if request.url.startswith('/failed'):
+				raise RuntimeError("origin down")
+			return request.url.startswith('/refreshed')
+
+		urls = ['/%s-%d' % (outcome, i) for outcome in ('refreshed', 'skipped', 'failed') for i in range(10)]
+		refresher = refresh.RefreshAhead(refresh_fn, clock=self.clock, lead_secs=5, min_hits=1,
+			rate=1000, concurrency=len(urls))
+		for url in urls:
+			refresher.note_access(url, FakeRequest(url), 1030)
+		self.clock.now = 1026
+		due = refresher.due_requests()
+		self.assertEqual(len(due), len(urls))
+
+		logging.disable(logging.ERROR)
+		self.addCleanup(logging.disable, logging.NOTSET)
+		threads = [threading.Thread(target=refresher.run_request, args=d) for d in due]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual((refresher.refreshed, refresher.skipped, refresher.failed), (10, 10, 10))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,100 @@
+import logging
+import threading
+import unittest
+
+import requestlog
+
+class CapturingHandler(logging.Handler):
+	'''Records the messages it's passed, and the threads passing them;
+	waits for gate to be set before each'''
+
+	def __init__(self):
+		logging.Handler.__init__(self)
+		self.messages = []
+		self.threads = set()
+		self.gate = threading.Event()
+		self.gate.set()
+
+	def emit(self, record):
+		self.gate.wait()
+		self.messages.append(self.format(record))
+		self.threads.add(threading.current_thread().name)
+
+class TestQueueHandler(unittest.TestCase):
+
+	def setUp(self):
+		self.target = CapturingHandler()
+		self.handler = requestlog.QueueHandler(self.target, capacity=2)
+		self.logger = logging.getLogger('test_requestlog')
+		self.logger.propagate = False
+		self.logger.setLevel(logging.DEBUG)
+		self.logger.addHandler(self.handler)
+		self.addCleanup(self.logger.removeHandler, self.handler)
+
+	def test_written_in_background(self):
+		'''tests that records are written in order, by the writer thread'''
+		self.logger.info("first %s", 1)
+		self.logger.debug("second %s", 'two')
+		self.handler.flush()
+
+		self.assertEqual(self.target.messages, ['first 1', 'second two'])
+		self.assertEqual(self.target.threads, set(['log-writer']))
+
+	def test_mutable_args_formatted_when_queued(self):
+		'''tests that arguments that could change are formatted before the
+		record is queued'''
+		data = {'reservation': 1}
+		self.logger.debug("data: %s", data)
+		data['reservation'] = 2
+		self.handler.flush()
+
+		self.assertEqual(self.target.messages, ["data: {'reservation': 1}"])
+
+	def test_full_queue_drops(self):
+		'''tests that records are dropped rather than waited on when the
+		queue is full'''
+		self.target.gate.clear()
+		self.logger.info("taken by the writer")
+		while self.handler._queue.qsize():
+			pass
+		for i in range(4):
+			self.logger.info("queued %d", i)
+		self.target.gate.set()
+		self.handler.flush()
+
+		self.assertEqual(self.handler.dropped, 2)
+		self.assertEqual(self.target.messages, ['taken by the writer', 'queued 0', 'queued 1'])
+
+	def test_close_stops_writer(self):
+		'''tests that closing writes the queued records, and stops the writer
+		thread'''
+		self.logger.info("before close")
+		thread = self.handler._thread
+		self.handler.close()
+
+		self.assertEqual(self.target.messages, ['before close'])
+		self.assertFalse(thread.is_alive())
+
+class TestUrlSampler(unittest.TestCase):
+
+	def test_sampled_by_url(self):
+		'''tests that a url's debug records are all passed or all dropped,
+		for about the sampled fraction of urls'''
+		sampler = requestlog.UrlSampler(0.1)
+		debug = logging.makeLogRecord({'levelno': logging.DEBUG})
+		info = logging.makeLogRecord({'levelno': logging.INFO})
+
+		passed = 0
+		for i in range(1000):
+			requestlog.begin('/page/%d' % (i,))
+			self.assertEqual(sampler.filter(debug), sampler.filter(debug))
+			self.assertTrue(sampler.filter(info))
+			passed += sampler.filter(debug)
+		requestlog.end()
+		self.assertTrue(60 < passed < 140, passed)
+
+		# outside of a request, everything is passed
+		self.assertTrue(sampler.filter(debug))
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,131 @@
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import shmcache
+
+class FakeClock(object):
+
+	def __init__(self):
+		self.now = 1000.0
+
+	def __call__(self):
+		return self.now
+
+def _stress_worker(path, seconds, errors):
+	'''reads and writes random keys from several threads, counting values
+	that don't belong to the key they were read under'''
+	cache = shmcache.SharedCache(path, sets=16, ways=4, slot_bytes=512)
+	failures = []
+	completed = []
+
+	def run(seed):
+		rand = random.Random(seed)
+		deadline = time.time() + seconds
+		while time.time() < deadline:
+			key = 'key-%d' % (rand.randint(0, 200),)
+			if rand.random() < 0.3:
+				cache.set(key, {'key': key, 'pad': key[-1] * rand.randint(0, 400)}, 60)
+			else:
+				value = cache.get(key)
+				if value is not None and (value['key'] != key or value['pad'].strip(key[-1])):
+					failures.append((key, value))
+		completed.append(True)
+
+	threads = [threading.Thread(target=run, args=(os.getpid() * 10 + i,)) for i in range(4)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+
+	# threads that died with an exception count as failures
+	errors.put(len(failures) + len(threads) - len(completed))
+
+class TestSharedCache(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.dir)
+		self.path = os.path.join(self.dir, 'table')
+		self.clock = FakeClock()
+
+	def make_cache(self, **options):
+		options.setdefault('clock', self.clock)
+		cache = shmcache.SharedCache(self.path, **options)
+		self.addCleanup(cache.close)
+		return cache
+
+	def test_set_get_delete(self):
+		'''tests storing, overwriting and deleting values'''
+		cache = self.make_cache()
+		self.assertIsNone(cache.get('/a'))
+
+		self.assertTrue(cache.set('/a', {'content': 'first'}, 10))
+		self.assertEqual(cache.get('/a'), {'content': 'first'})
+		self.assertTrue(cache.set('/a', {'content': 'second'}, 10))
+		self.assertEqual(cache.get('/a'), {'content': 'second'})
+
+		self.assertTrue(cache.delete('/a'))
+		self.assertIsNone(cache.get('/a'))
+		self.assertFalse(cache.delete('/a'))
+
+	def test_expiry(self):
+		'''tests that values expire after their ttl'''
+		cache = self.make_cache()
+		cache.set('/a', 'value', 10)
+		self.clock.now += 9
+		self.assertEqual(cache.get('/a'), 'value')
+		self.clock.now += 2
+		self.assertIsNone(cache.get('/a'))
+
+	def test_too_large(self):
+		'''tests that values larger than a slot aren't stored'''
+		cache = self.make_cache(slot_bytes=256)
+		self.assertFalse(cache.set('/a', 'x' * 300, 10))
+		self.assertIsNone(cache.get('/a'))
+
+	def test_shared_between_mappings(self):
+		'''tests that a second mapping of the table sees the first one's
+		values, and must match its layout'''
+		first = self.make_cache()
+		second = self.make_cache()
+		first.set('/a', 'value', 10)
+		self.assertEqual(second.get('/a'), 'value')
+
+		self.assertRaises(ValueError, shmcache.SharedCache, self.path, ways=4)
+
+	def test_clock_eviction(self):
+		'''tests that a full set evicts an unreferenced value before the
+		recently read ones'''
+		cache = self.make_cache(sets=1, ways=4)
+		for i in range(4):
+			cache.set('/%d' % (i,), i, 60)
+		cache.get('/0')
+		cache.get('/2')
+
+		cache.set('/4', 4, 60)
+		self.assertEqual([cache.get('/%d' % (i,)) for i in range(5)], [0, None, 2, 3, 4])
+		self.assertEqual(cache.stats()['evictions'], 1)
+
+	def test_stress(self):
+		'''tests that processes and threads reading and writing at once
+		never see torn or misplaced values'''
+		shmcache.SharedCache(self.path, sets=16, ways=4, slot_bytes=512).close()
+
+		errors = multiprocessing.Queue()
+		processes = [multiprocessing.Process(target=_stress_worker, args=(self.path, 1.0, errors)) for _ in range(4)]
+		for process in processes:
+			process.start()
+		for process in processes:
+			process.join()
+
+		self.assertEqual([process.exitcode for process in processes], [0] * 4)
+		self.assertEqual([errors.get(timeout=5) for _ in processes], [0] * 4)
+
+if __name__ == "__main__":
+	unittest.main()
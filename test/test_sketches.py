@@ -0,0 +1,71 @@
+import unittest
+import sketches
+
+class TestCountMinSketch(unittest.TestCase):
+
+	def test_estimates_never_undercount(self):
+		'''tests that estimates are at least the true counts, and exact
+		without collisions'''
+		sketch = sketches.CountMinSketch(width=1024)
+		for count, key in enumerate(['/a', '/b', '/c'], 1):
+			for _ in range(count):
+				sketch.increment(key)
+
+		self.assertEqual(sketch.estimate('/a'), 1)
+		self.assertEqual(sketch.estimate('/b'), 2)
+		self.assertEqual(sketch.estimate('/c'), 3)
+		self.assertEqual(sketch.estimate('/unseen'), 0)
+
+	def test_aging(self):
+		'''tests that counts are halved once the sample size is reached'''
+		sketch = sketches.CountMinSketch(width=1024, sample_size=10)
+		for _ in range(8):
+			sketch.increment('/hot')
+		self.assertEqual(sketch.estimate('/hot'), 8)
+
+		sketch.increment('/other')
+		sketch.increment('/other')
+		self.assertEqual(sketch.resets, 1)
+		self.assertEqual(sketch.estimate('/hot'), 4)
+		self.assertEqual(sketch.estimate('/other'), 1)
+
+class TestSpaceSaving(unittest.TestCase):
+
+	def test_exact_below_capacity(self):
+		'''tests that counts are exact while the table has room'''
+		tracker = sketches.SpaceSaving(capacity=4)
+		for key in ['/a', '/b', '/a', '/c', '/a', '/b']:
+			tracker.increment(key)
+
+		self.assertEqual(tracker.top(), [('/a', 3, 0), ('/b', 2, 0), ('/c', 1, 0)])
+
+	def test_heavy_hitters_retained(self):
+		'''tests that frequent keys survive a stream of one-off keys, and
+		that replacements inherit the smallest count as their error'''
+		tracker = sketches.SpaceSaving(capacity=3)
+		for i in range(100):
+			tracker.increment('/hot')
+			tracker.increment('/one-off-%d' % (i,))
+
+		self.assertEqual(len(tracker), 3)
+		self.assertEqual(tracker.top(1), [('/hot', 100, 0)])
+
+		key, count, error = tracker.top()[1]
+		self.assertTrue(key.startswith('/one-off'))
+		self.assertEqual(count - error, 1)
+
+	def test_decay(self):
+		'''tests that decay halves counts and drops keys reaching zero'''
+		tracker = sketches.SpaceSaving(capacity=4)
+		for key in ['/a', '/a', '/a', '/a', '/b']:
+			tracker.increment(key)
+
+		tracker.decay()
+		self.assertEqual(tracker.count('/a'), 2)
+		self.assertFalse('/b' in tracker)
+
+		tracker.increment('/a')
+		self.assertEqual(tracker.count('/a'), 3)
+
+if __name__ == "__main__":
+	unittest.main()
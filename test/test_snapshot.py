@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import snapshot
+
+class TestSnapshotFormat(unittest.TestCase):
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.dir)
+		self.path = os.path.join(self.dir, 'snapshot')
+
+	def write_records(self, records):
+		writer = snapshot.SnapshotWriter(self.path)
+		for record in records:
+			writer.write(*record)
+		writer.close()
+
+	def test_round_trip(self):
+		'''tests that records read back in order, across read chunks'''
+		records = [('key%d' % (i,), {'content': 'x' * i}, 1000 + i) for i in range(200)]
+		self.write_records(records)
+
+		self.assertEqual(list(snapshot.read_snapshot(self.path, chunk_size=97)), records)
+		self.assertEqual(os.listdir(self.dir), ['snapshot'])
+
+	def test_truncated(self):
+		'''tests that a snapshot missing its end is reported'''
+		self.write_records([('key%d' % (i,), 'value' * 100, 0) for i in range(20)])
+		with open(self.path, 'r+b') as snapshot_file:
+			snapshot_file.truncate(os.path.getsize(self.path) // 2)
+
+		self.assertRaises(snapshot.SnapshotError, list, snapshot.read_snapshot(self.path))
+
+	def test_damaged(self):
+		'''tests that a damaged record is reported'''
+		self.write_records([('key', 'value', 0)])
+		with open(self.path, 'r+b') as snapshot_file:
+			snapshot_file.seek(12)
+			snapshot_file.write(b'\0\0\0\0')
+
+		self.assertRaises(snapshot.SnapshotError, list, snapshot.read_snapshot(self.path))
+
+	def test_snapshotter_hot_urls(self):
+		'''tests that the snapshotter saves the most requested urls, hottest
+		first'''
+		saved = []
+		snapshotter = snapshot.Snapshotter(lambda urls, path: saved.append(urls) or len(urls), self.path, limit=2)
+		for url, hits in [('/a', 1), ('/b', 5), ('/c', 3)]:
+			for _ in range(hits):
+				snapshotter.note_access(url)
+
+		self.assertEqual(snapshotter.snapshot(), 2)
+		self.assertEqual(saved, [['/b', '/c']])
+
+	def test_snapshotter_checks_restore(self):
+		'''tests that the snapshotter's thread checks for restores every
+		check_secs, between snapshots'''
+		checked = threading.Event()
+		calls = []
+		def restore(path):
+			calls.append(path)
+			if len(calls) >= 3:
+				checked.set()
+			return 5 if len(calls) == 1 else None
+
+		snapshotter = snapshot.Snapshotter(lambda urls, path: 0, self.path, interval_secs=60,
+			restore_fn=restore, check_secs=0.01)
+		snapshotter.start()
+		self.assertTrue(checked.wait(5))
+		snapshotter.stop()
+
+		self.assertEqual(calls[0], self.path)
+		self.assertEqual(snapshotter.restores, 1)
+		self.assertEqual(snapshotter.snapshots, 0)
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,111 @@
+import unittest
+import json
+import os
+import random
+import shutil
+import tempfile
+
+import tracing
+
+class FakeClock(object):
+
+	def __init__(self):
+		self.now = 100.0
+
+	def __call__(self):
+		return self.now
+
+class TestTracing(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = FakeClock()
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, 'traces.jsonl')
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def make_tracer(self, **options):
+		return tracing.Tracer(self.path, clock=self.clock, rng=random.Random(3), **options)
+
+	def read_traces(self):
+		if not os.path.exists(self.path):
+			return []
+		with open(self.path) as traces:
+			return [json.loads(line) for line in traces]
+
+	def test_spans(self):
+		'''tests that spans record their start, duration and nesting, and
+		errors raised through them'''
+		@tracing.traced('outer')
+		def outer():
+			self.clock.now += 0.001
+			with tracing.span('inner'):
+				self.clock.now += 0.002
+			tracing.add('measured', 0.0005)
+
+		@tracing.traced('failing')
+		def failing():
+			raise KeyError()
+
+		tracer = self.make_tracer()
+		trace = tracer.begin('/url1')
+		outer()
+		self.assertRaises(KeyError, failing)
+		tracer.finish(trace, '200 OK')
+
+		self.assertEqual([(name, round(start, 6), round(duration, 6), depth, error) for name, start, duration, depth, error in trace.spans], [
+			('outer', 0, 0.003, 0, None),
+			('inner', 0.001, 0.002, 1, None),
+			('measured', 0.0025, 0.0005, 1, None),
+			('failing', 0.003, 0, 0, 'KeyError'),
+			])
+		self.assertEqual(tracing.current(), None)
+
+	def test_not_tracing(self):
+		'''tests that spans are no-ops on threads not tracing a request'''
+		@tracing.traced('outer')
+		def outer():
+			with tracing.span('inner'):
+				tracing.add('measured', 1)
+			return 'result'
+
+		self.assertEqual(outer(), 'result')
+		self.assertEqual(tracing.current(), None)
+
+	def test_slow_written(self):
+		'''tests that only traces of slow requests are written, unsampled'''
+		tracer = self.make_tracer(slow_secs=0.5)
+		for url, duration in (('/fast', 0.1), ('/slow', 0.6)):
+			trace = tracer.begin(url)
+			with tracing.span('origin'):
+				self.clock.now += duration
+			tracer.finish(trace, '200 OK')
+
+		traces = self.read_traces()
+		self.assertEqual([t['url'] for t in traces], ['/slow'])
+		self.assertEqual(traces[0]['status'], '200 OK')
+		self.assertEqual(traces[0]['duration_ms'], 600.0)
+		self.assertEqual(traces[0]['spans'], [dict(name='origin', start_ms=0.0, duration_ms=600.0, depth=0, error=None)])
+
+	def test_sampled(self):
+		'''tests that a fraction of the fast requests are written'''
+		tracer = self.make_tracer(slow_secs=10, sample_rate=0.25)
+		for _ in range(400):
+			tracer.finish(tracer.begin('/fast'))
+		self.assertTrue(50 < len(self.read_traces()) < 150)
+
+	def test_server_timing(self):
+		'''tests that the Server-Timing header sums spans by name'''
+		tracer = self.make_tracer()
+		trace = tracer.begin('/url1')
+		for duration in (0.001, 0.0025):
+			with tracing.span('metadata_get'):
+				self.clock.now += duration
+		tracing.add('hash', 0.0004)
+		tracer.finish(trace)
+
+		self.assertEqual(tracer.server_timing_header(trace), 'metadata_get;dur=3.500, hash;dur=0.400, total;dur=3.500')
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,178 @@
+import unittest
+import random
+
+import requests
+
+import upstream
+import webcache
+
+import fixtures.origin_mockout
+
+class FakeClock(object):
+
+	def __init__(self):
+		self.now = 1000.0
+
+	def __call__(self):
+		return self.now
+
+class FakeRequest(object):
+
+	def __init__(self, url, headers=None):
+		self.url = url
+		self.headers = headers or {}
+
+class TestUpstreamPool(unittest.TestCase):
+
+	def setUp(self):
+		self.clock = FakeClock()
+
+	def make_pool(self, upstreams, **options):
+		return upstream.UpstreamPool(upstreams, clock=self.clock, rng=random.Random(7), **options)
+
+	def test_least_outstanding(self):
+		'''tests that requests go to the upstream with the fewest in flight'''
+		pool = self.make_pool(['http://a', 'http://b', 'http://c'])
+		first = pool.acquire()
+		second = pool.acquire()
+		third = pool.acquire()
+		self.assertEqual(set(u.url for u in (first, second, third)), set(['http://a', 'http://b', 'http://c']))
+
+		pool.release(second, 0.01, 200)
+		self.assertEqual(pool.acquire(), second)
+
+	def test_ewma(self):
+		'''tests that the ewma policy favors the faster upstream, scaled by
+		its requests in flight'''
+		pool = self.make_pool(['http://fast', 'http://slow'], policy='ewma')
+		fast, slow = pool.upstreams()
+		for u, elapsed in ((fast, 0.01), (slow, 0.1)):
+			u.outstanding += 1
+			pool.release(u, elapsed, 200)
+
+		self.assertEqual([pool.acquire() for _ in range(9)], [fast] * 9)
+		# ten in flight on fast weigh as much as slow's idle average
+		pool.acquire()
+		pool.acquire()
+		self.assertEqual(slow.outstanding, 1)
+
+	def test_unknown_policy(self):
+		'''tests that an unknown policy is refused'''
+		self.assertRaises(ValueError, upstream.UpstreamPool, ['http://a'], policy='round_robin')
+
+	def test_ejection(self):
+		'''tests that consecutive failures eject an upstream, for twice as
+		long each time, and that a success clears them'''
+		pool = self.make_pool(['http://a', 'http://b'], max_failures=2, eject_secs=10)
+		a, b = pool.upstreams()
+
+		for status in (503, None):
+			a.outstanding += 1
+			pool.release(a, 0.01, status)
+		self.assertEqual(a.ejected_until, self.clock.now + 10)
+		self.assertEqual([pool.acquire() for _ in range(3)], [b, b, b])
+
+		self.clock.now += 10
+		for _ in range(2):
+			a.outstanding += 1
+			pool.release(a, 0.01, 500)
+		self.assertEqual(a.ejected_until, self.clock.now + 20)
+
+		self.clock.now += 20
+		a.outstanding += 1
+		pool.release(a, 0.01, 404)
+		self.assertEqual((a.failures, a.ejections, a.ejected_until), (0, 0, None))
+
+	def test_all_ejected(self):
+		'''tests that with every upstream ejected, requests go to the one due
+		back first'''
+		pool = self.make_pool(['http://a', 'http://b'], max_failures=1, eject_secs=10)
+		a, b = pool.upstreams()
+		b.outstanding += 1
+		pool.release(b, 0.01, None)
+		self.clock.now += 1
+		a.outstanding += 1
+		pool.release(a, 0.01, None)
+
+		self.assertEqual(pool.acquire(), b)
+
+	def test_host_routes(self):
+		'''tests that hosts with routes get their own upstreams, with or
+		without a port, and other hosts the default ones'''
+		pool = self.make_pool(['http://a'], routes={'Static.example.com': ['http://s1', 'http://a']})
+		self.assertEqual([u.url for u in pool.candidates('static.example.com:80')], ['http://s1', 'http://a'])
+		self.assertEqual([u.url for u in pool.candidates('www.example.com')], ['http://a'])
+		self.assertEqual([u.url for u in pool.candidates(None)], ['http://a'])
+		# an upstream listed twice is tracked once
+		self.assertEqual(len(pool.upstreams()), 2)
+
+		pool = self.make_pool([], routes={'static.example.com': ['http://s1']})
+		self.assertRaises(upstream.NoUpstreamError, pool.acquire, 'www.example.com')
+
+class TestOriginRequests(unittest.TestCase):
+	'''Requests through webcache._issue_server_request to local origins'''
+
+	def setUp(self):
+		self.origins = []
+		self.saved_pool = webcache.UPSTREAM_POOL
+
+	def tearDown(self):
+		webcache.UPSTREAM_POOL = self.saved_pool
+		for origin in self.origins:
+			origin.stop()
+
+	def start_origin(self, name, status='200 OK'):
+		origin = fixtures.origin_mockout.MockOrigin(name, status)
+		self.origins.append(origin)
+		return origin
+
+	def test_balanced(self):
+		'''tests that misses are spread over the pool's origins'''
+		a = self.start_origin('a')
+		b = self.start_origin('b')
+		webcache.UPSTREAM_POOL = upstream.UpstreamPool([a.url, b.url])
+
+		for i in range(6):
+			response = webcache._issue_server_request(FakeRequest('/url%d' % (i,), {'Host': 'www.example.com'}))
+			self.assertEqual(response.status_code, 200)
+		self.assertTrue(a.requests > 0 and b.requests > 0)
+		self.assertEqual(a.requests + b.requests, 6)
+		self.assertEqual(sum(s['outstanding'] for s in webcache.UPSTREAM_POOL.stats()), 0)
+
+	def test_failing_origin_ejected(self):
+		'''tests that an origin answering with errors, and one that is down,
+		are ejected'''
+		good = self.start_origin('good')
+		failing = self.start_origin('failing', '503 Service Unavailable')
+		down = self.start_origin('down')
+		down.stop()
+		self.origins.remove(down)
+
+		webcache.UPSTREAM_POOL = upstream.UpstreamPool([good.url, failing.url, down.url], max_failures=2)
+		for i in range(12):
+			try:
+				webcache._issue_server_request(FakeRequest('/url%d' % (i,)))
+			except requests.RequestException:
+				pass
+
+		self.assertEqual(failing.requests, 2)
+		self.assertEqual(good.requests, 8)
+		ejected = [s['url'] for s in webcache.UPSTREAM_POOL.stats() if s['ejected_until'] is not None]
+		self.assertEqual(sorted(ejected), sorted([failing.url, down.url]))
+
+	def test_host_routing(self):
+		'''tests that the Host header picks the route, and reaches the origin'''
+		www = self.start_origin('www')
+		static = self.start_origin('static')
+		webcache.UPSTREAM_POOL = upstream.UpstreamPool([www.url], routes={'static.example.com': [static.url]})
+
+		response = webcache._issue_server_request(FakeRequest('/logo.png', {'Host': 'static.example.com'}))
+		self.assertEqual(response.content, b'static /logo.png')
+		response = webcache._issue_server_request(FakeRequest('/index.html', {'Host': 'www.example.com'}))
+		self.assertEqual(response.content, b'www /index.html')
+
+		self.assertEqual(static.hosts, ['static.example.com'])
+		self.assertEqual(www.hosts, ['www.example.com'])
+
+if __name__ == "__main__":
+	unittest.main()
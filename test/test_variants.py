@@ -0,0 +1,36 @@
+import unittest
+import variants
+
+class TestVariants(unittest.TestCase):
+
+	def test_accept_language(self):
+		'''tests that languages reduce to the primary subtag of the top preference'''
+		self.assertEqual(variants.normalize_accept_language('en-US,en;q=0.9,fr;q=0.8'), 'en')
+		self.assertEqual(variants.normalize_accept_language('fr;q=0.5, de'), 'de')
+		self.assertEqual(variants.normalize_accept_language('en;q=0, fr;q=0.1'), 'fr')
+		self.assertEqual(variants.normalize_accept_language(''), '')
+		self.assertEqual(variants.normalize_accept_language('*'), '')
+
+	def test_accept_encoding(self):
+		'''tests that encodings reduce to the best supported coding'''
+		self.assertEqual(variants.normalize_accept_encoding('gzip, deflate, br'), 'br')
+		self.assertEqual(variants.normalize_accept_encoding('deflate, gzip'), 'gzip')
+		self.assertEqual(variants.normalize_accept_encoding('gzip;q=0'), 'identity')
+		self.assertEqual(variants.normalize_accept_encoding(''), 'identity')
+
+	def test_variant_key(self):
+		'''tests that variant keys combine the configured headers only'''
+		headers = {
+			'Accept-Language': 'en-GB',
+			'Accept-Encoding': 'gzip',
+			'X-Theme': 'Dark, compact',
+			'User-Agent': 'ignored',
+			}
+		self.assertEqual(variants.make_variant_key(headers, []), '')
+		self.assertEqual(
+			variants.make_variant_key(headers, ['Accept-Language', 'Accept-Encoding', 'X-Theme']),
+			'accept-language=en&accept-encoding=gzip&x-theme=compact,dark'
+			)
+
+if __name__ == "__main__":
+	unittest.main()
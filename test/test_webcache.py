@@ -1,7 +1,16 @@
 import unittest
 import webcache
+import lifecycle
 import pylibmc
 import collections
+import json
+import os
+import profiling
+import pstats
+import shutil
+import requestlog
+import tempfile
+import tracing
 
 import fixtures.memcache_test_client
 import fixtures.server_mockout
@@ -69,6 +78,8 @@ class TestWebcache(unittest.TestCase):
 		server_data = self._server_data = fixtures.server_mockout.ServerData()
 		webcache._issue_server_request = server_data.replacement_issue_request
 
+		self.patch_setting('CONTENT_REAPER', lifecycle.ContentReaper(lambda: self._mc_client, synchronous=True))
+
 	def tearDown(self):
 		logging.info("tearing down")
 
@@ -165,7 +176,7 @@ class TestWebcache(unittest.TestCase):
 		self.assertCacheEqual('/url1',
 			url='/url1',
 			status="200 OK",
-			headers={},
+			response_headers=[],
 			content="other stuff"
 			)
 
@@ -211,7 +222,7 @@ class TestWebcache(unittest.TestCase):
 		# hang onto metadata fields from first entry
 		metadata_fields = self.get_metadata_fields('/url1',
 			'last_modified',
-			'sha256_digest',
+			'digest',
 			'session',
 			)
 
@@ -224,7 +235,7 @@ class TestWebcache(unittest.TestCase):
 		# compare new and old metadata fields
 		new_metadata_fields = self.get_metadata_fields('/url1',
 			'last_modified',
-			'sha256_digest',
+			'digest',
 			'session'
 			)
 		self.assertEqual(
@@ -247,7 +258,7 @@ class TestWebcache(unittest.TestCase):
 		# hang onto metadata fields from first entry
 		metadata_fields = self.get_metadata_fields('/url1',
 			'last_modified',
-			'sha256_digest',
+			'digest',
 			'session',
 			)
 
@@ -258,7 +269,7 @@ class TestWebcache(unittest.TestCase):
 		# compare new and last ones--only the session should be the same
 		new_metadata_fields = self.get_metadata_fields('/url1',
 			'last_modified',
-			'sha256_digest',
+			'digest',
 			'session'
 			)
 
@@ -273,8 +284,8 @@ class TestWebcache(unittest.TestCase):
 		self.assertEqual(self.__response_headers['Last-Modified'], [http_date])
 
 		self.assertNotEqual(
-			metadata_fields['sha256_digest'],
-			new_metadata_fields['sha256_digest']
+			metadata_fields['digest'],
+			new_metadata_fields['digest']
 			)
 
 		self.assertEqual(
@@ -345,5 +356,804 @@ class TestWebcache(unittest.TestCase):
 			reservation=2,
 			last_noted=0)
 
+	def get_variant(self, url, headers, content=None):
+		'''requests the url with the given headers, queueing a server response
+		with the given content (if any) in case of a cache miss'''
+		self.__response_started = False
+		if content is not None:
+			self._server_data.push_response(url, fixtures.server_mockout.MockResponse(
+				status_code=200,
+				reason="OK",
+				content=content,
+				))
+
+		self.make_overlay_request(url, headers)
+
+	def test_variants_cached_separately(self):
+		'''tests that responses for different values of a vary header are
+		cached as variants of one entry, and served to matching requests'''
+		self.patch_setting('VARY_HEADERS', ['Accept-Language'])
+
+		self.get_variant('/url1', {'Accept-Language': 'en-US,en;q=0.8'}, content="english")
+		self.assertOverlayResponseEqual(status="200 OK", content="english")
+		self.assertEqual(self.__response_headers['Vary'], ['Accept-Language'])
+
+		self.get_variant('/url1', {'Accept-Language': 'fr'}, content="french")
+		self.assertOverlayResponseEqual(status="200 OK", content="french")
+
+		# no server responses queued--both must be served from cache
+		self.get_variant('/url1', {'Accept-Language': 'en-GB'})
+		self.assertOverlayResponseEqual(status="200 OK", content="english")
+		self.get_variant('/url1', {'Accept-Language': 'fr-CA, en;q=0.5'})
+		self.assertOverlayResponseEqual(status="200 OK", content="french")
+
+		metadata_body = self._mc_client.get(webcache.EntryMetadata.make_metadata_key('/url1'))
+		self.assertEqual(
+			sorted(metadata_body['variants'].keys()),
+			['accept-language=en', 'accept-language=fr']
+			)
+
+	def test_variants_capped(self):
+		'''tests that the least recently fetched variant is dropped once
+		the number of variants exceeds the limit'''
+		self.patch_setting('VARY_HEADERS', ['Accept-Language'])
+		self.patch_setting('VARY_MAX_VARIANTS', 2)
+
+		for language in ['en', 'fr', 'de']:
+			self.get_variant('/url1', {'Accept-Language': language}, content=language)
+			self._time_mockout.add_delta(1)
+
+		metadata_body = self._mc_client.get(webcache.EntryMetadata.make_metadata_key('/url1'))
+		self.assertEqual(
+			sorted(metadata_body['variants'].keys()),
+			['accept-language=de', 'accept-language=fr']
+			)
+
+		# dropped variant is fetched again
+		self.get_variant('/url1', {'Accept-Language': 'en'}, content="english again")
+		self.assertOverlayResponseEqual(status="200 OK", content="english again")
+
+	def test_variant_loser_waits_for_variant(self):
+		'''tests that a request losing the reservation for a variant that isn't
+		cached waits for the winner's update to that variant, although the
+		url is already valid with another'''
+		import threading
+		import time
+		self.patch_setting('VARY_HEADERS', ['Accept-Language'])
+		self.patch_setting('SLEEP_POLL_INTERVAL', 0.01)
+		self.patch_setting('backoff_deadline', lambda cache_metadata: webcache.unixtime() + 5)
+		self.get_variant('/url1', {'Accept-Language': 'en'}, content="english")
+
+		# another request, for the french variant, holds the reservation
+		winner_request = webcache.WSGIRequest('/url1', {'Accept-Language': 'fr'}, webcache.unixtime(), '/url1')
+		cache_metadata, won = webcache.update_reservation(self._mc_client, '/url1')
+		self.assertTrue(won)
+		reservation_token = (cache_metadata.session, cache_metadata.reservation)
+		winner = threading.Timer(0.1, webcache.update_cache, (self._mc_client, winner_request,
+			fixtures.server_mockout.MockResponse(status_code=200, reason="OK", content="french"), reservation_token))
+		winner.start()
+		self.addCleanup(winner.join)
+
+		# no server response queued: served from the winner's update
+		started = time.time()
+		self.get_variant('/url1', {'Accept-Language': 'fr'})
+		self.assertOverlayResponseEqual(status="200 OK", content="french")
+		self.assertLess(time.time() - started, 5)
+
+	def test_admission_passes_through_one_hit(self):
+		'''tests that a url below the admission threshold is served from the
+		origin without being cached, and cached once it is admitted'''
+		import admission
+		self.patch_setting('ADMISSION_POLICY', admission.FrequencyAdmission(threshold=2, width=1024))
+
+		self.get_variant('/url1', {}, content="stuff")
+		self.assertOverlayResponseEqual(status="200 OK", content="stuff")
+		self.assertIsNone(self._mc_client.get(webcache.EntryMetadata.make_metadata_key('/url1')))
+
+		self.get_variant('/url1', {}, content="stuff")
+		self.assertOverlayResponseEqual(status="200 OK", content="stuff")
+		self.assertCacheEqual('/url1', content="stuff")
+
+		self.assertEqual(webcache.ADMISSION_POLICY.stats()['admitted'], 1)
+		self.assertEqual(webcache.ADMISSION_POLICY.stats()['rejected'], 1)
+
+	def test_refresh_ahead(self):
+		'''tests that a hot entry is refreshed through the reservation protocol
+		before it expires, and that requests after the original expiry are
+		served from cache'''
+		import refresh
+		refresher = refresh.RefreshAhead(webcache.refresh_entry, clock=webcache.unixtime, lead_secs=5, min_hits=2)
+		self.patch_setting('REFRESHER', refresher)
+
+		self.test_simple_get()
+		for _ in range(2):
+			self.get_variant('/url1', {})
+
+		self._time_mockout.add_delta(26)
+		self._server_data.push_response('/url1', fixtures.server_mockout.MockResponse(
+			status_code=200,
+			reason="OK",
+			content="refreshed stuff",
+			))
+		self.assertEqual(refresher.run_pending(), 1)
+		self.assertEqual(refresher.refreshed, 1)
+
+		self.assertMetadataEqual('/url1',
+			valid=True,
+			reservation=2,
+			last_noted=2,
+			)
+
+		# past the original expiry, no server response queued
+		self._time_mockout.add_delta(10)
+		self.get_variant('/url1', {})
+		self.assertOverlayResponseEqual(status="200 OK", content="refreshed stuff")
+
+	def test_refresh_failure_releases_reservation(self):
+		'''tests that a refresh failing at the origin, with an error status or
+		an exception, releases its reservation, so that the first request
+		after the expiry wins it'''
+		import refresh
+		refresher = refresh.RefreshAhead(webcache.refresh_entry, clock=webcache.unixtime, lead_secs=5, min_hits=2)
+		self.patch_setting('REFRESHER', refresher)
+
+		self.test_simple_get()
+		for _ in range(2):
+			self.get_variant('/url1', {})
+
+		self._time_mockout.add_delta(26)
+		self._server_data.push_response('/url1', fixtures.server_mockout.MockResponse(status_code=503, reason="Service Unavailable"))
+		self.assertEqual(refresher.run_pending(), 1)
+		self.assertEqual(refresher.refreshed, 0)
+		self.assertMetadataEqual('/url1', valid=True, reservation=2, last_noted=2)
+
+		# no server response queued: the origin request raises
+		self.get_variant('/url1', {})
+		self.assertEqual(refresher.run_pending(), 1)
+		self.assertEqual(refresher.failed, 1)
+		self.assertMetadataEqual('/url1', valid=True, reservation=3, last_noted=3)
+
+		self._time_mockout.add_delta(10)
+		self._server_data.push_response('/url1', fixtures.server_mockout.MockResponse(status_code=200, reason="OK", content="new stuff"))
+		self.get_variant('/url1', {})
+		self.assertOverlayResponseEqual(status="200 OK", content="new stuff")
+		self.assertMetadataEqual('/url1', valid=True, reservation=4, last_noted=4)
+
+	def make_admin_request(self, path, token='secret', method='POST'):
+		'''make a request to an admin endpoint'''
+		self.__response_started = False
+		environ = {
+			'REQUEST_URI': webcache.ADMIN_PATH + path,
+			'REQUEST_METHOD': method,
+			'HTTP_X_WEBCACHE_TOKEN': token,
+			}
+
+		self.__response_content = webcache.handle_application(environ, self.__mock_start_response)
+		return self.__response_content
+
+	def enable_invalidation(self, prefixes=None):
+		self.patch_setting('INVALIDATION_ENABLED', True)
+		self.patch_setting('INVALIDATION_PREFIXES', prefixes or [])
+		self.patch_setting('ADMIN_TOKEN', 'secret')
+
+	def test_admin_requires_token(self):
+		'''tests that admin requests without the right token are refused'''
+		self.enable_invalidation()
+
+		self.make_admin_request('invalidate?url=/url1', token='wrong')
+		self.assertOverlayResponseEqual(status="403 Forbidden")
+
+		self.make_admin_request('invalidate?url=/url1', method='GET')
+		self.assertOverlayResponseEqual(status="405 Method Not Allowed")
+
+		self.make_admin_request('unknown')
+		self.assertOverlayResponseEqual(status="404 Not Found")
+
+	def test_invalidate_url(self):
+		'''tests that an invalidated url is refetched, and others are not'''
+		self.enable_invalidation()
+
+		self.get_variant('/url1', {}, content="stuff")
+		self.get_variant('/url2', {}, content="other stuff")
+
+		self.make_admin_request('invalidate?url=/url1')
+		self.assertOverlayResponseEqual(status="200 OK")
+
+		self.get_variant('/url1', {}, content="new stuff")
+		self.assertOverlayResponseEqual(status="200 OK", content="new stuff")
+		self.get_variant('/url2', {})
+		self.assertOverlayResponseEqual(status="200 OK", content="other stuff")
+
+	def test_invalidate_prefix(self):
+		'''tests that invalidating a prefix refetches every url under it'''
+		self.enable_invalidation(prefixes=['/news/'])
+
+		self.get_variant('/news/1', {}, content="one")
+		self.get_variant('/news/2', {}, content="two")
+		self.get_variant('/url1', {}, content="stuff")
+
+		self.make_admin_request('invalidate?prefix=/other/')
+		self.assertOverlayResponseEqual(status="400 Bad Request")
+		self.make_admin_request('invalidate?prefix=/news/')
+		self.assertOverlayResponseEqual(status="200 OK")
+
+		self.get_variant('/news/1', {}, content="new one")
+		self.assertOverlayResponseEqual(status="200 OK", content="new one")
+		self.get_variant('/news/2', {}, content="new two")
+		self.assertOverlayResponseEqual(status="200 OK", content="new two")
+		self.get_variant('/url1', {})
+		self.assertOverlayResponseEqual(status="200 OK", content="stuff")
+
+	def test_invalidate_tag(self):
+		'''tests that invalidating a tag refetches the entries carrying it,
+		and that the tag header isn't passed to the client'''
+		self.enable_invalidation()
+
+		for url, tags in [('/url1', 'product-1 listing'), ('/url2', 'product-2')]:
+			self._server_data.push_response(url, fixtures.server_mockout.MockResponse(
+				status_code=200,
+				reason="OK",
+				content="stuff",
+				headers={'Surrogate-Key': tags},
+				))
+			self.get_variant(url, {})
+			self.assertFalse('Surrogate-Key' in self.__response_headers)
+
+		self.make_admin_request('invalidate?tag=listing')
+
+		self.get_variant('/url1', {}, content="new stuff")
+		self.assertOverlayResponseEqual(status="200 OK", content="new stuff")
+		self.get_variant('/url2', {})
+		self.assertOverlayResponseEqual(status="200 OK", content="stuff")
+
+	def test_tagged_hit_reads_generations_once(self):
+		'''tests that a hit on a tagged entry reads the tags' generations along
+		with the url's, in one get_multi, and still sees the tags invalidated'''
+		self.enable_invalidation()
+		self._server_data.push_response('/url1', fixtures.server_mockout.MockResponse(
+			status_code=200,
+			reason="OK",
+			content="stuff",
+			headers={'Surrogate-Key': 'product-1 listing'},
+			))
+		self.get_variant('/url1', {})
+
+		get_multi = self._mc_client.get_multi
+		reads = []
+		def counting_get_multi(keys, *args, **kwargs):
+			reads.append(keys)
+			return get_multi(keys, *args, **kwargs)
+		self._mc_client.get_multi = counting_get_multi
+
+		self.get_variant('/url1', {})
+		self.assertOverlayResponseEqual(status="200 OK", content="stuff")
+		self.assertEqual(len(reads), 1)
+
+		self.make_admin_request('invalidate?tag=listing')
+		self.get_variant('/url1', {}, content="new stuff")
+		self.assertOverlayResponseEqual(status="200 OK", content="new stuff")
+
+	def test_admission_with_invalidation(self):
+		'''tests that admission counts requests by url, not by the generation
+		of the url they were served under'''
+		import admission
+		self.enable_invalidation()
+		self.patch_setting('ADMISSION_POLICY', admission.FrequencyAdmission(threshold=2, width=1024))
+
+		self.get_variant('/url1', {}, content="stuff")
+		self.get_variant('/url1', {}, content="stuff")
+		self.assertEqual(webcache.ADMISSION_POLICY.stats()['admitted'], 1)
+
+		self.make_admin_request('invalidate?url=/url1')
+		self.get_variant('/url1', {}, content="new stuff")
+		self.assertOverlayResponseEqual(status="200 OK", content="new stuff")
+		self.assertEqual(webcache.ADMISSION_POLICY.stats()['admitted'], 2)
+
+	def push_tagged_response(self, url, status_code=200, reason="OK"):
+		self._server_data.push_response(url, fixtures.server_mockout.MockResponse(
+			status_code=status_code,
+			reason=reason,
+			content="stuff",
+			headers={'Surrogate-Key': 'listing'},
+			))
+
+	def test_uncached_responses_skip_tags(self):
+		'''tests that responses that aren't stored (passed through, or not
+		OK) don't read or create generations for their tags'''
+		import admission
+		import invalidation
+		self.enable_invalidation()
+		generation_key = invalidation.tag_generation_key('listing')
+
+		self.patch_setting('ADMISSION_POLICY', admission.FrequencyAdmission(threshold=2, width=1024))
+		self.push_tagged_response('/url1')
+		self.get_variant('/url1', {})
+		self.assertOverlayResponseEqual(status="200 OK", content="stuff")
+		self.assertIsNone(self._mc_client.get(generation_key))
+
+		self.patch_setting('ADMISSION_POLICY', None)
+		self.push_tagged_response('/url2', status_code=503, reason="Service Unavailable")
+		self.get_variant('/url2', {})
+		self.assertOverlayResponseEqual(status="503 Service Unavailable")
+		self.assertIsNone(self._mc_client.get(generation_key))
+
+		# stored, once admission is off
+		self.push_tagged_response('/url1')
+		self.get_variant('/url1', {})
+		self.assertIsNotNone(self._mc_client.get(generation_key))
+
+	def test_entries_stored_with_ttl(self):
+		'''tests that content expires shortly after the entry does, and
+		metadata is retained for longer'''
+		self.test_simple_get()
+		content_key = self.get_metadata_fields('/url1', 'content_key')['content_key']
+
+		self._time_mockout.add_delta(webcache.EXPIRE_SECS + webcache.CONTENT_RETAIN_SECS + 1)
+		self.assertIsNone(self._mc_client.get(content_key))
+		self.assertIsNotNone(self._mc_client.get(webcache.EntryMetadata.make_metadata_key('/url1')))
+
+		self._time_mockout.add_delta(webcache.METADATA_RETAIN_SECS)
+		self.assertIsNone(self._mc_client.get(webcache.EntryMetadata.make_metadata_key('/url1')))
+
+	def test_superseded_content_deleted(self):
+		'''tests that the previous body is deleted once an update replaces it'''
+		self.test_simple_get()
+		old_content_key = self.get_metadata_fields('/url1', 'content_key')['content_key']
+		self.assertIsNotNone(self._mc_client.get(old_content_key))
+
+		# refetch before the old body expires on its own
+		self._time_mockout.add_delta(webcache.EXPIRE_SECS + 1)
+		self.get_variant('/url1', {}, content="new stuff")
+
+		new_content_key = self.get_metadata_fields('/url1', 'content_key')['content_key']
+		self.assertNotEqual(old_content_key, new_content_key)
+		self.assertFalse(old_content_key in self._mc_client.store)
+		self.assertCacheEqual('/url1', content="new stuff")
+
+	def test_disk_tier(self):
+		'''tests that large bodies are kept on the disk tier, and served
+		from it through the server's file_wrapper'''
+		import disktier
+		import shutil
+		import tempfile
+
+		root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, root)
+		self.patch_setting('DISK_TIER', disktier.DiskTier(root, min_body_bytes=100))
+
+		content = "large stuff " * 100
+		self._server_data.push_response('/url1', fixtures.server_mockout.MockResponse(status_code=200, reason="OK", content=content))
+		self.make_overlay_request('/url1', {})
+		self.assertOverlayResponseEqual(status="200 OK", content=content)
+		self.assertCacheEqual('/url1', content=None)
+
+		environ = {
+			'REQUEST_URI': '/url1',
+			'wsgi.file_wrapper': lambda body_file, block_size: iter(lambda: body_file.read(block_size), ''),
+			}
+		self.__response_started = False
+		body = webcache.handle_application(environ, self.__mock_start_response)
+
+		self.assertEqual(''.join(body), content)
+		self.assertEqual(self.__response_headers['Content-Length'], [str(len(content))])
+
+		# small bodies stay in memcached
+		self.__response_started = False
+		self._server_data.push_response('/url2', fixtures.server_mockout.MockResponse(status_code=200, reason="OK", content="small stuff"))
+		self.make_overlay_request('/url2', {})
+		self.assertCacheEqual('/url2', content="small stuff")
+
+	def test_shared_cache(self):
+		'''tests that entries read from memcached are shared with the host's
+		other processes, and served from the shared cache afterwards'''
+		import os
+		import shmcache
+		import shutil
+		import tempfile
+
+		root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, root)
+		shared_cache = shmcache.SharedCache(os.path.join(root, 'table'), sets=64)
+		self.addCleanup(shared_cache.close)
+		self.patch_setting('SHARED_CACHE', shared_cache)
+
+		self.test_simple_get()
+		self.get_variant('/url1', {})
+		self.assertEqual(shared_cache.stats()['stores'], 2)
+
+		# another process on the host finds the entry without memcached
+		self._mc_client.store.clear()
+		self.get_variant('/url1', {})
+		self.assertOverlayResponseEqual(status="200 OK", content="stuff")
+		self.assertEqual(shared_cache.stats()['hits'], 2)
+
+	def test_snapshot_restore(self):
+		'''tests that a restored snapshot serves entries from cache, with
+		their original fetched times'''
+		import os
+		import shutil
+		import tempfile
+
+		root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, root)
+		path = os.path.join(root, 'snapshot')
+
+		self.test_simple_get()
+		fetched = self.get_metadata_fields('/url1', 'fetched')['fetched']
+		self.assertEqual(webcache.save_snapshot(['/url1', '/missing'], path, self._mc_client), 2)
+
+		# memcached restarts
+		self._mc_client.store.clear()
+		self._time_mockout.add_delta(webcache.EXPIRE_SECS - 5)
+		self.assertEqual(webcache.restore_snapshot(path, self._mc_client), 2)
+		self.assertMetadataEqual('/url1', fetched=fetched)
+
+		self.get_variant('/url1', {})
+		self.assertOverlayResponseEqual(status="200 OK", content="stuff")
+
+		# nothing is restored over entries memcached already holds
+		self.assertEqual(webcache.restore_snapshot(path, self._mc_client), 0)
+
+	def test_snapshot_restore_stale(self):
+		'''tests that metadata in a snapshot older than its entries' lifetimes
+		is restored stale, without a reservation held, and revalidated by the
+		first request, keeping its Last-Modified'''
+		import os
+		import shutil
+		import tempfile
+
+		root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, root)
+		path = os.path.join(root, 'snapshot')
+
+		self.test_simple_get()
+		last_modified = self.get_metadata_fields('/url1', 'last_modified')['last_modified']
+		# a reservation held as the snapshot is taken
+		webcache.update_reservation(self._mc_client, '/url1')
+		self.assertEqual(webcache.save_snapshot(['/url1'], path, self._mc_client), 2)
+
+		self._mc_client.store.clear()
+		self._time_mockout.add_delta(webcache.EXPIRE_SECS + webcache.METADATA_RETAIN_SECS + 100)
+		self.assertEqual(webcache.restore_snapshot(path, self._mc_client), 1)
+		self.assertMetadataEqual('/url1', valid=True, reservation=2, last_noted=2)
+
+		self._time_mockout.add_delta(60)
+		self._server_data.push_response('/url1', fixtures.server_mockout.MockResponse(status_code=200, reason="OK", content="stuff"))
+		self.get_variant('/url1', {})
+		self.assertOverlayResponseEqual(status="200 OK", content="stuff")
+		self.assertMetadataEqual('/url1', last_modified=last_modified, reservation=3, last_noted=3)
+
+	def test_restore_after_restart(self):
+		'''tests that the snapshot is restored once per memcached restart'''
+		import os
+		import shutil
+		import tempfile
+
+		root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, root)
+		path = os.path.join(root, 'snapshot')
+		self.assertEqual(webcache.restore_after_restart(path, self._mc_client), 0)
+
+		self.test_simple_get()
+		webcache.save_snapshot(['/url1'], path, self._mc_client)
+		self.assertIsNone(webcache.restore_after_restart(path, self._mc_client))
+
+		self._mc_client.store.clear()
+		self.assertEqual(webcache.restore_after_restart(path, self._mc_client), 2)
+		self.assertIsNone(webcache.restore_after_restart(path, self._mc_client))
+		self.get_variant('/url1', {})
+		self.assertOverlayResponseEqual(status="200 OK", content="stuff")
+
+	def test_in_memory_backend(self):
+		'''tests that requests are cached in an in-process backend'''
+		import backends
+
+		backend = backends.InMemoryBackend()
+		webcache._open_client = lambda: backend
+
+		self._server_data.push_response('/url1', fixtures.server_mockout.MockResponse(status_code=200, reason="OK", content="stuff"))
+		self.make_overlay_request('/url1', {})
+		self.get_variant('/url1', {})
+		self.assertOverlayResponseEqual(status="200 OK", content="stuff")
+
+		metadata = backend.get(webcache.EntryMetadata.make_metadata_key('/url1'))
+		self.assertEqual(backend.get(metadata['content_key'])['content'], "stuff")
+
+	def test_prefetch_embedded(self):
+		'''tests that the uncached resources embedded in a page fetched from
+		the origin are warmed, and served from cache when requested'''
+		import prefetch
+
+		prefetcher = prefetch.Prefetcher(webcache.uncached_urls, webcache.warm_url, patterns=[r'^/cacheme/'])
+		self.patch_setting('PREFETCHER', prefetcher)
+
+		self.test_simple_get(content="<p>hot</p>")
+		self._server_data.push_response('/cacheme/hot', fixtures.server_mockout.MockResponse(status_code=200, reason="OK", content="hot"))
+		self.get_variant('/cacheme/hot', {})
+
+		page = '<p><a href="/b">link</a></p><embed src=/cacheme/c><img src="/cacheme/hot">'
+		self._server_data.push_response('/page', fixtures.server_mockout.MockResponse(
+			status_code=200, reason="OK", content=page, headers={'Content-Type': 'text/html; charset=UTF-8'}))
+		self._server_data.push_response('/cacheme/c', fixtures.server_mockout.MockResponse(status_code=200, reason="OK", content="embedded"))
+		self.get_variant('/page', {})
+
+		self.assertEqual(prefetcher.run_pending(), 2)
+		self.assertEqual(prefetcher.warmed, 1)
+		self.assertCacheEqual('/cacheme/c', content="embedded")
+
+		# served from cache, without another origin response queued
+		self.get_variant('/cacheme/c', {})
+		self.assertOverlayResponseEqual(status="200 OK", content="embedded")
+
+	def test_freshness_headers(self):
+		'''tests that the origin's caching headers are replaced with ones
+		derived from the entry's remaining freshness'''
+		import datetime
+
+		self.patch_setting('FRESHNESS_HEADERS', True)
+		self.patch_setting('FRESHNESS_SHARED_MAX_AGE', True)
+
+		self.test_simple_get(headers={
+			'CacheControl': 'private, max-age=1, must-revalidate',
+			'Pragma': 'no-cache',
+			'Expires': 'Sat, 05 Jul 1997 12:00:00 GMT',
+			'Content-Type': 'text/html',
+			})
+
+		self._time_mockout.add_delta(10)
+		expires = self._time_mockout.replacement_unixtime() + webcache.EXPIRE_SECS - 10
+		self.get_variant('/url1', {})
+
+		self.assertOverlayResponseEqual(status="200 OK", content="stuff")
+		self.assertEqual(self.__response_headers['Cache-Control'], ['public, max-age=%d, s-maxage=%d' % (webcache.EXPIRE_SECS, webcache.EXPIRE_SECS)])
+		self.assertEqual(self.__response_headers['Age'], ['10'])
+		self.assertEqual(self.__response_headers['Expires'], [webcache.make_http_date(
+			datetime.datetime.fromtimestamp(expires, tz=webcache.gmt_tz))])
+		self.assertEqual(self.__response_headers['Content-Type'], ['text/html'])
+		for header in ['CacheControl', 'Pragma']:
+			self.assertFalse(header in self.__response_headers)
+
+	def test_freshness_headers_not_ok(self):
+		'''tests that responses that weren't cached get no freshness headers'''
+		self.patch_setting('FRESHNESS_HEADERS', True)
+
+		self._server_data.push_response('/url1', fixtures.server_mockout.MockResponse(
+			status_code=500, reason="Internal Server Error", headers={'Pragma': 'no-cache'}))
+		self.make_overlay_request('/url1', {})
+
+		self.assertOverlayResponseEqual(status="500 Internal Server Error")
+		self.assertFalse('Cache-Control' in self.__response_headers)
+		self.assertEqual(self.__response_headers['Pragma'], ['no-cache'])
+
+	def test_change_detector(self):
+		'''tests that changes to normalized-away regions don't move
+		Last-Modified, while the new body is still served'''
+		import changedetect
+
+		self.patch_setting('CHANGE_DETECTOR', changedetect.ChangeDetector([
+			(r'^/url1', [changedetect.RegexStrip(r'<p>\d+</p>')]),
+			]))
+
+		self.test_simple_get(content="<p>100</p><p>body</p>")
+		last_modified = self.get_metadata_fields('/url1', 'last_modified')['last_modified']
+
+		self._time_mockout.add_delta(webcache.EXPIRE_SECS + 1)
+		self.get_variant('/url1', {}, content="<p>200</p><p>body</p>")
+		self.assertOverlayResponseEqual(status="200 OK", content="<p>200</p><p>body</p>")
+		self.assertMetadataEqual('/url1', last_modified=last_modified)
+
+		self._time_mockout.add_delta(webcache.EXPIRE_SECS + 1)
+		self.get_variant('/url1', {}, content="<p>300</p><p>new body</p>")
+		self.assertNotEqual(self.get_metadata_fields('/url1', 'last_modified')['last_modified'], last_modified)
+
+	def test_digest_algorithm_change(self):
+		'''tests that switching digest algorithms doesn't make unchanged
+		entries look changed, and that entries record their algorithm'''
+		self.test_simple_get()
+		last_modified = self.get_metadata_fields('/url1', 'last_modified')['last_modified']
+		self.assertMetadataEqual('/url1', digest_algorithm='sha256')
+
+		self.patch_setting('DIGEST_ALGORITHM', 'md5')
+		self._time_mockout.add_delta(webcache.EXPIRE_SECS + 1)
+		self.get_variant('/url1', {}, content="stuff")
+		self.assertMetadataEqual('/url1', last_modified=last_modified, digest_algorithm='md5')
+
+		self._time_mockout.add_delta(webcache.EXPIRE_SECS + 1)
+		self.get_variant('/url1', {}, content="new stuff")
+		self.assertNotEqual(self.get_metadata_fields('/url1', 'last_modified')['last_modified'], last_modified)
+
+	def test_digest_algorithm_unavailable(self):
+		'''tests that an entry whose digest was taken with an algorithm this
+		process can't compute is refetched as changed, rather than failing'''
+		self.test_simple_get()
+		metadata_key = webcache.EntryMetadata.make_metadata_key('/url1')
+		metadata_body = self._mc_client.get(metadata_key)
+		metadata_body['digest_algorithm'] = 'unavailable'
+		self._mc_client.set(metadata_key, metadata_body)
+
+		self._time_mockout.add_delta(webcache.EXPIRE_SECS + 1)
+		self.get_variant('/url1', {}, content="stuff")
+		self.assertOverlayResponseEqual(status="200 OK", content="stuff")
+		self.assertMetadataEqual('/url1', digest_algorithm='sha256', last_modified=self.__http_date())
+
+	def test_legacy_digest_field(self):
+		'''tests that entries stored with the digest under sha256_digest are
+		compared by it, and stored under digest once refetched'''
+		self.test_simple_get()
+		last_modified = self.get_metadata_fields('/url1', 'last_modified')['last_modified']
+		metadata_key = webcache.EntryMetadata.make_metadata_key('/url1')
+		metadata_body = self._mc_client.get(metadata_key)
+		metadata_body['sha256_digest'] = metadata_body.pop('digest')
+		del metadata_body['digest_algorithm']
+		self._mc_client.set(metadata_key, metadata_body)
+
+		self._time_mockout.add_delta(webcache.EXPIRE_SECS + 1)
+		self.get_variant('/url1', {}, content="stuff")
+		self.assertMetadataEqual('/url1', last_modified=last_modified, digest_algorithm='sha256')
+		metadata_body = self._mc_client.get(metadata_key)
+		self.assertFalse('sha256_digest' in metadata_body)
+		self.assertIsNotNone(metadata_body['digest'])
+
+	def test_metrics(self):
+		'''tests that hits, 304s and misses are counted, and served in
+		Prometheus format on the admin path'''
+		registry = webcache.new_metrics()
+		self.patch_setting('METRICS', registry)
+		self.patch_setting('ADMIN_TOKEN', 'secret')
+
+		self.test_simple_get(headers={'Last-Modified': self.__http_date()})
+		self.get_variant('/url1', {})
+		self.get_variant('/url1', {'If-Modified-Since': self.__http_date()})
+		self.assertOverlayResponseEqual(status="304 Not Modified")
+
+		responses = 'webcache_responses_total'
+		self.assertEqual(registry.value(responses, (('source', 'miss'),)), 1)
+		self.assertEqual(registry.value(responses, (('source', 'hit'),)), 1)
+		self.assertEqual(registry.value(responses, (('source', 'not_modified'),)), 1)
+		self.assertEqual(registry.value('webcache_reservations_total', (('result', 'won'),)), 1)
+		self.assertEqual(registry.value('webcache_request_seconds'), 3)
+		self.assertEqual(registry.value('webcache_phase_seconds', (('phase', 'origin'),)), 1)
+		self.assertEqual(registry.hot_urls(), [('/url1', 3)])
+
+		body = ''.join(self.make_admin_request('metrics', method='GET'))
+		self.assertOverlayResponseEqual(status="200 OK")
+		self.assertTrue('webcache_responses_total{source="hit"} 1\n' in body)
+		self.assertTrue('webcache_phase_seconds_count{phase="lookup"} 3\n' in body)
+		self.assertTrue('webcache_hot_url_requests{url="/url1"} 3\n' in body)
+
+	def test_tracing(self):
+		'''tests that requests carry a Server-Timing header of their phases,
+		and that slow requests' traces are written'''
+		trace_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, trace_dir)
+		trace_path = os.path.join(trace_dir, 'traces.jsonl')
+		self.patch_setting('TRACER', tracing.Tracer(trace_path, slow_secs=0, server_timing=True))
+
+		self.test_simple_get()
+		phases = [metric.split(';')[0] for metric in self.__response_headers['Server-Timing'][0].split(', ')]
+		for phase in ('lookup', 'metadata_get', 'compete', 'reserve', 'metadata_store', 'origin', 'update', 'hash', 'body_store', 'total'):
+			self.assertTrue(phase in phases, phase)
+
+		self.get_variant('/url1', {})
+		phases = [metric.split(';')[0] for metric in self.__response_headers['Server-Timing'][0].split(', ')]
+		self.assertEqual(phases, ['lookup', 'metadata_get', 'body_get', 'total'])
+
+		with open(trace_path) as traces:
+			traces = [json.loads(line) for line in traces]
+		self.assertEqual([(t['url'], t['status']) for t in traces], [('/url1', '200 OK')] * 2)
+		self.assertEqual([(span['name'], span['depth']) for span in traces[1]['spans']], [('lookup', 0), ('metadata_get', 1), ('body_get', 1)])
+
+	def test_access_log(self):
+		'''tests that each request gets an access log line, saying how it
+		was served'''
+		log_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, log_dir)
+		log_path = os.path.join(log_dir, 'access.log')
+		access_log = requestlog.AccessLog(log_path)
+		self.addCleanup(access_log.close)
+		self.patch_setting('ACCESS_LOG', access_log)
+
+		self.test_simple_get(headers={'Last-Modified': self.__http_date()})
+		self.get_variant('/url1', {'If-Modified-Since': self.__http_date()})
+		access_log.flush()
+
+		with open(log_path) as lines:
+			lines = [json.loads(line) for line in lines]
+		self.assertEqual([(l['url'], l['status'], l['source']) for l in lines], [('/url1', 200, 'miss'), ('/url1', 304, 'not_modified')])
+		self.assertEqual(set(lines[0]), set(['time', 'host', 'url', 'status', 'source', 'ms']))
+
+	def test_profiler(self):
+		'''tests that the profile admin path starts profiling requests, and
+		stops it, writing a pstats file'''
+		profile_dir = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, profile_dir)
+		self.patch_setting('ADMIN_TOKEN', 'secret')
+		self.patch_setting('PROFILER', profiling.Profiler(profile_dir))
+
+		status = json.loads(''.join(self.make_admin_request('profile?mode=cprofile&sample_rate=1&seconds=0')))
+		self.assertOverlayResponseEqual(status="200 OK")
+		self.assertEqual((status['running'], status['mode']), (True, 'cprofile'))
+		self.make_admin_request('profile?mode=sample')
+		self.assertOverlayResponseEqual(status="409 Conflict")
+
+		self.get_variant('/url1', {}, content="stuff")
+		self.get_variant('/url1', {})
+
+		status = json.loads(''.join(self.make_admin_request('profile?stop=1')))
+		self.assertFalse(status['running'])
+		stats = pstats.Stats(status['last_path'])
+		self.assertEqual([stats.stats[f][1] for f in stats.stats if f[2] == 'handle_request'], [2])
+
+		self.make_admin_request('profile?mode=unknown')
+		self.assertOverlayResponseEqual(status="400 Bad Request")
+
+	def test_request_headers(self):
+		'''tests that request headers are read from the environ by name, in
+		any case, and only from its HTTP_ keys'''
+		headers = webcache.get_request_headers({
+			'REQUEST_URI': '/url1',
+			'HTTP_IF_MODIFIED_SINCE': 'Mon, 01 Jan 2018 00:00:00 GMT',
+			'HTTP_ACCEPT_LANGUAGE': 'en',
+			})
+
+		self.assertEqual(headers['If-Modified-Since'], 'Mon, 01 Jan 2018 00:00:00 GMT')
+		self.assertEqual(headers.get('accept-language'), 'en')
+		self.assertFalse('Request-Uri' in headers)
+		self.assertEqual(dict(headers), {'If-Modified-Since': 'Mon, 01 Jan 2018 00:00:00 GMT', 'Accept-Language': 'en'})
+
+	def test_response_headers_stored(self):
+		'''tests that the headers sent with cached content are filtered once,
+		and stored with it, and that entries stored without them are still
+		served'''
+		self.test_simple_get(headers={'Content-Type': 'text/html', 'Server': 'origin', 'Surrogate-Key': 'tag'})
+		self.assertCacheEqual('/url1', response_headers=[('Content-Type', 'text/html')])
+
+		content_key = self.get_metadata_fields('/url1', 'content_key')['content_key']
+		content_body = self._mc_client.get(content_key)
+		self.assertFalse('headers' in content_body)
+		# as entries were stored before: with all the headers
+		content_body['headers'] = {'Content-Type': 'text/html', 'Server': 'origin', 'Surrogate-Key': 'tag'}
+		del content_body['response_headers']
+		self._mc_client.set(content_key, content_body)
+
+		self.get_variant('/url1', {})
+		self.assertOverlayResponseEqual(status="200 OK", content="stuff")
+		self.assertEqual(self.__response_headers['Content-Type'], ['text/html'])
+		self.assertFalse('Server' in self.__response_headers)
+
+	def test_warm_up(self):
+		'''tests that warming up a new process loads the bodies of the urls
+		the last snapshot was taken of into the shared cache'''
+		import backends
+		import os
+		import shmcache
+		import shutil
+		import tempfile
+
+		root = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, root)
+		self.test_simple_get()
+		webcache.save_snapshot(['/url1', '/missing'], os.path.join(root, 'snapshot'), self._mc_client)
+		self.assertEqual(self._mc_client.get(webcache.HOT_URLS_KEY), ['/url1', '/missing'])
+
+		shared_cache = shmcache.SharedCache(os.path.join(root, 'table'), sets=64)
+		self.addCleanup(shared_cache.close)
+		self.patch_setting('SHARED_CACHE', shared_cache)
+		self.patch_setting('STORAGE_BACKEND', backends.InMemoryBackend())
+		done = webcache.warm_up(origin_path=None)
+		self.assertEqual((done['memcached_clients'], done['origins'], done['primed']), (0, 0, 1))
+
+		# served from the shared cache, without reading the body from memcached
+		content_key = self.get_metadata_fields('/url1', 'content_key')['content_key']
+		self._mc_client.delete(content_key)
+		self.get_variant('/url1', {})
+		self.assertOverlayResponseEqual(status="200 OK", content="stuff")
+		self.assertEqual(shared_cache.stats()['hits'], 1)
+
+	def patch_setting(self, name, value):
+		'''sets a webcache module setting for the duration of the test'''
+		self.addCleanup(setattr, webcache, name, getattr(webcache, name))
+		setattr(webcache, name, value)
+
 if __name__ == "__main__":
 	unittest.main()
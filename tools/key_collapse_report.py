@@ -0,0 +1,99 @@
+'''
+Reports how far a sample of an access log would collapse under cache key
+normalization
+
+(c) 2018 simzes
+
+Usage:
+    python tools/key_collapse_report.py [options] access.log [access.log.1.gz ...]
+
+Counts the distinct urls requested in the sample, the distinct cache keys
+they normalize to, and lists the keys that absorb the most spellings.
+Options mirror the arguments of keynorm.KeyNormalizer, so candidate
+settings can be compared before they are deployed.
+'''
+
+import collections
+import optparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webcache'))
+
+import accesslog
+import keynorm
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options] LOG [LOG ...]")
+    parser.add_option('--limit', type='int', default=1000000,
+        help="number of requests to sample from the start of the logs [%default]")
+    parser.add_option('--drop', action='append', default=None,
+        help="query parameter pattern to drop (repeatable); replaces the default tracking parameters")
+    parser.add_option('--keep', action='append', default=None,
+        help="query parameter pattern to keep (repeatable); all others are dropped")
+    parser.add_option('--no-sort', action='store_true', default=False,
+        help="leave query parameters in their requested order")
+    parser.add_option('--lowercase-path', action='store_true', default=False,
+        help="treat paths as case-insensitive")
+    parser.add_option('--top', type='int', default=20,
+        help="number of most-collapsed keys to list [%default]")
+    options, paths = parser.parse_args(argv)
+    if not paths:
+        parser.error("no logs given")
+
+    normalizer = keynorm.KeyNormalizer(
+        sort_query=not options.no_sort,
+        drop_params=keynorm.DEFAULT_DROP_PARAMS if options.drop is None else options.drop,
+        keep_params=options.keep,
+        lowercase_path=options.lowercase_path,
+        )
+
+    requests = 0
+    raw_counts = collections.Counter()
+    for entry in accesslog.read_entries(paths):
+        if requests >= options.limit:
+            break
+        requests += 1
+        raw_counts[entry.url] += 1
+
+    spellings = collections.defaultdict(set)
+    key_requests = collections.Counter()
+    hashed = 0
+    for url, count in raw_counts.items():
+        normalized = normalizer.normalize(url)
+        spellings[normalized].add(url)
+        key_requests[normalized] += count
+        if keynorm.hash_long_key("metadata_%s" % (normalized,)) != "metadata_%s" % (normalized,):
+            hashed += 1
+
+    if not requests:
+        sys.stdout.write("no requests found\n")
+        return 1
+
+    distinct_urls = len(raw_counts)
+    distinct_keys = len(spellings)
+    sys.stdout.write("requests sampled:        %d\n" % (requests,))
+    sys.stdout.write("distinct urls:           %d\n" % (distinct_urls,))
+    sys.stdout.write("distinct cache keys:     %d\n" % (distinct_keys,))
+    sys.stdout.write("entries saved:           %d (%.1f%%)\n" % (
+        distinct_urls - distinct_keys,
+        100.0 * (distinct_urls - distinct_keys) / distinct_urls,
+        ))
+    # with every entry cached forever, only the first request per entry misses
+    sys.stdout.write("best-case hit ratio:     %.1f%% -> %.1f%%\n" % (
+        100.0 * (requests - distinct_urls) / requests,
+        100.0 * (requests - distinct_keys) / requests,
+        ))
+    sys.stdout.write("urls needing hashed keys: %d\n" % (hashed,))
+
+    collapsed = sorted(spellings.items(), key=lambda item: len(item[1]), reverse=True)
+    collapsed = [item for item in collapsed[:options.top] if len(item[1]) > 1]
+    if collapsed:
+        sys.stdout.write("\nmost-collapsed keys (spellings, requests, key):\n")
+        for normalized, urls in collapsed:
+            sys.stdout.write("%8d %10d  %s\n" % (len(urls), key_requests[normalized], normalized))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,151 @@
+'''
+Estimates the share of a memcached instance taken up by orphaned bodies
+
+(c) 2018 simzes
+
+Usage:
+    python tools/orphan_report.py [--server 127.0.0.1:11211] [--sample 500]
+
+A body (a body_ key) is orphaned when the metadata entry for its url no
+longer refers to it. The tool lists the keys in the instance (with
+"lru_crawler metadump", or "stats cachedump" on older servers), samples
+the body keys, and checks each sampled body against the metadata of the
+url it was stored for. Reports the orphaned share of body keys and bytes,
+and extrapolates to the whole instance.
+
+Listing keys walks the whole cache; run it against production instances
+with care.
+'''
+
+import optparse
+import os
+import random
+import socket
+import sys
+
+try:
+    from urllib.parse import unquote
+except ImportError:
+    from urllib import unquote
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webcache'))
+
+import pylibmc
+
+import webcache
+
+_final_lines = ('END', 'ERROR', 'CLIENT_ERROR', 'SERVER_ERROR', 'BUSY')
+
+def _command(sock, command):
+    '''Sends a text protocol command, returning the lines of the response'''
+    sock.sendall(command.encode('ascii') + b'\r\n')
+    data = b''
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+        if data.endswith(b'\r\n'):
+            last_line = data[:-2].rsplit(b'\r\n', 1)[-1].decode('latin-1')
+            if last_line.startswith(_final_lines):
+                break
+    return data.decode('latin-1').splitlines()
+
+def list_keys(host, port):
+    '''Generates (key, size) for every key in the instance'''
+    sock = socket.create_connection((host, port))
+    try:
+        lines = _command(sock, 'lru_crawler metadump all')
+        if lines and not lines[0].startswith(('ERROR', 'CLIENT_ERROR', 'BUSY')):
+            for line in lines:
+                fields = dict(f.split('=', 1) for f in line.split() if '=' in f)
+                if 'key' in fields:
+                    yield unquote(fields['key']), int(fields.get('size', 0))
+            return
+
+        # older servers: dump each slab class (limited to ~1MB of keys per class)
+        slabs = set()
+        for line in _command(sock, 'stats items'):
+            parts = line.split(':')
+            if len(parts) > 2 and parts[0] == 'STAT items':
+                slabs.add(int(parts[1]))
+        for slab in sorted(slabs):
+            for line in _command(sock, 'stats cachedump %d 0' % (slab,)):
+                # ITEM <key> [<size> b; <expiry> s]
+                if line.startswith('ITEM '):
+                    _, key, size = line.split(' ', 3)[:3]
+                    yield key, int(size.lstrip('['))
+    finally:
+        sock.close()
+
+def referenced_content_keys(metadata):
+    '''The content keys a metadata entry refers to, across its variants'''
+    keys = set([metadata.get('content_key')])
+    for record in metadata.get('variants', {}).values():
+        keys.add(record.get('content_key'))
+    keys.discard(None)
+    return keys
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('--server', default='127.0.0.1:11211',
+        help="memcached instance to inspect [%default]")
+    parser.add_option('--sample', type='int', default=500,
+        help="number of body keys to check [%default]")
+    options, _ = parser.parse_args(argv)
+
+    host, _, port = options.server.partition(':')
+    port = int(port or 11211)
+
+    body_keys = []
+    body_bytes = 0
+    total_keys = 0
+    total_bytes = 0
+    for key, size in list_keys(host, port):
+        total_keys += 1
+        total_bytes += size
+        if key.startswith('body_'):
+            body_keys.append((key, size))
+            body_bytes += size
+
+    sys.stdout.write("keys:        %d (%d bytes)\n" % (total_keys, total_bytes))
+    sys.stdout.write("body keys:   %d (%d bytes)\n" % (len(body_keys), body_bytes))
+    if not body_keys:
+        return 0
+
+    mc_client = pylibmc.Client(["%s:%d" % (host, port)], binary=True)
+    sample = random.sample(body_keys, min(options.sample, len(body_keys)))
+
+    checked = orphaned = 0
+    checked_bytes = orphaned_bytes = 0
+    for key, size in sample:
+        body = mc_client.get(key)
+        if body is None:
+            # expired or evicted since listing
+            continue
+
+        checked += 1
+        checked_bytes += size
+        metadata = mc_client.get(webcache.EntryMetadata.make_metadata_key(body['url']))
+        if metadata is None or key not in referenced_content_keys(metadata):
+            orphaned += 1
+            orphaned_bytes += size
+
+    if not checked:
+        sys.stdout.write("no sampled bodies could be read\n")
+        return 1
+
+    count_ratio = float(orphaned) / checked
+    byte_ratio = float(orphaned_bytes) / checked_bytes if checked_bytes else 0.0
+    sys.stdout.write("sampled:     %d bodies\n" % (checked,))
+    sys.stdout.write("orphaned:    %.1f%% of bodies, %.1f%% of body bytes\n" % (100 * count_ratio, 100 * byte_ratio))
+    sys.stdout.write("estimated:   %d orphaned bodies, %d bytes (%.1f%% of the instance)\n" % (
+        count_ratio * len(body_keys),
+        byte_ratio * body_bytes,
+        100 * byte_ratio * body_bytes / total_bytes if total_bytes else 0.0,
+        ))
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
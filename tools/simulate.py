@@ -0,0 +1,315 @@
+'''
+Replays an access log through the webcache, to compare settings offline
+
+(c) 2018 simzes
+
+Usage:
+    python tools/simulate.py [options] access_log [access_log...]
+    python tools/simulate.py --sweep EXPIRE_SECS=30,300,3600 --sweep capacity=64M,1G access_log.gz
+
+Streams Apache access logs (read with accesslog.py: combined or common
+format; plain, .gz or .bz2, or - for stdin) and replays each GET through
+webcache.handle_application, on a virtual clock set from the log's
+timestamps, as the tests' TimeMockout does. Entries live in an
+InMemoryBackend with an LRU byte capacity, standing in for memcached;
+bodies are stood in for by tokens, but counted at their logged sizes
+(plus --item-overhead), so memory stays bounded by the capacity however
+long the log: entries past it are evicted, least recently used first. The origin answers at once with the logged size, and a body
+counts as changed when its size does. Logged 304s are replayed with an
+If-Modified-Since.
+
+Each --sweep gives a setting and its values, and every combination of
+the values is replayed, in a process of its own (--jobs at a time).
+Settings are webcache settings (EXPIRE_SECS, METADATA_RETAIN_SECS, ...),
+or:
+
+--capacity: memcached memory, with K, M or G suffixes (default 64M,
+memcached's own)
+--admission: the FrequencyAdmission threshold (0 for no admission policy)
+
+Reports, per combination, the hit ratio (requests served without going
+to the origin), byte hit ratio, origin requests and bytes, and peak
+memory. --curves writes, per combination, the hit ratio, origin load and
+memory over each --interval of log time, as CSV.
+
+Replays are single-threaded, so reservations are never contested: each
+origin fetch completes before the next request. Should a request still
+lose one, its backoff sleeps on the virtual clock, not in real time. --sample N replays only
+the urls hashing into 1 in N (with capacity scaled down to match),
+for logs too long to replay in full; counts are scaled back up.
+'''
+
+import csv
+import datetime
+import itertools
+import multiprocessing
+import optparse
+import os
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webcache'))
+
+import accesslog
+import admission
+import backends
+import lifecycle
+import webcache
+
+# statuses whose responses the webcache would store
+_cacheable_statuses = set([200, 203, 304])
+
+_size_suffixes = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+# memcached memory when no capacity is swept; memcached's own default
+DEFAULT_CAPACITY = 64 << 20
+
+def parse_size(text):
+    text = text.strip().upper()
+    if text[-1] in _size_suffixes:
+        return int(float(text[:-1]) * _size_suffixes[text[-1]])
+    return int(text)
+
+def parse_setting(name, text):
+    '''A sweep value, converted to the type of the setting it's for'''
+    if name == 'capacity':
+        return parse_size(text)
+    if name == 'admission':
+        return int(text)
+    if not hasattr(webcache, name):
+        raise ValueError("Unknown setting: %s" % (name,))
+    current = getattr(webcache, name)
+    if isinstance(current, bool):
+        return text.lower() in ('1', 'true', 'yes', 'on')
+    if isinstance(current, int):
+        return int(text)
+    if isinstance(current, float):
+        return float(text)
+    return text
+
+class SimulatedResponse(object):
+    '''An origin response of a given size, with a token standing in for the
+    body'''
+
+    def __init__(self, size):
+        self.status_code = 200
+        self.reason = 'OK'
+        self.ok = True
+        self.headers = {'Content-Length': str(size)}
+        self.content = ('%d' % (size,)).encode('ascii')
+
+class VirtualTime(object):
+    '''The time module, as the webcache sees it during a replay: sleeping
+    advances the simulation's virtual clock instead of waiting'''
+
+    def __init__(self, simulation):
+        self._simulation = simulation
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def sleep(self, secs):
+        self._simulation.now += secs
+
+class Simulation(object):
+    '''A replay of a log for one combination of settings'''
+
+    def __init__(self, settings, sample=1, item_overhead=50, interval=3600):
+        self.settings = settings
+        self.sample = sample
+        self.item_overhead = item_overhead
+        self.interval = interval
+
+        self.now = 0
+        self.requests = 0
+        self.passed = 0
+        self.bytes_requested = 0
+        self.origin_requests = 0
+        self.origin_bytes = 0
+        self.peak_bytes = 0
+        self.curve = []
+
+        # size the origin serves for each url, per the log line being replayed
+        self._size = 0
+        self._interval_start = None
+        self._interval_counts = (0, 0, 0)
+
+    def clock(self):
+        return self.now
+
+    def entry_size(self, key, value, pickled):
+        '''Bytes an entry takes in memcached: bodies count at their logged
+        size, rather than their token's'''
+        size = len(key) + len(pickled) + self.item_overhead
+        headers = dict(value.get('response_headers') or ()) if isinstance(value, dict) else {}
+        if 'Content-Length' in headers:
+            size += int(headers['Content-Length']) - len(value.get('content') or b'')
+        return size
+
+    def issue_server_request(self, wsgi_request):
+        self.origin_requests += 1
+        self.origin_bytes += self._size
+        return SimulatedResponse(self._size)
+
+    def configure(self):
+        capacity = self.settings.get('capacity', DEFAULT_CAPACITY)
+        self.backend = backends.InMemoryBackend(clock=self.clock, size_fn=self.entry_size,
+            max_bytes=max(capacity // self.sample, 1))
+
+        webcache.unixtime = self.clock
+        webcache.time = VirtualTime(self)
+        webcache._issue_server_request = self.issue_server_request
+        webcache.STORAGE_BACKEND = self.backend
+        webcache.CONTENT_REAPER = lifecycle.ContentReaper(lambda: self.backend, synchronous=True)
+        threshold = self.settings.get('admission')
+        webcache.ADMISSION_POLICY = admission.FrequencyAdmission(threshold=threshold) if threshold else None
+
+        for name, value in self.settings.items():
+            if name not in ('capacity', 'admission'):
+                setattr(webcache, name, value)
+
+    def replay(self, entries):
+        self.configure()
+        start_response = lambda status, headers: None
+
+        for entry in entries:
+            timestamp, method, url, status, size = entry.time, entry.method, entry.url, entry.status, entry.size
+            if self.sample > 1 and zlib.crc32(url if isinstance(url, bytes) else url.encode('latin-1')) % self.sample:
+                continue
+            if timestamp > self.now:
+                self.now = timestamp
+            if self._interval_start is None:
+                self._interval_start = timestamp
+            elif timestamp >= self._interval_start + self.interval:
+                self._end_interval()
+
+            self.requests += 1
+            self.bytes_requested += size
+            if method not in ('GET', 'HEAD') or status not in _cacheable_statuses:
+                # not cacheable: straight to the origin
+                self.passed += 1
+                self.origin_requests += 1
+                self.origin_bytes += size
+                continue
+
+            environ = {'REQUEST_URI': url}
+            if status == 304:
+                environ['HTTP_IF_MODIFIED_SINCE'] = webcache.make_http_date(
+                    datetime.datetime.fromtimestamp(timestamp, tz=webcache.gmt_tz))
+            self._size = size
+            for _ in webcache.handle_application(environ, start_response):
+                pass
+
+            if self.backend.bytes_used > self.peak_bytes:
+                self.peak_bytes = self.backend.bytes_used
+
+        if self._interval_start is not None:
+            self._end_interval()
+        return self.results()
+
+    def _end_interval(self):
+        requests, origin_requests, origin_bytes = self._interval_counts
+        interval_requests = self.requests - requests
+        self.curve.append({
+            'time': self._interval_start,
+            'requests': interval_requests * self.sample,
+            'hit_ratio': _ratio(interval_requests - (self.origin_requests - origin_requests), interval_requests),
+            'origin_requests': (self.origin_requests - origin_requests) * self.sample,
+            'origin_bytes': (self.origin_bytes - origin_bytes) * self.sample,
+            'memory_bytes': self.backend.bytes_used * self.sample,
+        })
+        self._interval_counts = (self.requests, self.origin_requests, self.origin_bytes)
+        while self._interval_start + self.interval <= self.now:
+            self._interval_start += self.interval
+
+    def results(self):
+        return {
+            'settings': self.settings,
+            'requests': self.requests * self.sample,
+            'passed': self.passed * self.sample,
+            'hit_ratio': _ratio(self.requests - self.origin_requests, self.requests),
+            'byte_hit_ratio': _ratio(self.bytes_requested - self.origin_bytes, self.bytes_requested),
+            'origin_requests': self.origin_requests * self.sample,
+            'origin_bytes': self.origin_bytes * self.sample,
+            'peak_memory_bytes': self.peak_bytes * self.sample,
+            'curve': self.curve,
+        }
+
+def _ratio(part, whole):
+    return round(float(part) / whole, 4) if whole else 0.0
+
+def simulate(job):
+    '''Replays the logs for one combination of settings; run in a worker
+    process, so that each starts from the webcache's defaults'''
+    paths, settings, options = job
+    simulation = Simulation(settings, options['sample'], options['item_overhead'], options['interval'])
+    return simulation.replay(accesslog.read_entries(paths, methods=None))
+
+def combinations(sweeps):
+    '''[(name, [values])] -> every combination, as a table of name -> value'''
+    names = [name for name, _ in sweeps]
+    return [dict(zip(names, values)) for values in itertools.product(*[values for _, values in sweeps])]
+
+def label(settings):
+    return ' '.join('%s=%s' % item for item in sorted(settings.items())) or 'defaults'
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog [options] access_log [access_log...]")
+    parser.add_option('--sweep', action='append', default=[],
+        help="setting=value,value,...; may be repeated")
+    parser.add_option('--sample', type='int', default=1,
+        help="replay only the urls hashing into 1 in this many [%default]")
+    parser.add_option('--item-overhead', type='int', default=50,
+        help="bytes memcached spends per entry beyond its key and value [%default]")
+    parser.add_option('--interval', type='int', default=3600,
+        help="seconds of log time per point of the curves [%default]")
+    parser.add_option('--curves', help="file to write the curves to, as CSV")
+    parser.add_option('--jobs', type='int', default=multiprocessing.cpu_count(),
+        help="combinations replayed at once [%default]")
+    options, paths = parser.parse_args(argv)
+    if not paths:
+        parser.error("No access log given")
+    if '-' in paths and len(paths) > 1:
+        parser.error("stdin can't be combined with other logs")
+
+    sweeps = []
+    for sweep in options.sweep:
+        name, _, values = sweep.partition('=')
+        sweeps.append((name, [parse_setting(name, value) for value in values.split(',')]))
+    settings = combinations(sweeps)
+    if '-' in paths and len(settings) > 1:
+        parser.error("stdin can only be replayed for one combination of settings")
+
+    job_options = {'sample': options.sample, 'item_overhead': options.item_overhead, 'interval': options.interval}
+    jobs = [(paths, combination, job_options) for combination in settings]
+    if len(jobs) == 1:
+        results = [simulate(jobs[0])]
+    else:
+        pool = multiprocessing.Pool(max(1, min(options.jobs, len(jobs))), maxtasksperchild=1)
+        try:
+            results = pool.map(simulate, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    sys.stdout.write("%-40s %10s %8s %8s %12s %14s %12s\n" % (
+        "settings", "requests", "hits", "bytes", "origin reqs", "origin bytes", "peak memory"))
+    for result in results:
+        sys.stdout.write("%-40s %10d %7.1f%% %7.1f%% %12d %14d %12d\n" % (
+            label(result['settings']), result['requests'], result['hit_ratio'] * 100, result['byte_hit_ratio'] * 100,
+            result['origin_requests'], result['origin_bytes'], result['peak_memory_bytes']))
+
+    if options.curves:
+        with open(options.curves, 'w') as curves:
+            writer = csv.writer(curves)
+            writer.writerow(['settings', 'time', 'requests', 'hit_ratio', 'origin_requests', 'origin_bytes', 'memory_bytes'])
+            for result in results:
+                for point in result['curve']:
+                    writer.writerow([label(result['settings']), point['time'], point['requests'], point['hit_ratio'],
+                        point['origin_requests'], point['origin_bytes'], point['memory_bytes']])
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
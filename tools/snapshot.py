@@ -0,0 +1,66 @@
+'''
+Saves the hottest cache entries to a snapshot file, or reloads one
+
+(c) 2018 simzes
+
+Usage:
+    python tools/snapshot.py save [--server 127.0.0.1:11211] [--top 1000] SNAPSHOT access.log [...]
+    python tools/snapshot.py restore [--server 127.0.0.1:11211] SNAPSHOT
+
+save finds the most requested urls in the given access logs, and writes
+their metadata and content entries to the snapshot. restore loads a
+snapshot (from this tool, or from webcache.start_snapshots) into
+memcached, skipping entries that have expired since it was written. Run
+restore after a memcached restart, before traffic returns if possible.
+
+With INVALIDATION_ENABLED, cache keys carry generation counters that the
+logs don't; snapshots for such caches have to come from the webcache
+processes (webcache.start_snapshots).
+'''
+
+import collections
+import optparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'webcache'))
+
+import pylibmc
+
+import accesslog
+import webcache
+
+def main(argv):
+    parser = optparse.OptionParser(usage="%prog save [options] SNAPSHOT LOG [LOG ...]\n       %prog restore [options] SNAPSHOT")
+    parser.add_option('--server', default='127.0.0.1:11211',
+        help="memcached instance to read from or load into [%default]")
+    parser.add_option('--top', type='int', default=1000,
+        help="number of most requested urls to save [%default]")
+    parser.add_option('--batch', type='int', default=100,
+        help="number of entries per memcached request [%default]")
+    options, args = parser.parse_args(argv)
+    if len(args) < 2 or args[0] not in ('save', 'restore'):
+        parser.error("expected save or restore, and a snapshot path")
+
+    mc_client = pylibmc.Client([options.server], binary=True, behaviors={"tcp_nodelay": True})
+    command, path = args[0], args[1]
+
+    if command == 'restore':
+        restored = webcache.restore_snapshot(path, mc_client, batch_size=options.batch)
+        sys.stdout.write("restored %d entries from %s\n" % (restored, path))
+        return 0
+
+    if len(args) < 3:
+        parser.error("no logs given")
+
+    counts = collections.Counter()
+    for entry in accesslog.read_entries(args[2:]):
+        counts[webcache.normalize_cache_url(entry.url)] += 1
+    urls = [url for url, _ in counts.most_common(options.top)]
+
+    written = webcache.save_snapshot(urls, path, mc_client, batch_size=options.batch)
+    sys.stdout.write("saved %d entries for %d urls to %s\n" % (written, len(urls), path))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,110 @@
+'''
+Streaming reader for apache access logs in the common or combined format
+
+(c) 2018 simzes
+
+Used by the tools that replay or summarize production traffic. Logs are
+read one line at a time, so arbitrarily large logs can be processed in
+bounded memory; logs compressed with gzip or bzip2 are decompressed on
+the fly, based on their file extension.
+'''
+
+import bz2
+import calendar
+import collections
+import gzip
+import re
+import sys
+import time
+
+# host ident user [time] "method url protocol" status size ["referer" "agent"]
+_line_re = re.compile(
+    r'^(\S+) (\S+) (\S+) \[([^\]]+)\] "(\S+) (\S+)(?: [^"]*)?" (\d{3}) (\S+)'
+    r'(?: "((?:[^"\\]|\\.)*)" "((?:[^"\\]|\\.)*)")?')
+
+AccessLogEntry = collections.namedtuple('AccessLogEntry', [
+    'host',
+    'time',
+    'method',
+    'url',
+    'status',
+    'size',
+    'referer',
+    'agent',
+])
+
+# the last timestamp parsed, and its unixtime; busy logs have many lines
+# per second
+_last_log_time = (None, None)
+
+def parse_log_time(log_time):
+    '''Converts an access log timestamp (05/Jul/1997:12:00:00 +0100) to
+    unixtime'''
+    global _last_log_time
+
+    last, parsed = _last_log_time
+    if log_time == last:
+        return parsed
+
+    stamp, _, offset = log_time.partition(' ')
+    parsed = calendar.timegm(time.strptime(stamp, '%d/%b/%Y:%H:%M:%S'))
+    if offset:
+        sign = -1 if offset[0] == '-' else 1
+        parsed -= sign * (int(offset[1:3]) * 3600 + int(offset[3:5]) * 60)
+    _last_log_time = (log_time, parsed)
+    return parsed
+
+def parse_line(line):
+    '''Returns an AccessLogEntry for the line, or None if it isn't in the
+    common or combined format'''
+    match = _line_re.match(line)
+    if match is None:
+        return None
+
+    host, _, _, log_time, method, url, status, size, referer, agent = match.groups()
+    try:
+        entry_time = parse_log_time(log_time)
+    except ValueError:
+        return None
+
+    return AccessLogEntry(
+        host=host,
+        time=entry_time,
+        method=method,
+        url=url,
+        status=int(status),
+        size=0 if size == '-' else int(size),
+        referer=referer,
+        agent=agent,
+        )
+
+def open_log(path):
+    '''Opens a log for reading, decompressing .gz and .bz2 files; '-' reads
+    standard input'''
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'rb')
+    return open(path, 'rb')
+
+def read_entries(paths, methods=('GET',)):
+    '''Generates the AccessLogEntry objects for each parseable line of the
+    given logs, in order, skipping requests with methods not in methods
+    (all methods, if methods is None)'''
+    for path in paths:
+        log = open_log(path)
+        try:
+            for line in log:
+                if not isinstance(line, str):
+                    line = line.decode('latin-1')
+                entry = parse_line(line)
+                if entry is None:
+                    continue
+                if methods is not None and entry.method not in methods:
+                    continue
+                yield entry
+        finally:
+            if log is not sys.stdin:
+                log.close()
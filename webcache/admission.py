@@ -0,0 +1,78 @@
+'''
+Admission policy deciding which origin responses are worth caching
+
+(c) 2018 simzes
+
+Without a policy, every miss stores a body in memcached. A crawler walking
+millions of urls that are each requested once then evicts the popular
+entries from memcached's LRU, for content that is never served again.
+
+FrequencyAdmission follows the TinyLFU design: each process counts the
+requests for each url in a CountMinSketch, aged periodically, and only
+admits a url into the cache once it has been requested threshold times
+within the sketch's window, or when it is requested more often than a
+sampled resident entry (a stand-in for memcached's eviction victim).
+Rejected requests are served straight from the origin.
+'''
+
+import random
+import threading
+
+import sketches
+
+class FrequencyAdmission(object):
+    '''Thread-safe admission filter over a per-process frequency sketch'''
+
+    def __init__(self, threshold=2, width=1 << 16, sample_size=None, victim_sample_size=64):
+        self.threshold = threshold
+        self.victim_sample_size = victim_sample_size
+
+        self._sketch = sketches.CountMinSketch(width=width, sample_size=sample_size)
+        self._residents = []
+        self._lock = threading.Lock()
+
+        self.admitted = 0
+        self.rejected = 0
+
+    def record(self, key):
+        '''Counts a request for the key; called for every request, hit or miss'''
+        with self._lock:
+            self._sketch.increment(key)
+
+    def admit(self, key):
+        '''Whether a response for the key should be stored in the cache'''
+        with self._lock:
+            frequency = self._sketch.estimate(key)
+
+            admitted = frequency >= self.threshold
+            if not admitted and self._residents:
+                # compete against a resident entry, as if it were evicted
+                victim_index = random.randrange(len(self._residents))
+                victim = self._residents[victim_index]
+                admitted = frequency > self._sketch.estimate(victim)
+                if admitted:
+                    self._residents[victim_index] = key
+            elif admitted:
+                self._note_resident(key)
+
+            if admitted:
+                self.admitted += 1
+            else:
+                self.rejected += 1
+
+            return admitted
+
+    def _note_resident(self, key):
+        if len(self._residents) < self.victim_sample_size:
+            self._residents.append(key)
+        else:
+            self._residents[random.randrange(self.victim_sample_size)] = key
+
+    def stats(self):
+        '''Returns the admission counters, and the sketch's aging count'''
+        with self._lock:
+            return {
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'resets': self._sketch.resets,
+            }
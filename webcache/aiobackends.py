@@ -0,0 +1,130 @@
+'''
+Storage backends for the asyncio entry point (asgi.py)
+
+(c) 2018 simzes
+
+The same operations as the backends in backends.py, as coroutines:
+
+    get(key) -> value, or None
+    gets(key) -> (value, cas token), or (None, None)
+    set(key, value, time=0) -> success
+    add(key, value, time=0) -> success; fails if the key exists
+    cas(key, value, cas token, time=0) -> success; fails if the entry has
+        changed since the token was read (or, for AsyncMemcachedBackend,
+        is gone), or raises backends.NotFound if it is gone
+    delete(key) -> whether the key existed
+    get_multi(keys) -> table of key -> value, for the keys present
+    close()
+
+AsyncMemcachedBackend keeps entries in memcached through aiomcache, with
+a pool of connections shared by every request of the event loop. Values
+are pickled under pylibmc's flag for pickled values, so they read the same
+as the entries of pylibmc clients. AsyncInMemoryBackend wraps an
+InMemoryBackend, whose operations never block.
+
+Requires Python 3.5 or later.
+'''
+
+import pickle
+
+try:
+    import aiomcache
+except ImportError:
+    aiomcache = None
+
+# pylibmc's flag for pickled values
+_FLAG_PICKLE = 1
+
+# the newest pickle protocol the pylibmc clients of Python 2 processes can
+# read
+_PICKLE_PROTOCOL = 2
+
+async def _get_flagged(value_and_flags):
+    value, flags = value_and_flags
+    if flags & _FLAG_PICKLE:
+        return pickle.loads(value)
+    return value
+
+async def _set_flagged(value):
+    return pickle.dumps(value, _PICKLE_PROTOCOL), _FLAG_PICKLE
+
+def _key(key):
+    return key.encode('utf-8') if isinstance(key, str) else key
+
+class AsyncMemcachedBackend(object):
+    '''Entries in memcached, through a pool of up to pool_size connections
+    to one server'''
+
+    def __init__(self, host, port=11211, pool_size=32):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            if aiomcache is None:
+                raise RuntimeError("AsyncMemcachedBackend requires aiomcache")
+            self._client = aiomcache.FlagClient(self.host, self.port, pool_size=self.pool_size,
+                get_flag_handler=_get_flagged, set_flag_handler=_set_flagged)
+        return self._client
+
+    async def get(self, key):
+        return await self.client.get(_key(key))
+
+    async def gets(self, key):
+        return await self.client.gets(_key(key))
+
+    async def set(self, key, value, time=0):
+        return await self.client.set(_key(key), value, exptime=time)
+
+    async def add(self, key, value, time=0):
+        return await self.client.add(_key(key), value, exptime=time)
+
+    async def cas(self, key, value, cas, time=0):
+        # memcached's NOT_FOUND and EXISTS both come back as a failure
+        return await self.client.cas(_key(key), value, cas, exptime=time)
+
+    async def delete(self, key):
+        return await self.client.delete(_key(key))
+
+    async def get_multi(self, keys):
+        values = await self.client.multi_get(*[_key(k) for k in keys])
+        return dict((k, v) for k, v in zip(keys, values) if v is not None)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+class AsyncInMemoryBackend(object):
+    '''Entries in a backends.InMemoryBackend, which may be shared with
+    threads using it directly'''
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def get(self, key):
+        return self.backend.get(key)
+
+    async def gets(self, key):
+        return self.backend.gets(key)
+
+    async def set(self, key, value, time=0):
+        return self.backend.set(key, value, time=time)
+
+    async def add(self, key, value, time=0):
+        return self.backend.add(key, value, time=time)
+
+    async def cas(self, key, value, cas, time=0):
+        return self.backend.cas(key, value, cas, time=time)
+
+    async def delete(self, key):
+        return self.backend.delete(key)
+
+    async def get_multi(self, keys):
+        return self.backend.get_multi(keys)
+
+    async def close(self):
+        pass
@@ -0,0 +1,492 @@
+'''
+An ASGI application serving the webcache from an asyncio event loop
+
+(c) 2018 simzes
+
+Usage, with any ASGI server:
+    uvicorn --app-dir webcache asgi:application
+
+Under mod_wsgi, a request holds one of the process's threads for as long
+as it takes, including the time it spends waiting on the origin, or
+backing off after losing the reservation for an update, so the thread
+count bounds how many requests a process can have pending. Here, each
+request is a task on the event loop:
+
+--entries are read and stored through an async client (STORAGE_BACKEND,
+see aiobackends.py)
+--misses go to the webcache's UPSTREAM_POOL through an aiohttp session,
+which keeps up to ORIGIN_CONNECTIONS connections open to each origin
+--requests that lost a reservation wait on an event, set as soon as a
+request of this process stores an update of the entry, polling the cache
+every SLEEP_POLL_INTERVAL for updates stored by other processes
+
+Entries, keys and the reservation protocol are the webcache's own, through
+the functions of webcache.py that don't touch the network, and the
+settings of webcache.py apply here too; WSGI and ASGI processes can share
+a memcached. The REFRESHER, PREFETCHER, SNAPSHOTTER and CONTENT_REAPER
+work as they do under WSGI, in their own threads, through
+webcache.STORAGE_BACKEND, which should then hold the same entries as
+STORAGE_BACKEND. The DISK_TIER, SHARED_CACHE, invalidation and TRACER
+(whose traces are per thread) are not supported; check_settings refuses
+them at startup.
+
+Requires Python 3.5 or later, aiohttp, and aiomcache for memcached.
+'''
+
+import asyncio
+import logging
+import time
+from urllib.parse import quote
+
+try:
+    import aiohttp
+    import yarl
+except ImportError:
+    aiohttp = None
+
+from requests.structures import CaseInsensitiveDict
+
+import aiobackends
+import backends
+import digests
+import requestlog
+import webcache
+from webcache import ConsistencyError, EntryContent, EntryMetadata, WSGIRequest, WSGIResponse
+
+# where entries are kept, through an async client (see aiobackends.py); e.g.
+# aiobackends.AsyncInMemoryBackend(backends.InMemoryBackend()) for a single
+# process
+STORAGE_BACKEND = aiobackends.AsyncMemcachedBackend('127.0.0.1')
+
+# most connections kept open to each origin server; requests beyond that
+# wait for a connection
+ORIGIN_CONNECTIONS = 100
+
+# webcache settings that the ASGI application can't serve requests with
+# while they are enabled
+unsupported_settings = [
+    'DISK_TIER',
+    'SHARED_CACHE',
+    'INVALIDATION_ENABLED',
+    'TRACER',
+]
+
+class UpdateNotifier(object):
+    '''Wakes the requests waiting for the update of an entry when another
+    request of this process stores it'''
+
+    def __init__(self):
+        # cache url -> event, and the number of requests waiting on it
+        self._events = {}
+        self._waiting = {}
+
+    async def wait(self, url, timeout):
+        '''Waits up to timeout seconds for an update of url's entry;
+        returns whether one was stored'''
+        event = self._events.get(url)
+        if event is None:
+            event = self._events[url] = asyncio.Event()
+        self._waiting[url] = self._waiting.get(url, 0) + 1
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self._waiting[url] -= 1
+            if not self._waiting[url]:
+                del self._waiting[url]
+                if self._events.get(url) is event:
+                    del self._events[url]
+
+    def notify(self, url):
+        '''Wakes the requests waiting for url's entry'''
+        event = self._events.pop(url, None)
+        if event is not None:
+            event.set()
+
+    def __len__(self):
+        return len(self._events)
+
+_notifier = UpdateNotifier()
+_session = None
+
+def check_settings():
+    '''Raises a ValueError if a webcache setting the ASGI application
+    doesn't support is enabled'''
+    enabled = [name for name in unsupported_settings if getattr(webcache, name)]
+    if enabled:
+        raise ValueError("Not supported by the ASGI application: %s" % (', '.join(enabled),))
+
+def get_request_headers(scope):
+    '''ASGI headers are (name, value) pairs of lowercase bytes; names are
+    recovered as webcache.get_request_headers does for cgi names, and
+    repeated headers joined with commas'''
+    http_headers = {}
+    for name, value in scope['headers']:
+        header_name = '-'.join(f.capitalize() for f in name.decode('latin-1').split('-'))
+        value = value.decode('latin-1')
+        if header_name in http_headers:
+            value = http_headers[header_name] + ', ' + value
+        http_headers[header_name] = value
+    return http_headers
+
+def get_request_url(scope):
+    '''The request's path and query, as sent (REQUEST_URI, for WSGI)'''
+    path = scope.get('raw_path')
+    path = path.decode('latin-1') if path else quote(scope['path'])
+    query = scope.get('query_string', b'').decode('latin-1')
+    return path + '?' + query if query else path
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await handle_lifespan(receive, send)
+    if scope['type'] != 'http':
+        raise ValueError("Unsupported ASGI scope: %s" % (scope['type'],))
+
+    request_url = get_request_url(scope)
+    wsgi_request = WSGIRequest(
+        request_url=request_url,
+        request_headers=get_request_headers(scope),
+        request_time=webcache.unixtime(),
+        cache_url=webcache.normalize_cache_url(request_url)
+        )
+
+    if webcache.ADMIN_TOKEN is not None and wsgi_request.url.startswith(webcache.ADMIN_PATH):
+        return await handle_admin(scope, wsgi_request, send)
+
+    requestlog.begin_task(wsgi_request.url)
+    logging.debug("Received request: %s", wsgi_request)
+
+    started = time.time()
+    try:
+        wsgi_response = await handle_request(wsgi_request)
+        logging.debug("Issuing response: %s", wsgi_response)
+    except ConsistencyError:
+        logging.warn("Couldn't update cache due to contention--bailing early")
+        webcache._count('webcache_consistency_errors_total')
+        wsgi_response = WSGIResponse.from_internal_error()
+    finally:
+        requestlog.end_task()
+    elapsed = time.time() - started
+    webcache._observe('webcache_request_seconds', elapsed)
+    if webcache.ACCESS_LOG is not None:
+        webcache.ACCESS_LOG.write(wsgi_request, wsgi_response.status, elapsed, wsgi_request.source)
+    # other exceptions are left to the ASGI server, which answers them with
+    # a 500
+
+    await _send_response(send, wsgi_response.status, wsgi_response.headers, wsgi_response.content)
+
+async def handle_lifespan(receive, send):
+    '''Checks the settings on startup, and closes the clients on shutdown'''
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                check_settings()
+            except ValueError as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def handle_admin(scope, wsgi_request, send):
+    '''Serves a request under ADMIN_PATH through webcache.handle_admin'''
+    environ = {
+        'REQUEST_URI': wsgi_request.url,
+        'REQUEST_METHOD': scope['method'],
+        'HTTP_X_WEBCACHE_TOKEN': wsgi_request.headers.get('X-Webcache-Token', ''),
+    }
+    started = []
+    content = webcache.handle_admin(environ, lambda status, headers: started.append((status, headers)))
+    status, headers = started[0]
+    await _send_response(send, status, headers, content)
+
+async def _send_response(send, status, headers, content):
+    await send({
+        'type': 'http.response.start',
+        'status': int(status[:3]),
+        'headers': [(name.encode('latin-1'), str(value).encode('latin-1')) for name, value in headers],
+    })
+    body = b''.join(c if isinstance(c, bytes) else c.encode('utf-8') for c in content)
+    await send({'type': 'http.response.body', 'body': body})
+
+async def handle_request(wsgi_request):
+    '''webcache.handle_request, as a coroutine'''
+    mc = STORAGE_BACKEND
+
+    if webcache.ADMISSION_POLICY is not None:
+        webcache.ADMISSION_POLICY.record(wsgi_request.cache_url)
+    if webcache.METRICS is not None:
+        webcache.METRICS.note_url(wsgi_request.cache_url)
+
+    # check if we can serve the request from cache
+    started = time.time()
+    cached_response = await check_for_cache_response(mc, wsgi_request)
+    webcache._observe_phase('lookup', started)
+
+    if cached_response:
+        logging.debug("Serving from cache")
+        webcache._count_response(wsgi_request, 'not_modified' if cached_response.status.startswith('304') else 'hit')
+        return cached_response
+
+    if webcache.ADMISSION_POLICY is not None and not webcache.ADMISSION_POLICY.admit(wsgi_request.cache_url):
+        logging.debug("Not admitted to cache--passing request through to the origin")
+        webcache._count_response(wsgi_request, 'pass')
+        return WSGIResponse.from_server_response(mc, wsgi_request, await _issue_origin_request(wsgi_request))
+
+    # can't serve from the cache -- compete for cache update
+    started = time.time()
+    won, reservation_token = await compete_for_cache_update(wsgi_request, mc)
+    webcache._observe_phase('compete', started)
+    if not won:
+        # check cache again to see if a competing request has updated the entry
+        cached_response = await check_for_cache_response(mc, wsgi_request)
+        if cached_response:
+            logging.debug("Serving parallel-update from cache")
+            webcache._count_response(wsgi_request, 'parallel_update')
+            return cached_response
+
+    logging.debug("Can't serve from cache--issuing new request to the origin")
+    webcache._count_response(wsgi_request, 'miss')
+
+    try:
+        server_response = await _issue_origin_request(wsgi_request)
+        started = time.time()
+        cache_metadata = await update_cache(mc, wsgi_request, server_response, reservation_token)
+        webcache._observe_phase('update', started)
+    finally:
+        # waiting requests check the entry, whether or not it was updated
+        _notifier.notify(wsgi_request.cache_url)
+
+    if webcache.PREFETCHER is not None:
+        webcache._prefetch_embedded(wsgi_request, cache_metadata.content_entry)
+
+    # responses that weren't cached mustn't be reused downstream either
+    stored = server_response.ok or not webcache.DROP_NOT_OK_STATUS
+    return WSGIResponse.from_cache_metadata(cache_metadata, freshness=stored)
+
+async def check_for_cache_response(mc_client, wsgi_request, cache_metadata=None):
+    '''webcache.check_for_cache_response, as a coroutine'''
+    if cache_metadata is None:
+        cache_metadata = await load_metadata(mc_client, wsgi_request.cache_url, wsgi_request.variant)
+
+    logging.debug("Checking cache metadata for url: %s", wsgi_request.cache_url)
+
+    if not webcache.entry_servable(wsgi_request, cache_metadata):
+        return None
+
+    response = webcache.not_modified_response(wsgi_request, cache_metadata)
+    if response is not None:
+        webcache._note_hit(wsgi_request, cache_metadata)
+        return response
+
+    cache_metadata.content_entry = await load_content(mc_client, cache_metadata)
+    if cache_metadata.content_entry is not None:
+        logging.debug("Have valid cache body")
+        webcache._note_hit(wsgi_request, cache_metadata)
+        return WSGIResponse.from_cache_metadata(cache_metadata)
+
+    logging.debug("No cache body; can't serve from cache")
+
+    return None
+
+async def load_metadata(mc_client, url, variant=''):
+    '''EntryMetadata.from_cache_or_none, through an async backend'''
+    cache_entry, etag = await mc_client.gets(EntryMetadata.make_metadata_key(url))
+    if cache_entry is None:
+        return None
+    return EntryMetadata.from_cache_entry(mc_client, cache_entry, etag, variant)
+
+async def load_content(mc_client, cache_metadata):
+    '''EntryContent.from_cache, through an async backend'''
+    cache_key = cache_metadata.content_key
+    cache_entry = await mc_client.get(cache_key)
+    if cache_entry is None:
+        return None
+    return EntryContent.from_cache_entry(cache_key, cache_entry)
+
+async def store_metadata(mc_client, cache_metadata):
+    '''EntryMetadata.store_metadata, through an async backend'''
+    metadata_key = cache_metadata.metadata_key
+    logging.debug("cache[%s] = %s", metadata_key, cache_metadata.cache_entry)
+
+    if cache_metadata.cas_token is not None:
+        try:
+            if await mc_client.cas(metadata_key, cache_metadata.cache_entry, cache_metadata.cas_token, time=cache_metadata.metadata_ttl()):
+                return True
+        except backends.NotFound:
+            pass
+        # memcached may have failed the cas because the entry was evicted;
+        # an add succeeds only if it was
+    return await mc_client.add(metadata_key, cache_metadata.cache_entry, time=cache_metadata.metadata_ttl())
+
+async def compete_for_cache_update(wsgi_request, mc_client):
+    '''webcache.compete_for_cache_update, as a coroutine. Losers wait on the
+    _notifier between polls, so that an update stored by this process wakes
+    them at once'''
+    cache_metadata, won = await update_reservation(mc_client, wsgi_request.cache_url)
+    reservation_token = (cache_metadata.session, cache_metadata.reservation,)
+
+    if won:
+        logging.debug("Won cache update, with reservation: %s", reservation_token)
+        webcache._count('webcache_reservations_total', labels=(('result', 'won'),))
+        return (True, reservation_token,)
+
+    webcache._count('webcache_reservations_total', labels=(('result', 'lost'),))
+    slept = time.time()
+
+    stop = webcache.backoff_deadline(cache_metadata)
+    logging.debug("Lost cache update, backing off until: %d, now: %d, reservation: %s", int(stop), int(webcache.unixtime()), reservation_token)
+
+    while stop > webcache.unixtime():
+        await _notifier.wait(wsgi_request.cache_url,
+            min(
+                webcache.SLEEP_POLL_INTERVAL,
+                max(stop - webcache.unixtime(), 0)
+            ))
+
+        cache_metadata = await load_metadata(mc_client, wsgi_request.cache_url, wsgi_request.variant)
+        # as in webcache.compete_for_cache_update, wait for this variant
+        if (cache_metadata is None) or (cache_metadata.valid and cache_metadata.has_variant):
+            break
+
+    logging.debug("Finished cache backoff")
+    webcache._observe('webcache_backoff_seconds', time.time() - slept)
+
+    return (False, reservation_token,)
+
+async def update_reservation(mc_client, url):
+    '''webcache.update_reservation, as a coroutine'''
+    for attempt in range(webcache.UPDATE_MAX_ATTEMPTS):
+        if attempt:
+            webcache._count('webcache_cas_retries_total', labels=(('operation', 'reservation'),))
+        cache_metadata = await load_metadata(mc_client, url)
+        if cache_metadata:
+            cache_metadata.reservation += 1
+        else:
+            cache_metadata = EntryMetadata.new_reservation(mc_client, url)
+
+        if await store_metadata(mc_client, cache_metadata):
+            won = (cache_metadata.reservation == cache_metadata.last_noted + 1)
+            return (cache_metadata, won,)
+
+    raise ConsistencyError()
+
+async def update_cache(mc_client, wsgi_request, server_response, reservation_token):
+    '''webcache.update_cache, as a coroutine'''
+    content_entry = EntryContent.from_server_response(server_response, wsgi_request.cache_url, mc_client, reservation_token)
+    variant = wsgi_request.variant
+
+    if webcache.DROP_NOT_OK_STATUS and (not server_response.ok):
+        logging.debug("Server response not OK -- invalidating cache")
+        cache_metadata = EntryMetadata.from_server_response(mc_client, wsgi_request.cache_url, content_entry, variant, stored=False)
+
+        # delete metadata as a way of notifying other, waiting requests that
+        # the blocking request has given up
+        await mc_client.delete(cache_metadata.metadata_key)
+
+        return cache_metadata
+
+    logging.debug("cache[%s] = [...]", content_entry.content_key)
+    if not await mc_client.set(content_entry.content_key, content_entry.to_cache_entry(), time=EntryContent.content_ttl()):
+        raise ConsistencyError()
+
+    for attempt in range(webcache.UPDATE_MAX_ATTEMPTS):
+        if attempt:
+            webcache._count('webcache_cas_retries_total', labels=(('operation', 'update'),))
+        cache_metadata = await load_metadata(mc_client, wsgi_request.cache_url, variant)
+        if cache_metadata:
+            cached_response = await check_for_cache_response(mc_client, wsgi_request, cache_metadata=cache_metadata)
+            if cached_response:
+                # can already serve from cache--return response
+                # delete server body we stored unnecessarily
+                await mc_client.delete(content_entry.content_key)
+                if cached_response.status.startswith('304'):
+                    # the response is built from the body, which a 304 leaves unread
+                    cache_metadata.content_entry = await load_content(mc_client, cache_metadata)
+                return cache_metadata
+            # have entry, but need to update metadata with server response to make valid
+            cache_metadata.update_for_server_response(content_entry)
+        else:
+            # no existing entry--insert new one
+            cache_metadata = EntryMetadata.from_server_response(mc_client, wsgi_request.cache_url, content_entry, variant)
+        if await store_metadata(mc_client, cache_metadata):
+            if webcache.CONTENT_REAPER is not None:
+                webcache.CONTENT_REAPER.delete_later(cache_metadata.superseded_content_keys)
+            return cache_metadata
+
+    raise ConsistencyError()
+
+def _open_session():
+    '''The aiohttp session misses are sent to the origin with, opened on
+    first use, in the running event loop'''
+    global _session
+
+    if aiohttp is None:
+        raise RuntimeError("The ASGI application requires aiohttp")
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0, limit_per_host=ORIGIN_CONNECTIONS))
+    return _session
+
+def _origin_timeout():
+    '''webcache.REQUEST_TIMEOUT, as an aiohttp timeout'''
+    if isinstance(webcache.REQUEST_TIMEOUT, tuple):
+        connect, read = webcache.REQUEST_TIMEOUT
+    else:
+        connect = read = webcache.REQUEST_TIMEOUT
+    return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+async def close():
+    '''Closes the origin session and the STORAGE_BACKEND's connections'''
+    global _session
+
+    if _session is not None:
+        await _session.close()
+        _session = None
+    await STORAGE_BACKEND.close()
+
+async def _issue_origin_request(wsgi_request):
+    '''Issues a request to the origin, timing it as the origin phase'''
+    started = time.time()
+    try:
+        return await _issue_server_request(wsgi_request)
+    finally:
+        webcache._observe_phase('origin', started)
+
+async def _issue_server_request(wsgi_request):
+    logging.debug("Issuing request to origin server: %s", wsgi_request)
+
+    # the Host header goes to the origin as the client sent it, and picks
+    # which of the pool's routes serves the request
+    origin = webcache.UPSTREAM_POOL.acquire(wsgi_request.headers.get('Host'))
+    session = _open_session()
+    started = time.time()
+    status_code = None
+    try:
+        url = yarl.URL(origin.url + wsgi_request.url, encoded=True)
+        async with session.get(url, headers=wsgi_request.headers, timeout=_origin_timeout()) as response:
+            logging.debug("Server response from %s--status: %d, reason: %s", origin.url, response.status, response.reason)
+
+            # hash the body as it is read, rather than in another pass afterwards
+            hasher = digests.new(webcache.DIGEST_ALGORITHM)
+            chunks = []
+            async for chunk in response.content.iter_chunked(webcache.ORIGIN_READ_CHUNK):
+                hasher.update(chunk)
+                chunks.append(chunk)
+
+            # repeated headers are joined, as requests does
+            headers = CaseInsensitiveDict()
+            for name, value in response.headers.items():
+                headers[name] = headers[name] + ', ' + value if name in headers else value
+
+            server_response = webcache.OriginResponse(response.status, response.reason, headers,
+                b''.join(chunks), (webcache.DIGEST_ALGORITHM, hasher.digest()))
+            status_code = response.status
+    finally:
+        webcache.UPSTREAM_POOL.release(origin, time.time() - started, status_code)
+
+    return server_response
@@ -0,0 +1,272 @@
+'''
+Storage backends for cache entries
+
+(c) 2018 simzes
+
+The webcache keeps its entries through a small set of operations, those
+of a memcached client (pylibmc.Client):
+
+    get(key) -> value, or None
+    gets(key) -> (value, cas token), or (None, None)
+    set(key, value, time=0) -> success
+    add(key, value, time=0) -> success; fails if the key exists
+    cas(key, value, cas token, time=0) -> success; fails if the entry has
+        changed since the token was read, raises NotFound if it is gone
+    delete(key) -> whether the key existed
+    get_multi(keys) -> table of key -> value, for the keys present
+    set_multi(table, time=0) -> list of the keys that failed
+    incr(key, delta=1) -> new value; raises NotFound if the key is missing
+    stats() -> table of items, bytes and evictions, summed over servers
+    warm(clients) -> number of connections opened ahead of their first use
+
+time is a lifetime in seconds (0 for none), or, beyond 30 days, an
+absolute unix time, as in memcached.
+
+A backend provides these operations, and is shared by all the threads of
+a process. MemcachedBackend keeps entries in memcached, so that they are
+shared across processes and hosts. InMemoryBackend keeps them in the
+process, for single-process deployments, benchmarks and tests.
+'''
+
+import collections
+import threading
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import pylibmc
+    NotFound = pylibmc.NotFound
+except ImportError:
+    pylibmc = None
+    class NotFound(Exception):
+        pass
+
+# lifetimes beyond this are absolute unix times
+_RELATIVE_TIME_LIMIT = 30 * 24 * 3600
+
+class MemcachedBackend(object):
+    '''Entries in memcached, through a pylibmc client per thread (clients
+    aren't thread-safe)'''
+
+    def __init__(self, servers, binary=True, behaviors=None):
+        self.servers = servers
+        self.binary = binary
+        self.behaviors = behaviors if behaviors is not None else {"tcp_nodelay": True, "cas": True}
+        self._local = threading.local()
+        self._spare = []
+        self._spare_lock = threading.Lock()
+
+    def _new_client(self):
+        return pylibmc.Client(self.servers, binary=self.binary, behaviors=self.behaviors)
+
+    @property
+    def client(self):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            with self._spare_lock:
+                client = self._spare.pop() if self._spare else None
+            client = self._local.client = client or self._new_client()
+        return client
+
+    def warm(self, clients):
+        '''Opens clients clients, and their connections, to be handed to the
+        first threads needing one'''
+        opened = []
+        for _ in range(clients):
+            client = self._new_client()
+            # pylibmc connects on a client's first operation
+            client.get('webcache_warm')
+            opened.append(client)
+        with self._spare_lock:
+            self._spare.extend(opened)
+        return len(opened)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def gets(self, key):
+        return self.client.gets(key)
+
+    def set(self, key, value, time=0):
+        return self.client.set(key, value, time=time)
+
+    def add(self, key, value, time=0):
+        return self.client.add(key, value, time=time)
+
+    def cas(self, key, value, cas, time=0):
+        return self.client.cas(key, value, cas, time=time)
+
+    def delete(self, key):
+        return self.client.delete(key)
+
+    def get_multi(self, keys):
+        return self.client.get_multi(keys)
+
+    def set_multi(self, mapping, time=0):
+        return self.client.set_multi(mapping, time=time)
+
+    def incr(self, key, delta=1):
+        return self.client.incr(key, delta)
+
+    def stats(self):
+        totals = {'items': 0, 'bytes': 0, 'evictions': 0}
+        for _, server_stats in self.client.get_stats():
+            totals['items'] += int(server_stats.get('curr_items', 0))
+            totals['bytes'] += int(server_stats.get('bytes', 0))
+            totals['evictions'] += int(server_stats.get('evictions', 0))
+        return totals
+
+class InMemoryBackend(object):
+    '''Entries in a table in this process. Values are pickled on the way in,
+    as memcached would, so callers can't change stored entries by mutating
+    what they read.
+
+    With max_items or max_bytes set, the least recently used entries are
+    evicted beyond that many entries, or bytes. size_fn gives the bytes an
+    entry counts as, from its key, value and pickled value; by default, the
+    lengths of its key and pickled value.'''
+
+    def __init__(self, max_items=None, clock=time.time, max_bytes=None, size_fn=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.clock = clock
+        self.size_fn = size_fn or (lambda key, value, pickled: len(key) + len(pickled))
+
+        # key -> (pickled value, expires or None, cas token, size)
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._next_cas = 1
+        self._bytes = 0
+
+        self.evictions = 0
+
+    def _expires(self, lifetime):
+        if not lifetime:
+            return None
+        if lifetime > _RELATIVE_TIME_LIMIT:
+            return lifetime
+        return self.clock() + lifetime
+
+    def _lookup(self, key):
+        '''The live entry for key, marked as recently used; call with the
+        lock held'''
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= self.clock():
+            self._bytes -= entry[3]
+            return None
+        self._entries[key] = entry
+        return entry
+
+    def _remove(self, key):
+        '''Call with the lock held'''
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[3]
+        return entry
+
+    def _store(self, key, value, lifetime, expires=None):
+        '''Call with the lock held'''
+        self._remove(key)
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        size = self.size_fn(key, value, pickled)
+        if expires is None:
+            expires = self._expires(lifetime)
+        self._entries[key] = (pickled, expires, self._next_cas, size)
+        self._next_cas += 1
+        self._bytes += size
+
+        while ((self.max_items is not None and len(self._entries) > self.max_items)
+                or (self.max_bytes is not None and self._bytes > self.max_bytes and len(self._entries) > 1)):
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry[3]
+            self.evictions += 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._lookup(key)
+        return pickle.loads(entry[0]) if entry is not None else None
+
+    def gets(self, key):
+        with self._lock:
+            entry = self._lookup(key)
+        if entry is None:
+            return None, None
+        return pickle.loads(entry[0]), entry[2]
+
+    def set(self, key, value, time=0):
+        with self._lock:
+            self._store(key, value, time)
+        return True
+
+    def add(self, key, value, time=0):
+        with self._lock:
+            if self._lookup(key) is not None:
+                return False
+            self._store(key, value, time)
+        return True
+
+    def cas(self, key, value, cas, time=0):
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                raise NotFound(key)
+            if entry[2] != cas:
+                return False
+            self._store(key, value, time)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._remove(key) is not None
+
+    def get_multi(self, keys):
+        with self._lock:
+            entries = [(key, self._lookup(key)) for key in keys]
+        return dict((key, pickle.loads(entry[0])) for key, entry in entries if entry is not None)
+
+    def set_multi(self, mapping, time=0):
+        with self._lock:
+            for key, value in mapping.items():
+                self._store(key, value, time)
+        return []
+
+    def incr(self, key, delta=1):
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                raise NotFound(key)
+            value = pickle.loads(entry[0]) + delta
+            # incr keeps the entry's expiry
+            self._store(key, value, None, expires=entry[1])
+        return value
+
+    @property
+    def bytes_used(self):
+        '''Bytes held, including expired entries not yet reclaimed, as in
+        memcached's memory use'''
+        return self._bytes
+
+    def stats(self):
+        '''Counts the live entries, and the bytes they count as'''
+        with self._lock:
+            now = self.clock()
+            live = [entry for entry in self._entries.values() if entry[1] is None or entry[1] > now]
+            return {
+                'items': len(live),
+                'bytes': sum(entry[3] for entry in live),
+                'evictions': self.evictions,
+            }
+
+    def warm(self, clients):
+        '''Nothing to connect to'''
+        return 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -0,0 +1,116 @@
+'''
+Change detection that ignores the volatile parts of pages
+
+(c) 2018 simzes
+
+Each refetch of an entry compares the digest of the new body with the
+stored one, and only a changed body moves the entry's Last-Modified
+forward. Pages that embed a timestamp, a CSRF token or a rotating ad slot
+differ on every fetch, so their Last-Modified always moves, and clients
+never get a 304.
+
+A ChangeDetector holds rules, each a url pattern with a list of
+normalizers, and the first rule matching an entry's url normalizes its
+body before the digest is taken. Normalizers remove the volatile parts:
+
+--RegexStrip removes the matches of a regular expression
+--ByteRanges removes fixed byte ranges (offsets from the end if negative)
+--HtmlElements removes elements by tag, optionally only those with a
+given attribute value (class="ad-slot", name="csrf_token")
+
+Only the digest is affected; the body served is the one from the origin.
+'''
+
+import re
+
+def _compile_both(pattern, flags=0):
+    '''The pattern compiled for text and for byte strings'''
+    if isinstance(pattern, bytes):
+        text_pattern, bytes_pattern = pattern.decode('utf-8'), pattern
+    else:
+        text_pattern, bytes_pattern = pattern, pattern.encode('utf-8')
+    return re.compile(text_pattern, flags), re.compile(bytes_pattern, flags)
+
+def _empty(content):
+    return b'' if isinstance(content, bytes) else u''
+
+class RegexStrip(object):
+    '''Removes every match of a regular expression'''
+
+    def __init__(self, pattern, flags=0):
+        self._text_re, self._bytes_re = _compile_both(pattern, flags)
+
+    def __call__(self, content):
+        regex = self._bytes_re if isinstance(content, bytes) else self._text_re
+        return regex.sub(_empty(content), content)
+
+class ByteRanges(object):
+    '''Removes (start, end) ranges of the body, as slice offsets; None for
+    end runs to the end of the body'''
+
+    def __init__(self, ranges):
+        self.ranges = ranges
+
+    def __call__(self, content):
+        length = len(content)
+        spans = []
+        for start, end in self.ranges:
+            start, end, _ = slice(start, end).indices(length)
+            if start < end:
+                spans.append((start, end))
+
+        pieces = []
+        position = 0
+        for start, end in sorted(spans):
+            if start > position:
+                pieces.append(content[position:start])
+            position = max(position, end)
+        pieces.append(content[position:])
+        return _empty(content).join(pieces)
+
+# elements without closing tags
+_void_elements = set(['area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source', 'track', 'wbr'])
+
+class HtmlElements(object):
+    '''Removes the elements with the given tag, and, if attribute is given,
+    only those whose attribute has the given value (or any value, if value
+    is None). Nested elements of the same tag aren't supported'''
+
+    def __init__(self, tag, attribute=None, value=None):
+        start_tag = r'<%s\b' % (re.escape(tag),)
+        if attribute is not None:
+            if value is None:
+                start_tag += r'''(?=[^>]*\s%s\b)''' % (re.escape(attribute),)
+            else:
+                start_tag += r'''(?=[^>]*\s%s\s*=\s*["']?%s(?=["'\s>/]))''' % (re.escape(attribute), re.escape(value))
+        start_tag += r'[^>]*>'
+
+        if tag.lower() in _void_elements:
+            pattern = start_tag
+        else:
+            pattern = r'%s.*?</%s\s*>' % (start_tag, re.escape(tag))
+        self._text_re, self._bytes_re = _compile_both(pattern, re.IGNORECASE | re.DOTALL)
+
+    def __call__(self, content):
+        regex = self._bytes_re if isinstance(content, bytes) else self._text_re
+        return regex.sub(_empty(content), content)
+
+class ChangeDetector(object):
+    '''Rules of (url pattern, [normalizers]); the first rule whose pattern
+    matches (re.search) an entry's url applies'''
+
+    def __init__(self, rules):
+        self.rules = [(re.compile(pattern), normalizers) for pattern, normalizers in rules]
+
+    def applies(self, url):
+        '''Whether any rule matches url'''
+        return any(pattern.search(url) for pattern, _ in self.rules)
+
+    def normalize(self, url, content):
+        '''The content with its volatile parts removed, for hashing'''
+        for pattern, normalizers in self.rules:
+            if pattern.search(url):
+                for normalizer in normalizers:
+                    content = normalizer(content)
+                break
+        return content
@@ -0,0 +1,62 @@
+'''
+Digest algorithms for change detection
+
+(c) 2018 simzes
+
+Digests only tell whether a body changed since the last fetch; they
+aren't relied on for security, so a fast algorithm will do. Available:
+
+--sha256, sha1, md5: from hashlib
+--blake2b, blake2s: from hashlib, where supported (python 3.6+), with
+16-byte digests
+--xxh128, xxh64: non-cryptographic, with the xxhash package installed
+
+Hashers are created with new(name), and fed with update() as data
+arrives.
+'''
+
+import hashlib
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# name of the algorithm entries used before the algorithm was recorded
+LEGACY_ALGORITHM = 'sha256'
+
+def _constructors():
+    constructors = {}
+    for name in ('sha256', 'sha1', 'md5'):
+        constructors[name] = getattr(hashlib, name)
+    for name in ('blake2b', 'blake2s'):
+        if hasattr(hashlib, name):
+            constructors[name] = (lambda fn: lambda: fn(digest_size=16))(getattr(hashlib, name))
+    if xxhash is not None:
+        constructors['xxh64'] = xxhash.xxh64
+        if hasattr(xxhash, 'xxh3_128'):
+            constructors['xxh128'] = xxhash.xxh3_128
+        elif hasattr(xxhash, 'xxh128'):
+            constructors['xxh128'] = xxhash.xxh128
+    return constructors
+
+_algorithms = _constructors()
+
+def available_algorithms():
+    return sorted(_algorithms)
+
+def available(name):
+    '''Whether this process can compute the named algorithm'''
+    return name in _algorithms
+
+def new(name):
+    '''A new hasher for the named algorithm'''
+    try:
+        return _algorithms[name]()
+    except KeyError:
+        raise ValueError("Unsupported digest algorithm: %s (available: %s)" % (name, ', '.join(available_algorithms())))
+
+def digest(name, content):
+    hasher = new(name)
+    hasher.update(content)
+    return hasher.digest()
@@ -0,0 +1,307 @@
+'''
+Local disk tier for large response bodies
+
+(c) 2018 simzes
+
+memcached memory is the expensive part of the cache, and a few large
+bodies displace many small, popular ones. With a DiskTier configured,
+bodies above a size threshold are written to local disk instead, and the
+content entry in memcached holds only a small record of where the body is
+(its location). The metadata and content entries work as before.
+
+Bodies are appended to a log of fixed-size segment files. Each process
+appends to its own slot directory (claimed with a lock file), while any
+process on the host can read any slot: a location names the slot,
+segment and offset directly, and reads go through mmap. A location from
+another host, or into a segment that has since been reclaimed, reads as
+a miss, and the body is refetched.
+
+Space is bounded by max_segments per slot; once exceeded, the oldest
+segment is deleted, and its bodies with it. Each record carries a
+checksum, and on startup a slot's segments are scanned to rebuild its
+index; a damaged tail (from a crash mid-write) ends the scan of its
+segment, and writing continues in a new segment. Files are never
+truncated, as other processes may have them mapped.
+
+Record layout: magic (4 bytes), key length (2), value length (4),
+crc32 of key and value (4), key, value.
+'''
+
+import collections
+import errno
+import fcntl
+import logging
+import mmap
+import os
+import socket
+import struct
+import threading
+import zlib
+
+RECORD_MAGIC = b'WCB1'
+_header = struct.Struct('<4sHII')
+
+# largest number of segments mapped by a process at once
+MAX_MAPPED_SEGMENTS = 64
+
+def _segment_name(segment_id):
+    return 'seg-%010d.log' % (segment_id,)
+
+def _zero_copy(mapped, start, length):
+    '''A view of part of a mapping, without copying it'''
+    try:
+        return memoryview(mapped)[start:start + length]
+    except TypeError:
+        # python 2 mmaps only support the old buffer interface
+        return buffer(mapped, start, length)
+
+class DiskBody(object):
+    '''A body stored in the disk tier, readable without loading it whole'''
+
+    def __init__(self, path, mapped, value_offset, length):
+        self.path = path
+        self._mapped = mapped
+        self.value_offset = value_offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def view(self):
+        '''The body as a memoryview (buffer, under python 2) of the mapping'''
+        return _zero_copy(self._mapped, self.value_offset, self.length)
+
+    def tobytes(self):
+        return self._mapped[self.value_offset:self.value_offset + self.length]
+
+    def chunks(self, chunk_size=65536):
+        end = self.value_offset + self.length
+        for start in range(self.value_offset, end, chunk_size):
+            yield self._mapped[start:min(start + chunk_size, end)]
+
+    def open_file(self):
+        '''A file-like object positioned at the body, for wsgi.file_wrapper'''
+        return DiskBodyFile(self.path, self.value_offset, self.length)
+
+class DiskBodyFile(object):
+    '''File-like object reading one body from a segment file. Exposes
+    fileno() and tell(), so servers can send it with sendfile; they must
+    stop after the body's length (given as the Content-Length)'''
+
+    def __init__(self, path, offset, length):
+        self._file = open(path, 'rb')
+        self._file.seek(offset)
+        self._remaining = length
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def tell(self):
+        return self._file.tell()
+
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+class DiskTier(object):
+    '''Log-structured store of bodies on local disk'''
+
+    def __init__(self, root, segment_bytes=64 << 20, max_segments=16, min_body_bytes=256 << 10, max_slots=64):
+        self.root = root
+        self.segment_bytes = segment_bytes
+        self.max_segments = max_segments
+        self.min_body_bytes = min_body_bytes
+        self.host = socket.gethostname()
+
+        self._lock = threading.Lock()
+        # key -> (segment id, record offset, value length), for this slot
+        self._index = {}
+        # segment id -> keys written to it, oldest segment first
+        self._segments = collections.OrderedDict()
+        self._active = None
+        self._active_size = 0
+
+        self._maps = collections.OrderedDict()
+        self._maps_lock = threading.Lock()
+
+        self.reclaimed_segments = 0
+        self.recovered_records = 0
+
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        self._claim_slot(max_slots)
+        self._recover()
+
+    def _claim_slot(self, max_slots):
+        for slot in range(max_slots):
+            lock_file = open(os.path.join(self.root, 'slot-%d.lock' % (slot,)), 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                lock_file.close()
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    continue
+                raise
+
+            self.slot = slot
+            self._lock_file = lock_file
+            self.slot_dir = os.path.join(self.root, 'slot-%d' % (slot,))
+            if not os.path.isdir(self.slot_dir):
+                os.makedirs(self.slot_dir)
+            return
+
+        raise RuntimeError("No free disk tier slot under %s" % (self.root,))
+
+    def _segment_path(self, segment_id, slot=None):
+        slot_dir = self.slot_dir if slot is None else os.path.join(self.root, 'slot-%d' % (slot,))
+        return os.path.join(slot_dir, _segment_name(segment_id))
+
+    def _recover(self):
+        '''Rebuilds the index from the slot's segments'''
+        segment_ids = sorted(
+            int(name[4:-4]) for name in os.listdir(self.slot_dir)
+            if name.startswith('seg-') and name.endswith('.log'))
+
+        for segment_id in segment_ids:
+            keys = self._segments[segment_id] = []
+            with open(self._segment_path(segment_id), 'rb') as segment:
+                offset = 0
+                while True:
+                    header = segment.read(_header.size)
+                    if len(header) < _header.size:
+                        break
+                    magic, key_len, value_len, crc = _header.unpack(header)
+                    if magic != RECORD_MAGIC:
+                        break
+                    payload = segment.read(key_len + value_len)
+                    if len(payload) < key_len + value_len or (zlib.crc32(payload) & 0xffffffff) != crc:
+                        logging.warn("Disk tier segment %s damaged at offset %d", segment_id, offset)
+                        break
+
+                    key = payload[:key_len].decode('utf-8')
+                    self._index[key] = (segment_id, offset, value_len)
+                    keys.append(key)
+                    self.recovered_records += 1
+                    offset += _header.size + key_len + value_len
+
+        # always continue in a fresh segment; the last one may end in a
+        # damaged record
+        next_id = (segment_ids[-1] + 1) if segment_ids else 0
+        self._open_segment(next_id)
+        self._reclaim()
+
+    def _open_segment(self, segment_id):
+        if self._active is not None:
+            os.close(self._active[1])
+        fd = os.open(self._segment_path(segment_id), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._active = (segment_id, fd)
+        self._active_size = 0
+        self._segments[segment_id] = []
+
+    def _reclaim(self):
+        while len(self._segments) > self.max_segments:
+            segment_id, keys = self._segments.popitem(last=False)
+            for key in keys:
+                if self._index.get(key, (None,))[0] == segment_id:
+                    del self._index[key]
+            path = self._segment_path(segment_id)
+            with self._maps_lock:
+                self._maps.pop(path, None)
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            self.reclaimed_segments += 1
+
+    def accepts(self, content):
+        return len(content) >= self.min_body_bytes
+
+    def put(self, key, value):
+        '''Appends a body, returning its location'''
+        key_bytes = key.encode('utf-8') if not isinstance(key, bytes) else key
+        value = bytes(value)
+        crc = zlib.crc32(key_bytes + value) & 0xffffffff
+        record = _header.pack(RECORD_MAGIC, len(key_bytes), len(value), crc) + key_bytes + value
+
+        with self._lock:
+            if self._active_size and self._active_size + len(record) > self.segment_bytes:
+                self._open_segment(self._active[0] + 1)
+                self._reclaim()
+
+            segment_id, fd = self._active
+            offset = self._active_size
+            os.write(fd, record)
+            self._active_size += len(record)
+
+            self._index[key] = (segment_id, offset, len(value))
+            self._segments[segment_id].append(key)
+
+        return {
+            'host': self.host,
+            'slot': self.slot,
+            'segment': segment_id,
+            'offset': offset,
+            'length': len(value),
+            'key': key,
+        }
+
+    def _map(self, path, min_length):
+        '''A read-only mapping of the file, at least min_length long'''
+        with self._maps_lock:
+            mapped = self._maps.pop(path, None)
+            if mapped is None or len(mapped) < min_length:
+                with open(path, 'rb') as segment:
+                    mapped = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[path] = mapped
+            while len(self._maps) > MAX_MAPPED_SEGMENTS:
+                # dropped mappings are unmapped once no body refers to them
+                self._maps.popitem(last=False)
+            return mapped
+
+    def get(self, location):
+        '''Returns a DiskBody for a location, or None if the body is no
+        longer (or was never) available on this host'''
+        if location.get('host') != self.host:
+            return None
+
+        path = self._segment_path(location['segment'], location['slot'])
+        key = location['key']
+        key_bytes = key.encode('utf-8') if not isinstance(key, bytes) else key
+        offset = location['offset']
+        value_offset = offset + _header.size + len(key_bytes)
+
+        # a mapping outlives its file; the segment may have been reclaimed
+        # by the slot's owner since it was mapped
+        if not os.path.exists(path):
+            with self._maps_lock:
+                self._maps.pop(path, None)
+            return None
+        try:
+            mapped = self._map(path, value_offset + location['length'])
+        except (IOError, OSError, ValueError):
+            return None
+        if len(mapped) < value_offset + location['length']:
+            return None
+
+        magic, key_len, value_len, _ = _header.unpack(mapped[offset:offset + _header.size])
+        if magic != RECORD_MAGIC or value_len != location['length'] or \
+                mapped[offset + _header.size:value_offset] != key_bytes:
+            return None
+
+        return DiskBody(path, mapped, value_offset, value_len)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'slot': self.slot,
+                'segments': len(self._segments),
+                'entries': len(self._index),
+                'active_bytes': self._active_size,
+                'reclaimed_segments': self.reclaimed_segments,
+            }
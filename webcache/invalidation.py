@@ -0,0 +1,114 @@
+'''
+Invalidation of cache entries through generation counters
+
+(c) 2018 simzes
+
+Purging by deleting keys would need a scan of memcached for everything
+under a prefix or carrying a tag, and flushing all of memcached sends
+every url to the origin at once. Instead, invalidation bumps a counter in
+memcached, and entries stop matching once the counter moves on:
+
+--url and prefix counters are folded into the url used for cache keys,
+so a bump moves all affected urls onto new keys; the old entries are
+never looked up again, and age out of memcached
+--tag counters can't be known before the entry is loaded (tags come
+from the origin's response), so each entry records the counters of its
+tags when fetched, and is treated as expired once any of them moves
+
+Either way, a lookup costs one get_multi for the counters, and an
+invalidation one increment.
+
+A missing url counter reads as 0, as most urls are never invalidated.
+Missing prefix and tag counters are initialized from the clock, so that
+a counter evicted from memcached can never return to an old value.
+'''
+
+import time
+
+import keynorm
+from backends import NotFound
+
+def url_generation_key(url):
+    return keynorm.hash_long_key("gen_url_%s" % (url,))
+
+def prefix_generation_key(prefix):
+    return keynorm.hash_long_key("gen_prefix_%s" % (prefix,))
+
+def tag_generation_key(tag):
+    return keynorm.hash_long_key("gen_tag_%s" % (tag,))
+
+def _initial_generation():
+    return int(time.time() * 1000)
+
+def read_generations(mc_client, keys, initialize=()):
+    '''Returns a table of key -> counter value for the given generation
+    keys. Keys in initialize are created if missing; others read as 0'''
+    generations = mc_client.get_multi(keys) if keys else {}
+
+    for key in keys:
+        if key in generations:
+            continue
+        if key in initialize:
+            mc_client.add(key, _initial_generation())
+            generations[key] = mc_client.get(key) or 0
+        else:
+            generations[key] = 0
+
+    return generations
+
+def bump_generation(mc_client, key):
+    '''Advances a generation counter, returning the new value'''
+    for _ in range(3):
+        try:
+            return mc_client.incr(key)
+        except NotFound:
+            if mc_client.add(key, _initial_generation()):
+                return mc_client.get(key)
+    raise RuntimeError("Couldn't advance generation for %s" % (key,))
+
+def matching_prefixes(url, prefixes):
+    return [prefix for prefix in prefixes if url.startswith(prefix)]
+
+def generation_url(mc_client, url, prefixes):
+    '''The url, with the generations of the url and its matching prefixes
+    folded in. Costs one get_multi'''
+    return generation_urls(mc_client, [url], prefixes)[0]
+
+def generation_urls(mc_client, urls, prefixes):
+    '''generation_url for several urls, with a single get_multi'''
+    url_keys = [[url_generation_key(url)] + [prefix_generation_key(p) for p in matching_prefixes(url, prefixes)]
+        for url in urls]
+    prefix_keys = set(key for keys in url_keys for key in keys[1:])
+    all_keys = list(set(key for keys in url_keys for key in keys))
+    generations = read_generations(mc_client, all_keys, initialize=prefix_keys)
+
+    return ["%s#g%s" % (url, '.'.join(str(generations[k]) for k in keys))
+        for url, keys in zip(urls, url_keys)]
+
+def generation_url_and_tags(mc_client, url, prefixes, tags):
+    '''generation_url, along with a table of tag -> current generation for
+    the given tags, with a single get_multi. Missing tag generations read
+    as 0, which no recorded generation matches, rather than being created'''
+    url_keys = [url_generation_key(url)] + [prefix_generation_key(p) for p in matching_prefixes(url, prefixes)]
+    tag_keys = dict((tag_generation_key(tag), tag) for tag in tags)
+    generations = read_generations(mc_client, list(set(url_keys) | set(tag_keys)), initialize=set(url_keys[1:]))
+
+    return ("%s#g%s" % (url, '.'.join(str(generations[k]) for k in url_keys)),
+        dict((tag, generations[key]) for key, tag in tag_keys.items()))
+
+def parse_tags(header_value):
+    '''Tags from a space-separated surrogate key header'''
+    if not header_value:
+        return []
+    return header_value.split()
+
+def tag_generations(mc_client, tags):
+    '''Table of tag -> current generation, for recording in an entry'''
+    keys = dict((tag_generation_key(tag), tag) for tag in tags)
+    generations = read_generations(mc_client, list(keys), initialize=keys)
+    return dict((keys[key], value) for key, value in generations.items())
+
+def tags_current(mc_client, recorded):
+    '''Whether none of the tags in a recorded table of tag -> generation has
+    been invalidated since it was recorded'''
+    return tag_generations(mc_client, recorded) == recorded
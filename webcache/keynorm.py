@@ -0,0 +1,148 @@
+'''
+Normalization of request urls into cache keys
+
+(c) 2018 simzes
+
+Several spellings of a url often name the same content: reordered query
+parameters, tracking parameters, differences in percent-encoding, or
+case in the host. Left alone, each spelling gets its own cache entry and
+its own request to the origin. A KeyNormalizer maps all such spellings
+onto one canonical url, which the webcache uses for its cache keys (the
+origin is still asked for the url as requested).
+
+memcached also limits keys to 250 bytes, without spaces or control
+characters; hash_long_key() folds any key that would break these rules
+into a fixed-length digest.
+'''
+
+import fnmatch
+import hashlib
+import re
+
+try:
+    from urllib.parse import urlsplit, urlunsplit, quote
+except ImportError:
+    from urlparse import urlsplit, urlunsplit
+    from urllib import quote
+
+# memcached's limit on the length of a key
+MAX_KEY_LENGTH = 250
+
+# query parameters that only track where a visitor came from
+DEFAULT_DROP_PARAMS = (
+    'utm_*',
+    'fbclid',
+    'gclid',
+    'dclid',
+    'msclkid',
+    'mc_cid',
+    'mc_eid',
+    '_ga',
+)
+
+# characters that never need to be percent-encoded (rfc 3986, section 2.3)
+UNRESERVED = frozenset(
+    'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+
+# characters left as-is when (re-)encoding paths and query components
+PATH_SAFE = "/:@!$&'()*+,;=-._~%"
+QUERY_SAFE = ":@!$'()*+,;/?-._~%"
+
+_escape_re = re.compile('%([0-9a-fA-F]{2})')
+_illegal_key_re = re.compile('[\x00-\x20\x7f]')
+
+def _canonical_escape(match):
+    char = chr(int(match.group(1), 16))
+    if char in UNRESERVED:
+        return char
+    return '%' + match.group(1).upper()
+
+def canonicalize_encoding(component, safe):
+    '''Rewrites a url component so that equivalent encodings compare equal:
+    escaped unreserved characters are decoded, other escapes are
+    uppercased, and characters that need escaping are escaped'''
+    component = _escape_re.sub(_canonical_escape, component)
+    # a lone '%' that doesn't start an escape has to be escaped itself
+    component = re.sub('%(?![0-9A-F]{2})', '%25', component)
+    return quote(component, safe=safe)
+
+def hash_long_key(key):
+    '''Returns the key unchanged if memcached will accept it, or a
+    fixed-length replacement made from the key's namespace (the part up to
+    and including the first underscore) and a digest of the full key'''
+    if len(key) <= MAX_KEY_LENGTH and not _illegal_key_re.search(key):
+        return key
+
+    namespace, sep, _ = key.partition('_')
+    if not sep or _illegal_key_re.search(namespace):
+        namespace = ''
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return "%s_~%s" % (namespace, hashlib.sha1(key).hexdigest())
+
+class KeyNormalizer(object):
+    '''Maps a request url onto a canonical url for use in cache keys.
+
+    --query parameters are sorted by name, if sort_query is set; the
+    sort is stable, so repeated parameters keep their relative order
+    --parameters matching a pattern in drop_params are removed; if
+    keep_params is given, only matching parameters are retained.
+    Patterns are shell-style (fnmatch) and case-insensitive
+    --percent-encoding is canonicalized in the path and query
+    --the host is lowercased and a default port is removed, for
+    absolute urls; the path is lowercased only if lowercase_path is set,
+    as most origins treat paths as case-sensitive
+    --fragments are dropped, as they are never sent to the origin
+    '''
+
+    def __init__(self, sort_query=True, drop_params=DEFAULT_DROP_PARAMS, keep_params=None, lowercase_path=False):
+        self.sort_query = sort_query
+        self.drop_params = [p.lower() for p in (drop_params or ())]
+        self.keep_params = None
+        if keep_params is not None:
+            self.keep_params = [p.lower() for p in keep_params]
+        self.lowercase_path = lowercase_path
+
+    def _retain_param(self, name):
+        name = name.lower()
+        if self.keep_params is not None:
+            if not any(fnmatch.fnmatchcase(name, p) for p in self.keep_params):
+                return False
+        return not any(fnmatch.fnmatchcase(name, p) for p in self.drop_params)
+
+    def normalize_query(self, query):
+        params = []
+        for param in query.split('&'):
+            if not param:
+                continue
+            name, sep, value = param.partition('=')
+            name = canonicalize_encoding(name, QUERY_SAFE)
+            if not self._retain_param(name):
+                continue
+            params.append((name, sep + canonicalize_encoding(value, QUERY_SAFE)))
+
+        if self.sort_query:
+            params.sort(key=lambda param: param[0])
+
+        return '&'.join(name + value for name, value in params)
+
+    def normalize_path(self, path):
+        path = canonicalize_encoding(path or '/', PATH_SAFE)
+        if self.lowercase_path:
+            path = path.lower()
+        return path
+
+    def normalize(self, url):
+        scheme, netloc, path, query, _ = urlsplit(url)
+
+        netloc = netloc.lower()
+        if (scheme, netloc[-3:]) == ('http', ':80') or (scheme, netloc[-4:]) == ('https', ':443'):
+            netloc = netloc.rsplit(':', 1)[0]
+
+        return urlunsplit((
+            scheme.lower(),
+            netloc,
+            self.normalize_path(path),
+            self.normalize_query(query),
+            '',
+            ))
@@ -0,0 +1,92 @@
+'''
+Cleanup of content entries that no metadata entry refers to anymore
+
+(c) 2018 simzes
+
+Each update of an entry writes its body under a new content key, and
+points the metadata at it; the previous body stays in memcached, where
+nothing will ever look it up again. Expiry times bound how long such
+bodies linger, but under memory pressure they are evicted alongside live
+entries until then.
+
+A ContentReaper deletes superseded bodies once the metadata update that
+replaced them has succeeded. Deletes are best-effort and happen in a
+background thread, after a short delay, so that requests that loaded the
+old metadata just before the update can still read the old body.
+'''
+
+import collections
+import logging
+import threading
+import time
+
+class ContentReaper(object):
+    '''Deletes cache keys in the background, delay_secs after they are
+    queued. At most max_pending keys are held; beyond that, keys are left
+    to expire on their own.
+
+    If synchronous is set, keys are deleted immediately in the calling
+    thread instead (for tests and tools).'''
+
+    def __init__(self, client_fn, delay_secs=5, max_pending=10000, synchronous=False):
+        self._client_fn = client_fn
+        self.delay_secs = delay_secs
+        self.max_pending = max_pending
+        self.synchronous = synchronous
+
+        self._pending = collections.deque()
+        self._condition = threading.Condition()
+        self._thread = None
+
+        self.deleted = 0
+        self.dropped = 0
+
+    def delete_later(self, keys):
+        '''Queues the keys for deletion'''
+        keys = [k for k in keys if k]
+        if not keys:
+            return
+
+        if self.synchronous:
+            self._delete(self._client_fn(), keys)
+            return
+
+        with self._condition:
+            if len(self._pending) + len(keys) > self.max_pending:
+                self.dropped += len(keys)
+                return
+
+            due = time.time() + self.delay_secs
+            for key in keys:
+                self._pending.append((due, key))
+            self._start()
+            self._condition.notify()
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="content-reaper")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        mc_client = self._client_fn()
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                due, key = self._pending[0]
+                wait = due - time.time()
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                self._pending.popleft()
+
+            self._delete(mc_client, [key])
+
+    def _delete(self, mc_client, keys):
+        for key in keys:
+            try:
+                mc_client.delete(key)
+                self.deleted += 1
+            except Exception:
+                logging.exception("Couldn't delete superseded content %s", key)
@@ -0,0 +1,183 @@
+'''
+In-process counters and histograms, in Prometheus text format
+
+(c) 2018 simzes
+
+Requests are counted on the threads serving them, so recording has to
+be cheap and mustn't make threads wait on each other. Each thread
+records into its own shard (a table of counts, and of histogram buckets),
+which only it writes to; rendering sums the shards of every thread that
+has recorded anything. Shards are kept after their threads end, so counts
+never go backwards.
+
+Metrics are named and labelled as in Prometheus. Labels are given as a
+tuple of (name, value) pairs, so that recording doesn't build dicts:
+
+    METRICS.inc('webcache_responses_total', labels=(('source', 'hit'),))
+    METRICS.observe('webcache_phase_seconds', 0.002, (('phase', 'lookup'),))
+
+The most requested urls are tracked per shard with a SpaceSaving sketch,
+and merged when rendered, as the webcache_hot_url_requests gauge.
+'''
+
+import bisect
+import threading
+
+import sketches
+
+# upper bounds of the default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class _Shard(object):
+    '''One thread's counts'''
+
+    def __init__(self, top_capacity):
+        # (name, labels) -> count
+        self.counts = {}
+        # (name, labels) -> [count per bucket..., count beyond the last, sum]
+        self.histograms = {}
+        self.urls = sketches.SpaceSaving(top_capacity)
+
+class Metrics(object):
+    '''Counters and histograms recorded by any number of threads.
+
+    Metrics are declared with counter() and histogram() before they are
+    recorded; top_urls is the number of hot urls rendered, and
+    top_capacity the number each thread tracks.'''
+
+    def __init__(self, top_urls=20, top_capacity=256):
+        self.top_urls = top_urls
+        self.top_capacity = top_capacity
+
+        # name -> (type, help, buckets), in declaration order
+        self._declared = {}
+        self._order = []
+        self._local = threading.local()
+        self._shards = []
+        self._lock = threading.Lock()
+
+    def counter(self, name, help):
+        self._declare(name, 'counter', help, None)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        self._declare(name, 'histogram', help, tuple(sorted(buckets)))
+
+    def _declare(self, name, kind, help, buckets):
+        if name not in self._declared:
+            self._order.append(name)
+        self._declared[name] = (kind, help, buckets)
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = _Shard(self.top_capacity)
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def inc(self, name, amount=1, labels=()):
+        counts = self._shard().counts
+        key = (name, labels)
+        counts[key] = counts.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        histograms = self._shard().histograms
+        key = (name, labels)
+        buckets = self._declared[name][2]
+        counts = histograms.get(key)
+        if counts is None:
+            counts = histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(buckets, value)] += 1
+        counts[-1] += value
+
+    def note_url(self, url):
+        self._shard().urls.increment(url)
+
+    def _snapshot(self):
+        '''The shards' counts summed: (counts, histograms, url counts). A
+        shard's thread may be recording as it is read; the copies are
+        retried in the rare case one catches a table mid-update'''
+        with self._lock:
+            shards = list(self._shards)
+
+        counts = {}
+        histograms = {}
+        urls = {}
+        for shard in shards:
+            while True:
+                try:
+                    shard_counts = list(shard.counts.items())
+                    shard_histograms = [(key, list(values)) for key, values in list(shard.histograms.items())]
+                    shard_urls = shard.urls.top()
+                    break
+                except (RuntimeError, KeyError):
+                    continue
+
+            for key, count in shard_counts:
+                counts[key] = counts.get(key, 0) + count
+            for key, values in shard_histograms:
+                total = histograms.get(key)
+                if total is None:
+                    histograms[key] = values
+                else:
+                    histograms[key] = [a + b for a, b in zip(total, values)]
+            for url, count, _ in shard_urls:
+                urls[url] = urls.get(url, 0) + count
+
+        return counts, histograms, urls
+
+    def value(self, name, labels=()):
+        '''The current total of a counter, or the number of observations
+        of a histogram'''
+        counts, histograms, _ = self._snapshot()
+        if (name, labels) in histograms:
+            return sum(histograms[(name, labels)][:-1])
+        return counts.get((name, labels), 0)
+
+    def hot_urls(self):
+        '''(url, request count) pairs for the most requested urls, most
+        requested first; counts are estimates'''
+        _, _, urls = self._snapshot()
+        return self._ranked(urls)
+
+    def _ranked(self, urls):
+        return sorted(urls.items(), key=lambda item: item[1], reverse=True)[:self.top_urls]
+
+    def render(self):
+        '''All metrics, in the Prometheus text exposition format'''
+        counts, histograms, urls = self._snapshot()
+        lines = []
+        for name in self._order:
+            kind, help, buckets = self._declared[name]
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            if kind == 'counter':
+                for labels, count in sorted((key[1], count) for key, count in counts.items() if key[0] == name):
+                    lines.append('%s%s %s' % (name, _format_labels(labels), _format_value(count)))
+            else:
+                for labels, values in sorted((key[1], values) for key, values in histograms.items() if key[0] == name):
+                    cumulative = 0
+                    for bound, count in zip(buckets + ('+Inf',), values[:-1]):
+                        cumulative += count
+                        lines.append('%s_bucket%s %d' % (name, _format_labels(labels + (('le', _format_value(bound)),)), cumulative))
+                    lines.append('%s_sum%s %s' % (name, _format_labels(labels), _format_value(values[-1])))
+                    lines.append('%s_count%s %d' % (name, _format_labels(labels), cumulative))
+
+        lines.append('# HELP webcache_hot_url_requests Estimated requests for the most requested urls')
+        lines.append('# TYPE webcache_hot_url_requests gauge')
+        for url, count in self._ranked(urls):
+            lines.append('webcache_hot_url_requests%s %d' % (_format_labels((('url', url),)), count))
+
+        return '\n'.join(lines) + '\n'
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (name, _escape(value)) for name, value in labels),)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value):
+    return repr(value) if isinstance(value, float) else str(value)
@@ -0,0 +1,167 @@
+'''
+Prefetching of the resources embedded in cached pages
+
+(c) 2018 simzes
+
+A browser requests a page's images, scripts and stylesheets right after
+the page itself, and when the page was a miss, those usually miss too,
+each paying for its own trip to the origin. A Prefetcher looks through
+pages fetched from the origin for same-origin src and href references,
+and warms the ones that aren't cached in the background, so that they
+are hot by the time the browser asks for them.
+
+Only references matching one of the configured patterns (regular
+expressions on the path) are considered; they should match the paths
+Apache routes through the webcache. Pages are scanned, and their
+references checked (with one batched lookup per page), on the
+prefetcher's worker threads, which also bound how many warm-ups run at
+once.
+'''
+
+import logging
+import re
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from urllib.parse import urljoin, urlsplit
+except ImportError:
+    from urlparse import urljoin, urlsplit
+
+_reference_re = re.compile(r'''\b(?:src|href)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>"']+))''', re.IGNORECASE)
+
+def find_references(html, page_url, host=None):
+    '''The same-origin paths (with queries) referenced by src and href
+    attributes in html, in order of first appearance. Relative references
+    are resolved against page_url; absolute ones must be for host'''
+    if isinstance(html, bytes):
+        html = html.decode('latin-1')
+
+    found = []
+    seen = set()
+    for match in _reference_re.finditer(html):
+        reference = (match.group(1) or match.group(2) or match.group(3) or '').strip()
+        if not reference or reference.startswith('#'):
+            continue
+
+        parts = urlsplit(urljoin(page_url, reference))
+        if parts.scheme not in ('', 'http', 'https'):
+            continue
+        if parts.netloc and parts.netloc != host:
+            continue
+
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        if path and path not in seen:
+            seen.add(path)
+            found.append(path)
+
+    return found
+
+class Prefetcher(object):
+    '''Warms the uncached resources referenced by pages, on a pool of
+    worker threads.
+
+    missing_fn takes the page's request and a list of paths, and returns
+    those that need warming (see webcache.uncached_urls); warm_fn takes
+    the page's request and a path, and fetches it into the cache (see
+    webcache.warm_url).'''
+
+    def __init__(self, missing_fn, warm_fn, patterns, max_references=32,
+            concurrency=4, max_pending=256):
+        self.missing_fn = missing_fn
+        self.warm_fn = warm_fn
+        self.patterns = [re.compile(p) for p in patterns]
+        self.max_references = max_references
+        self.concurrency = concurrency
+
+        self._queue = queue.Queue(max_pending)
+        self._lock = threading.Lock()
+        # paths being warmed, so concurrent pages don't warm them twice
+        self._in_flight = set()
+        self._threads = []
+
+        self.pages = 0
+        self.warmed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def references(self, html, page_url, host=None):
+        '''The references in a page that are eligible for prefetching'''
+        eligible = [path for path in find_references(html, page_url, host)
+            if path != page_url and any(p.search(path) for p in self.patterns)]
+        return eligible[:self.max_references]
+
+    def page_fetched(self, request, html):
+        '''Queues a page fetched from the origin for scanning'''
+        self._put(('page', request, html))
+
+    def _put(self, job):
+        try:
+            self._queue.put_nowait(job)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def run_job(self, job):
+        kind, request, payload = job
+        try:
+            if kind == 'page':
+                self.pages += 1
+                references = self.references(payload, request.url, request.headers.get('Host'))
+                if references:
+                    for path in self.missing_fn(request, references):
+                        with self._lock:
+                            if path in self._in_flight:
+                                continue
+                            self._in_flight.add(path)
+                        if not self._put(('warm', request, path)):
+                            with self._lock:
+                                self._in_flight.discard(path)
+            else:
+                try:
+                    self.warm_fn(request, payload)
+                    self.warmed += 1
+                finally:
+                    with self._lock:
+                        self._in_flight.discard(payload)
+        except Exception:
+            self.failed += 1
+            logging.exception("Prefetch for %s failed", request.url)
+
+    def run_pending(self):
+        '''Runs the queued jobs in the calling thread, including the warm-ups
+        they queue; returns how many ran'''
+        ran = 0
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                return ran
+            self.run_job(job)
+            ran += 1
+
+    def start(self):
+        self._threads = [threading.Thread(target=self._worker_loop, name="prefetch-worker-%d" % (i,))
+            for i in range(self.concurrency)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _worker_loop(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            self.run_job(job)
@@ -0,0 +1,339 @@
+'''
+On-demand profiling of a running process
+
+(c) 2018 simzes
+
+When a process's throughput drops, the traces say which phases got slow,
+but not where the CPU went. A Profiler is idle until started (through
+the profile admin path, or a signal), and then profiles the process in
+one of two modes:
+
+--sample: a thread samples the stacks of all the other threads every
+interval seconds, and counts each stack; written as collapsed stacks
+(one "frame;frame;frame count" line per stack, root first), the input of
+flamegraph.pl and speedscope
+--cprofile: a sample_rate fraction of requests are run under cProfile,
+each thread into a profile of its own; the profiles are added together
+and written as a pstats file (for pstats, snakeviz or flameprof)
+
+Profiling stops after the given seconds, or when stopped, and writes its
+file to the profiler's directory, named for the process and the time.
+
+The overhead is bounded by max_overhead. The sampler measures the time
+each sample takes, and sleeps long enough between samples to hold that
+under max_overhead of the elapsed time. The cProfile mode compares the
+mean time of profiled and unprofiled requests, and lowers the rate of
+profiled requests to hold the time they add, over all requests, under
+max_overhead. Either way, the overhead measured is reported
+in the status, and logged with the file written.
+'''
+
+import cProfile
+import collections
+import logging
+import os
+import pstats
+import random
+import signal
+import sys
+import threading
+import time
+
+MODES = ('sample', 'cprofile')
+
+class StackSampler(object):
+    '''Counts the stacks of the other threads, every interval seconds, or
+    less often if that would take more than max_overhead of the time'''
+
+    def __init__(self, interval=0.005, max_overhead=0.02):
+        self.interval = interval
+        self.max_overhead = max_overhead
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.sampling_secs = 0.0
+
+        self._labels = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+        self._stopped = None
+
+    def start(self):
+        self._started = time.time()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._stopped = time.time()
+
+    @property
+    def overhead(self):
+        '''The fraction of the elapsed time spent sampling'''
+        elapsed = (self._stopped or time.time()) - self._started
+        return self.sampling_secs / elapsed if elapsed > 0 else 0.0
+
+    def _run(self):
+        own = threading.current_thread().ident
+        while not self._stop.is_set():
+            started = time.time()
+            self.sample(own)
+            taken = time.time() - started
+            self.sampling_secs += taken
+            self._stop.wait(max(self.interval, taken * (1 / self.max_overhead - 1)))
+
+    def sample(self, own=None):
+        '''Counts the current stack of each thread but own'''
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            stack.reverse()
+            self.stacks[';'.join(stack)] += 1
+        self.samples += 1
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+        return label
+
+    def write(self, path):
+        with open(path, 'w') as collapsed:
+            for stack, count in sorted(self.stacks.items()):
+                collapsed.write('%s %d\n' % (stack, count))
+
+class CallProfiler(object):
+    '''Runs a sample_rate fraction of calls under cProfile, lowering the
+    rate when profiled calls add more than max_overhead to the time of all
+    calls'''
+
+    # calls of each kind needed before the overhead is estimated
+    min_calls = 20
+
+    def __init__(self, sample_rate=0.01, max_overhead=0.02, rng=None):
+        self.sample_rate = self.initial_rate = sample_rate
+        self.max_overhead = max_overhead
+        self._random = rng or random.Random()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._profiles = []
+
+        self.profiled_calls = 0
+        self.profiled_secs = 0.0
+        self.plain_calls = 0
+        self.plain_secs = 0.0
+        self.active = 0
+
+    def begin(self):
+        '''Starts profiling the current call if it is sampled, returning its
+        profile; None otherwise'''
+        if self._random.random() >= self.sample_rate:
+            return None
+        profile = getattr(self._local, 'profile', None)
+        with self._lock:
+            if profile is None:
+                profile = self._local.profile = cProfile.Profile()
+                self._profiles.append(profile)
+            self.active += 1
+        profile.enable()
+        return profile
+
+    def finish(self, profile, seconds):
+        '''Notes a call that took seconds, and stops its profile, if any'''
+        if profile is not None:
+            profile.disable()
+        with self._lock:
+            if profile is not None:
+                self.active -= 1
+                self.profiled_calls += 1
+                self.profiled_secs += seconds
+            else:
+                self.plain_calls += 1
+                self.plain_secs += seconds
+            slowdown = self.slowdown
+            if slowdown:
+                # profiling a fraction r of calls adds about r * slowdown
+                self.sample_rate = min(self.initial_rate, self.max_overhead / slowdown)
+
+    @property
+    def slowdown(self):
+        '''How much longer profiled calls take than the others, as a
+        fraction of the others' time; None until there are enough calls to
+        tell'''
+        if self.profiled_calls < self.min_calls or self.plain_calls < self.min_calls or not self.plain_secs:
+            return None
+        plain_mean = self.plain_secs / self.plain_calls
+        return max(0.0, self.profiled_secs / self.profiled_calls / plain_mean - 1)
+
+    @property
+    def overhead(self):
+        '''The time profiling added, as a fraction of the time all calls
+        took; None until there are enough calls to tell'''
+        if self.profiled_calls < self.min_calls or self.plain_calls < self.min_calls:
+            return None
+        plain_mean = self.plain_secs / self.plain_calls
+        added = max(0.0, self.profiled_secs - plain_mean * self.profiled_calls)
+        total = self.profiled_secs + self.plain_secs
+        return added / total if total > 0 else 0.0
+
+    def write(self, path, wait_secs=5):
+        '''Writes the profiles of all threads, added together, once the calls
+        being profiled have finished (or after wait_secs); returns whether
+        there were any'''
+        deadline = time.time() + wait_secs
+        while self.active and time.time() < deadline:
+            time.sleep(0.01)
+        with self._lock:
+            profiles = list(self._profiles)
+        if not self.profiled_calls:
+            return False
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+        return True
+
+class Profiler(object):
+    '''Profiles the process on demand, writing to directory. Options are
+    the defaults of start(), and are passed to the StackSampler or the
+    CallProfiler'''
+
+    def __init__(self, directory, mode='sample', seconds=30, interval=0.005, sample_rate=0.01,
+            max_overhead=0.02, rng=None):
+        if mode not in MODES:
+            raise ValueError("Unknown profiling mode: %s" % (mode,))
+        self.directory = directory
+        self.mode = mode
+        self.seconds = seconds
+        self.interval = interval
+        self.sample_rate = sample_rate
+        self.max_overhead = max_overhead
+        self._random = rng
+
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._calls = None
+        self._timer = None
+        self._started = None
+        self.last_path = None
+
+    @property
+    def running(self):
+        return self._sampler is not None or self._calls is not None
+
+    def start(self, mode=None, seconds=None, **options):
+        '''Starts profiling, stopping after seconds (None for the default,
+        0 to run until stopped). Returns False if already profiling'''
+        mode = mode or self.mode
+        if mode not in MODES:
+            raise ValueError("Unknown profiling mode: %s" % (mode,))
+        seconds = self.seconds if seconds is None else seconds
+        max_overhead = options.get('max_overhead', self.max_overhead)
+
+        with self._lock:
+            if self.running:
+                return False
+            if mode == 'sample':
+                self._sampler = StackSampler(options.get('interval', self.interval), max_overhead)
+                self._sampler.start()
+            else:
+                self._calls = CallProfiler(options.get('sample_rate', self.sample_rate), max_overhead, self._random)
+            self._started = time.time()
+            if seconds:
+                self._timer = threading.Timer(seconds, self.stop)
+                self._timer.daemon = True
+                self._timer.start()
+        logging.info("Profiling started: %s", self.status())
+        return True
+
+    def stop(self):
+        '''Stops profiling, and writes what was collected; returns the path
+        written, or None if nothing was'''
+        with self._lock:
+            sampler, calls, timer = self._sampler, self._calls, self._timer
+            if sampler is None and calls is None:
+                return None
+            status = self.status()
+            self._sampler = self._calls = self._timer = None
+        if timer is not None:
+            timer.cancel()
+
+        name = 'webcache-%d-%s' % (os.getpid(), time.strftime('%Y%m%d-%H%M%S', time.localtime(self._started)))
+        path = None
+        if sampler is not None:
+            sampler.stop()
+            status['overhead'] = round(sampler.overhead, 5)
+            if sampler.samples:
+                path = os.path.join(self.directory, name + '.collapsed')
+                sampler.write(path)
+        else:
+            path = os.path.join(self.directory, name + '.pstats')
+            if not calls.write(path):
+                path = None
+
+        self.last_path = path
+        logging.info("Profiling stopped, written to %s: %s", path, status)
+        return path
+
+    def toggle(self):
+        '''Starts profiling with the defaults, or stops it'''
+        if not self.start():
+            self.stop()
+
+    def toggle_on(self, signum):
+        '''Toggles profiling on each signum. The handler runs in the main
+        thread, between any two of its instructions, possibly with _lock
+        held, so it only sets an event; a thread of its own toggles'''
+        toggle_requested = threading.Event()
+
+        def run():
+            while True:
+                toggle_requested.wait()
+                toggle_requested.clear()
+                self.toggle()
+
+        thread = threading.Thread(target=run, name='profiler-toggle')
+        thread.daemon = True
+        thread.start()
+        signal.signal(signum, lambda signum, frame: toggle_requested.set())
+
+    def begin(self):
+        '''Called as a request starts; returns what to pass to finish(), if
+        the request is profiled'''
+        calls = self._calls
+        if calls is None:
+            return None
+        profile = calls.begin()
+        return (calls, profile) if profile is not None else None
+
+    def finish(self, profiled, seconds):
+        '''Called as a request ends, with what begin() returned, and how long
+        it took'''
+        if profiled is not None:
+            calls, profile = profiled
+            calls.finish(profile, seconds)
+            return
+        calls = self._calls
+        if calls is not None:
+            calls.finish(None, seconds)
+
+    def status(self):
+        '''The profiler's state, as a table'''
+        sampler, calls = self._sampler, self._calls
+        status = {'running': sampler is not None or calls is not None, 'last_path': self.last_path}
+        if sampler is not None:
+            status.update(mode='sample', samples=sampler.samples, stacks=len(sampler.stacks),
+                overhead=round(sampler.overhead, 5))
+        elif calls is not None:
+            overhead = calls.overhead
+            status.update(mode='cprofile', profiled_calls=calls.profiled_calls, calls=calls.profiled_calls + calls.plain_calls,
+                sample_rate=calls.sample_rate, overhead=round(overhead, 5) if overhead is not None else None)
+        if status['running']:
+            status['seconds'] = round(time.time() - self._started, 3)
+        return status
@@ -0,0 +1,209 @@
+'''
+Refresh-ahead scheduling for frequently requested urls
+
+(c) 2018 simzes
+
+Every entry expires EXPIRE_SECS after it was fetched, and the first
+request to see it expired pays for the trip to the origin, on top of the
+reservation contest. For urls that are requested often, a RefreshAhead
+scheduler revalidates the entry in the background shortly before it
+expires, so that requests keep finding it fresh.
+
+The scheduler counts requests per url (sketches.SpaceSaving, halved every
+window_secs), and a url becomes eligible after min_hits requests in a
+window. Each hit on an eligible url schedules a refresh lead_secs before
+the entry expires. Due refreshes are handed to a fixed pool of worker
+threads (bounding concurrency), at no more than rate refreshes per second.
+
+The refresh itself is a callable taking the request to revalidate and the
+expiry time it was scheduled against (see webcache.refresh_entry). It goes
+through the usual reservation protocol, so processes refreshing the same
+url don't duplicate the origin request. Every process refreshes the urls
+that are hot in its own traffic: the hit counts aren't shared, so a
+single elected process would miss the urls hot only elsewhere.
+'''
+
+import heapq
+import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import sketches
+
+class TokenBucket(object):
+    '''Allows up to rate events per second, with bursts of up to burst'''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, rate))
+        self._tokens = self.burst
+        self._updated = None
+
+    def take(self, now):
+        if self._updated is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+class RefreshAhead(object):
+    '''Schedules refreshes of hot urls shortly before they expire'''
+
+    def __init__(self, refresh_fn, clock=time.time, lead_secs=5, min_hits=10,
+            window_secs=60, rate=5.0, concurrency=2, capacity=1024, poll_interval=0.25):
+        self.refresh_fn = refresh_fn
+        self.clock = clock
+        self.lead_secs = lead_secs
+        self.min_hits = min_hits
+        self.window_secs = window_secs
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+
+        self._tracker = sketches.SpaceSaving(capacity)
+        self._bucket = TokenBucket(rate)
+        self._slots = threading.Semaphore(concurrency)
+        # guards the schedule, and the counts below, which the workers update
+        self._lock = threading.Lock()
+
+        # url -> (expires, request) for the pending refresh of each url
+        self._scheduled = {}
+        # (due, expires, url), ordered by due time
+        self._heap = []
+        self._window_start = None
+
+        self._queue = queue.Queue()
+        self._threads = []
+        self._stopping = threading.Event()
+
+        self.refreshed = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def top_urls(self, limit=None):
+        '''Returns (url, count, error) tuples for the most requested urls'''
+        with self._lock:
+            return self._tracker.top(limit)
+
+    def note_access(self, url, request, expires):
+        '''Counts a request for url, served from an entry expiring at
+        expires, and schedules a refresh of the entry if url is hot.
+        request is the WSGIRequest the refresh will issue'''
+        with self._lock:
+            hits = self._tracker.increment(url)
+            if hits < self.min_hits:
+                return
+
+            scheduled = self._scheduled.get(url)
+            if scheduled is not None and scheduled[0] >= expires:
+                return
+
+            self._scheduled[url] = (expires, request)
+            heapq.heappush(self._heap, (expires - self.lead_secs, expires, url))
+
+    def due_requests(self):
+        '''Pops the refreshes that are due, within the rate and concurrency
+        budget, returning (request, expires) pairs. The caller must run each
+        one and call finished() afterwards'''
+        now = self.clock()
+        due = []
+
+        with self._lock:
+            if self._window_start is None:
+                self._window_start = now
+            elif now - self._window_start >= self.window_secs:
+                self._tracker.decay()
+                self._window_start = now
+
+            while self._heap and self._heap[0][0] <= now:
+                _, expires, url = self._heap[0]
+                scheduled = self._scheduled.get(url)
+                if scheduled is None or scheduled[0] != expires:
+                    # superseded by a later schedule for the same url
+                    heapq.heappop(self._heap)
+                    continue
+                if now >= expires:
+                    # too late to refresh ahead; a request will refetch it
+                    heapq.heappop(self._heap)
+                    del self._scheduled[url]
+                    self.skipped += 1
+                    continue
+
+                if not self._slots.acquire(False):
+                    break
+                if not self._bucket.take(now):
+                    self._slots.release()
+                    break
+
+                heapq.heappop(self._heap)
+                del self._scheduled[url]
+                due.append((scheduled[1], expires))
+
+        return due
+
+    def finished(self):
+        self._slots.release()
+
+    def run_request(self, request, expires):
+        try:
+            refreshed = self.refresh_fn(request, expires)
+        except Exception:
+            logging.exception("Refresh of %s failed", request.url)
+            with self._lock:
+                self.failed += 1
+        else:
+            with self._lock:
+                if refreshed:
+                    self.refreshed += 1
+                else:
+                    self.skipped += 1
+        finally:
+            self.finished()
+
+    def run_pending(self):
+        '''Runs the due refreshes in the calling thread; returns how many ran'''
+        due = self.due_requests()
+        for request, expires in due:
+            self.run_request(request, expires)
+        return len(due)
+
+    def start(self):
+        '''Starts the scheduler and worker threads'''
+        self._stopping.clear()
+        self._threads = [threading.Thread(target=self._schedule_loop, name="refresh-scheduler")]
+        for i in range(self.concurrency):
+            self._threads.append(threading.Thread(target=self._worker_loop, name="refresh-worker-%d" % (i,)))
+
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        for _ in range(self.concurrency):
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _schedule_loop(self):
+        while not self._stopping.wait(self.poll_interval):
+            try:
+                for due in self.due_requests():
+                    self._queue.put(due)
+            except Exception:
+                logging.exception("Refresh scheduling failed")
+
+    def _worker_loop(self):
+        while True:
+            due = self._queue.get()
+            if due is None:
+                return
+            self.run_request(*due)
@@ -0,0 +1,234 @@
+'''
+Logging that stays off the request path
+
+(c) 2018 simzes
+
+With a FileHandler on the root logger, every record is formatted and
+written by the thread that logged it, under the handler's lock, so busy
+threads queue up behind each other's log lines. Here:
+
+--a QueueHandler hands records to a background thread, which formats
+and writes them through the handler it wraps; when its queue is full,
+records are dropped (and counted) rather than holding up requests
+--a UrlSampler filter passes debug records only for a fraction of urls,
+picked by a hash of the url, so that every request for a sampled url is
+logged in full, and nothing is logged for the others
+--an AccessLog writes one JSON line per request (time, host, url,
+status, how it was served, and how long it took), through a QueueHandler
+of its own
+
+configure() sets up the root logger with these. Debug records are
+sampled by the url of the request the thread is handling, as set by
+begin(), or under ASGI by the url of the request the task is handling,
+as set by begin_task() (which needs Python 3.7, for contextvars);
+records logged outside requests are always passed.
+'''
+
+import json
+import logging
+import threading
+import zlib
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    _immutable_types = (str, unicode, int, long, float, bool, type(None))
+except NameError:
+    _immutable_types = (str, bytes, int, float, bool, type(None))
+
+DEFAULT_FORMAT = "%(levelname)s:%(asctime)-15s:%(thread)d %(message)s"
+
+_local = threading.local()
+
+# the url of the request an asyncio task is handling, which a
+# threading.local can't follow; None without contextvars
+_task_url = contextvars.ContextVar('webcache_request_url', default=None) if contextvars else None
+
+# queued to stop a writer thread
+_STOP = object()
+
+def begin(url):
+    '''Notes the url of the request this thread is handling'''
+    _local.url = url
+
+def end():
+    '''Notes that this thread has finished handling its request'''
+    _local.url = None
+
+def begin_task(url):
+    '''Notes the url of the request this asyncio task is handling'''
+    if _task_url is not None:
+        _task_url.set(url)
+
+def end_task():
+    '''Notes that this asyncio task has finished handling its request'''
+    if _task_url is not None:
+        _task_url.set(None)
+
+def _immutable(value):
+    if isinstance(value, tuple):
+        return all(_immutable(v) for v in value)
+    return isinstance(value, _immutable_types)
+
+class QueueHandler(logging.Handler):
+    '''Passes records to handler from a background thread. Records whose
+    arguments could change before the thread gets to them (anything but
+    strings, numbers and tuples of them) are formatted as they are
+    queued. Beyond capacity records waiting, records are dropped'''
+
+    def __init__(self, handler, capacity=10000):
+        logging.Handler.__init__(self)
+        self.handler = handler
+        self._queue = queue.Queue(capacity)
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+        self.dropped = 0
+
+    def handle(self, record):
+        # the queue has a lock of its own; the handler's would serialize
+        # the threads logging
+        if self.filter(record):
+            self.emit(record)
+        return record
+
+    def emit(self, record):
+        args = record.args
+        if args and not _immutable(args):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # the traceback's frames won't keep
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        self._enqueue(record)
+
+    def _enqueue(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self._thread is None:
+            self._start()
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                thread = threading.Thread(target=self._run, name="log-writer")
+                thread.daemon = True
+                thread.start()
+                self._thread = thread
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                return
+            try:
+                self._write(item)
+            except Exception:
+                self.handleError(item)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, record):
+        self.handler.handle(record)
+
+    def flush(self):
+        '''Waits for the queued records to be written'''
+        self._queue.join()
+        self.handler.flush()
+
+    def close(self):
+        '''Writes the queued records, and stops the writer thread'''
+        with self._start_lock:
+            thread, self._thread = self._thread, _STOP
+        if thread not in (None, _STOP):
+            self._queue.put(_STOP)
+            thread.join()
+        self.handler.flush()
+        self.handler.close()
+        logging.Handler.close(self)
+
+class UrlSampler(logging.Filter):
+    '''Passes the debug records of requests for the rate fraction of urls,
+    and every other record'''
+
+    def __init__(self, rate):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self._threshold = int(rate * 0x100000000)
+
+    def sampled(self, url):
+        '''Whether url's debug records are passed'''
+        if not isinstance(url, bytes):
+            url = url.encode('utf-8')
+        return (zlib.crc32(url) & 0xffffffff) < self._threshold
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        url = getattr(_local, 'url', None)
+        if url is None and _task_url is not None:
+            url = _task_url.get()
+        return url is None or self.sampled(url)
+
+class JSONFormatter(logging.Formatter):
+    '''Formats records whose message is a table, as a JSON line'''
+
+    def format(self, record):
+        return json.dumps(record.msg, sort_keys=True)
+
+class AccessLog(QueueHandler):
+    '''Writes a JSON line per request to path (or through handler, if
+    given), from a background thread. The request's thread only queues a
+    tuple; the record is made and formatted by the writer'''
+
+    def __init__(self, path=None, handler=None, capacity=10000):
+        if handler is None:
+            handler = logging.FileHandler(path)
+        handler.setFormatter(JSONFormatter())
+        QueueHandler.__init__(self, handler, capacity)
+
+    def write(self, wsgi_request, status, seconds, source=None):
+        '''Logs a request, its response's status line, how long it took,
+        and how it was served (see webcache._count_response)'''
+        self._enqueue((wsgi_request.time, wsgi_request.headers.get('Host'), wsgi_request.url, status, source, seconds))
+
+    def _write(self, item):
+        request_time, host, url, status, source, seconds = item
+        fields = {
+            'time': request_time,
+            'host': host,
+            'url': url,
+            'status': int(status[:3]) if status else None,
+            'source': source,
+            'ms': round(seconds * 1000, 3),
+        }
+        self.handler.handle(logging.makeLogRecord({'msg': fields, 'levelno': logging.INFO, 'levelname': 'INFO'}))
+
+def configure(path, level=logging.INFO, format=DEFAULT_FORMAT, debug_sample_rate=None, capacity=10000):
+    '''Logs the root logger's records to the file at path, through a
+    QueueHandler; with debug_sample_rate, only that fraction of urls get
+    their debug records logged. Returns the QueueHandler'''
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter(format))
+    queue_handler = QueueHandler(handler, capacity)
+    if debug_sample_rate is not None:
+        queue_handler.addFilter(UrlSampler(debug_sample_rate))
+
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    return queue_handler
@@ -0,0 +1,263 @@
+'''
+Host-local cache shared by the webcache's processes through shared memory
+
+(c) 2018 simzes
+
+mod_wsgi runs the webcache in several daemon processes, and every request
+costs at least one memcached round trip, for the metadata, and usually a
+second for the body. A SharedCache is a hash table in a memory-mapped
+file (under /dev/shm, by default), which all the processes on a host map,
+so that an entry fetched by one of them is served to the rest without
+going over the network.
+
+The table is set-associative: a key hashes to a set of `ways` fixed-size
+slots, and can live in any slot of its set. Each slot holds the key, the
+pickled value and an expiry time; values too large for a slot are not
+cached. When a set is full, a clock hand sweeps it for a slot whose
+reference bit (set on every hit) is clear.
+
+Writers lock the set's stripe, with a thread lock within the process and
+an fcntl record lock across processes. Readers take no locks: each slot
+has a sequence number (a seqlock), odd while a write is in progress and
+advanced by each write, and a read is retried if the sequence number
+changed while it copied the slot.
+'''
+
+import errno
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+TABLE_MAGIC = b'WCS1'
+_table_header = struct.Struct('<4sIII')
+
+# seq, used, referenced, key length, value length, expires, key hash
+_slot_header = struct.Struct('<IBBHIdQ')
+_seq = struct.Struct('<I')
+
+_REFERENCED_OFFSET = 5
+_READ_ATTEMPTS = 8
+
+def _key_bytes(key):
+    return key if isinstance(key, bytes) else key.encode('utf-8')
+
+def _key_hash(key):
+    return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+
+class SharedCache(object):
+    '''Table of key -> value with expiry, shared by every process mapping
+    the same path. The first process creates the table with the given
+    geometry; later ones must be configured alike'''
+
+    def __init__(self, path='/dev/shm/webcache', sets=4096, ways=8, slot_bytes=2048, stripes=64, clock=time.time):
+        self.path = path
+        self.sets = sets
+        self.ways = ways
+        self.slot_bytes = slot_bytes
+        self.stripes = stripes
+        self.clock = clock
+
+        self._hands_offset = _table_header.size
+        self._slots_offset = (self._hands_offset + sets + 63) & ~63
+        size = self._slots_offset + sets * ways * slot_bytes
+
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, size)
+                os.write(self._fd, _table_header.pack(TABLE_MAGIC, sets, ways, slot_bytes))
+            else:
+                header = os.read(self._fd, _table_header.size)
+                if len(header) < _table_header.size or _table_header.unpack(header) != (TABLE_MAGIC, sets, ways, slot_bytes):
+                    raise ValueError("Shared cache %s has a different layout" % (path,))
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+        self._map = mmap.mmap(self._fd, size)
+        self._locks = [threading.Lock() for _ in range(stripes)]
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+    def _slot_offset(self, set_index, way):
+        return self._slots_offset + (set_index * self.ways + way) * self.slot_bytes
+
+    def _lock_stripe(self, stripe):
+        self._locks[stripe].acquire()
+        try:
+            while True:
+                try:
+                    fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, stripe)
+                    return
+                except (IOError, OSError) as e:
+                    # record locks belong to the process, so the kernel sees
+                    # a cycle when two processes' threads wait on each
+                    # other's stripes; no thread holds more than one stripe,
+                    # so waiting again is safe
+                    if e.errno != errno.EDEADLK:
+                        raise
+                    time.sleep(0.001)
+        except Exception:
+            self._locks[stripe].release()
+            raise
+
+    def _unlock_stripe(self, stripe):
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, stripe)
+        finally:
+            self._locks[stripe].release()
+
+    def _read_slot(self, offset, key, key_hash):
+        '''Returns (found, expires, pickled value) for the key's slot, using
+        the seqlock to get a consistent copy'''
+        mapped = self._map
+        for _ in range(_READ_ATTEMPTS):
+            seq, used, _, key_len, value_len, expires, slot_hash = _slot_header.unpack_from(mapped, offset)
+            if seq & 1:
+                continue
+            if not used or slot_hash != key_hash or key_len != len(key):
+                return False, None, None
+
+            start = offset + _slot_header.size
+            payload = mapped[start:start + key_len + value_len]
+            if _seq.unpack_from(mapped, offset)[0] != seq:
+                continue
+            if payload[:key_len] != key:
+                return False, None, None
+            return True, expires, payload[key_len:]
+
+        # contended with writers throughout; treat as a miss
+        return False, None, None
+
+    def get(self, key):
+        '''The value stored under key, or None'''
+        key = _key_bytes(key)
+        key_hash = _key_hash(key)
+        set_index = key_hash % self.sets
+
+        for way in range(self.ways):
+            offset = self._slot_offset(set_index, way)
+            found, expires, value = self._read_slot(offset, key, key_hash)
+            if not found:
+                continue
+            if expires <= self.clock():
+                break
+
+            # a hint for eviction; racing with a writer is harmless
+            struct.pack_into('<B', self._map, offset + _REFERENCED_OFFSET, 1)
+            self.hits += 1
+            return pickle.loads(value)
+
+        self.misses += 1
+        return None
+
+    def set(self, key, value, ttl):
+        '''Stores value under key for ttl seconds. Returns False if the
+        value doesn't fit in a slot'''
+        key = _key_bytes(key)
+        value = pickle.dumps(value, 2)
+        if _slot_header.size + len(key) + len(value) > self.slot_bytes or len(key) > 0xffff:
+            return False
+
+        key_hash = _key_hash(key)
+        set_index = key_hash % self.sets
+        stripe = set_index % self.stripes
+
+        self._lock_stripe(stripe)
+        try:
+            way = self._choose_way(set_index, key, key_hash)
+            self._write_slot(self._slot_offset(set_index, way), key, key_hash, value, self.clock() + ttl)
+        finally:
+            self._unlock_stripe(stripe)
+
+        self.stores += 1
+        return True
+
+    def delete(self, key):
+        key = _key_bytes(key)
+        key_hash = _key_hash(key)
+        set_index = key_hash % self.sets
+        stripe = set_index % self.stripes
+
+        self._lock_stripe(stripe)
+        try:
+            for way in range(self.ways):
+                offset = self._slot_offset(set_index, way)
+                if self._read_slot(offset, key, key_hash)[0]:
+                    self._write_slot(offset, None, 0, None, 0)
+                    return True
+            return False
+        finally:
+            self._unlock_stripe(stripe)
+
+    def _choose_way(self, set_index, key, key_hash):
+        '''The way to store the key in: its current slot, a free or expired
+        one, or else the first unreferenced slot under the clock hand.
+        Called with the stripe locked'''
+        now = self.clock()
+        free = None
+        for way in range(self.ways):
+            offset = self._slot_offset(set_index, way)
+            found, expires, _ = self._read_slot(offset, key, key_hash)
+            if found:
+                return way
+            if free is None:
+                used, = struct.unpack_from('<B', self._map, offset + 4)
+                expires, = struct.unpack_from('<d', self._map, offset + 12)
+                if not used or expires <= now:
+                    free = way
+        if free is not None:
+            return free
+
+        hand_offset = self._hands_offset + set_index
+        hand = struct.unpack_from('<B', self._map, hand_offset)[0] % self.ways
+        for _ in range(2 * self.ways):
+            offset = self._slot_offset(set_index, hand)
+            if not struct.unpack_from('<B', self._map, offset + _REFERENCED_OFFSET)[0]:
+                break
+            struct.pack_into('<B', self._map, offset + _REFERENCED_OFFSET, 0)
+            hand = (hand + 1) % self.ways
+
+        struct.pack_into('<B', self._map, hand_offset, (hand + 1) % self.ways)
+        self.evictions += 1
+        return hand
+
+    def _write_slot(self, offset, key, key_hash, value, expires):
+        '''Writes the slot under its seqlock; None for key clears it.
+        Called with the stripe locked'''
+        mapped = self._map
+        seq = _seq.unpack_from(mapped, offset)[0]
+        _seq.pack_into(mapped, offset, (seq + 1) & 0xffffffff)
+
+        if key is None:
+            _slot_header.pack_into(mapped, offset, (seq + 1) & 0xffffffff, 0, 0, 0, 0, 0.0, 0)
+        else:
+            _slot_header.pack_into(mapped, offset, (seq + 1) & 0xffffffff, 1, 0, len(key), len(value), expires, key_hash)
+            start = offset + _slot_header.size
+            mapped[start:start + len(key) + len(value)] = key + value
+
+        _seq.pack_into(mapped, offset, (seq + 2) & 0xffffffff)
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,152 @@
+'''
+Compact, approximate counting structures for tracking request frequencies
+
+(c) 2018 simzes
+
+The webcache sees far more distinct urls than it could count exactly in
+memory. These sketches trade a bounded amount of error for a fixed
+footprint, and age their counts so that they reflect recent traffic.
+
+Not thread-safe; callers are expected to hold a lock.
+'''
+
+from array import array
+
+class CountMinSketch(object):
+    '''Estimates how often each key has been seen.
+
+    Each key maps to one counter in each of depth rows; an estimate is the
+    smallest of its counters, so it can overcount (through collisions) but
+    never undercounts. Updates are conservative: only the counters equal
+    to the current minimum are incremented, which limits overcounting.
+
+    Every sample_size increments, all counters are halved, so old traffic
+    decays away and the sketch tracks frequency within a sliding window.
+    '''
+
+    MAX_COUNT = 0xffff
+
+    def __init__(self, width=1 << 16, depth=4, sample_size=None):
+        # width is rounded up to a power of two, for masking
+        self.width = 1 << max(width - 1, 1).bit_length()
+        self.depth = depth
+        self.sample_size = sample_size or 10 * self.width
+
+        self._mask = self.width - 1
+        self._rows = [array('H', [0]) * self.width for _ in range(depth)]
+        self._additions = 0
+        self.resets = 0
+
+    def _indexes(self, key):
+        # double hashing: row i uses h1 + i * h2
+        h1 = hash(key)
+        h2 = (h1 >> 17) | 1
+        return [(h1 + i * h2) & self._mask for i in range(self.depth)]
+
+    def estimate(self, key):
+        rows = self._rows
+        return min(rows[i][index] for i, index in enumerate(self._indexes(key)))
+
+    def increment(self, key):
+        '''Counts one occurrence of the key, returning its new estimate'''
+        rows = self._rows
+        indexes = self._indexes(key)
+        current = min(rows[i][index] for i, index in enumerate(indexes))
+
+        if current < self.MAX_COUNT:
+            for i, index in enumerate(indexes):
+                if rows[i][index] == current:
+                    rows[i][index] = current + 1
+
+        self._additions += 1
+        if self._additions >= self.sample_size:
+            self.reset()
+
+        return min(current + 1, self.MAX_COUNT)
+
+    def reset(self):
+        '''Halves every counter, aging out old traffic'''
+        self._rows = [array('H', [count >> 1 for count in row]) for row in self._rows]
+        self._additions //= 2
+        self.resets += 1
+
+class SpaceSaving(object):
+    '''Tracks the most frequent keys in a stream, with fixed memory.
+
+    Keeps exact counts for up to capacity keys. When a new key arrives and
+    the table is full, the key with the smallest count is replaced, and
+    the new key inherits that count (plus one); its count is then an
+    overestimate by at most the inherited amount, recorded as its error.
+    Keys seen more often than total / capacity are always retained.
+
+    Counts are kept in buckets by value, so that updates and replacements
+    take constant time. decay() halves all counts, aging out old traffic.
+    '''
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self._counts = {}
+        self._errors = {}
+        self._buckets = {}
+        self._min_count = 0
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __contains__(self, key):
+        return key in self._counts
+
+    def _move(self, key, old_count, new_count):
+        if old_count:
+            bucket = self._buckets[old_count]
+            bucket.discard(key)
+            if not bucket:
+                del self._buckets[old_count]
+        self._buckets.setdefault(new_count, set()).add(key)
+        self._counts[key] = new_count
+
+    def increment(self, key):
+        '''Counts one occurrence of the key, returning its new count'''
+        count = self._counts.get(key)
+        if count is not None:
+            self._move(key, count, count + 1)
+        elif len(self._counts) < self.capacity:
+            self._errors[key] = 0
+            self._move(key, 0, 1)
+            count = 0
+        else:
+            count = self._min_count
+            bucket = self._buckets[count]
+            victim = bucket.pop()
+            if not bucket:
+                del self._buckets[count]
+            del self._counts[victim]
+            del self._errors[victim]
+            self._errors[key] = count
+            self._move(key, 0, count + 1)
+
+        if count == self._min_count or self._min_count not in self._buckets:
+            self._min_count = min(self._buckets) if len(self._counts) >= self.capacity else 0
+        return count + 1
+
+    def count(self, key):
+        return self._counts.get(key, 0)
+
+    def top(self, limit=None):
+        '''Returns (key, count, error) tuples for the most frequent keys,
+        most frequent first'''
+        ranked = sorted(self._counts.items(), key=lambda item: item[1], reverse=True)
+        return [(key, count, self._errors[key]) for key, count in ranked[:limit]]
+
+    def decay(self):
+        '''Halves every count, dropping keys that reach zero'''
+        counts = self._counts
+        self._counts = {}
+        self._buckets = {}
+        for key, count in counts.items():
+            if count >> 1:
+                self._errors[key] >>= 1
+                self._move(key, 0, count >> 1)
+            else:
+                del self._errors[key]
+        self._min_count = min(self._buckets) if len(self._counts) >= self.capacity else 0
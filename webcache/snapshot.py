@@ -0,0 +1,211 @@
+'''
+Snapshots of the hottest cache entries, for reloading after a restart
+
+(c) 2018 simzes
+
+A memcached restart empties the cache, and the origin takes the full
+request rate until it refills. A snapshot keeps the metadata and content
+entries of the most requested urls in a local file, from which a fresh
+memcached can be reloaded in a few bulk requests.
+
+Snapshot files are written to a temporary file and renamed into place,
+so a reader never sees a partial snapshot. The format is streamed, so
+neither writing nor reading holds the whole snapshot in memory:
+
+    magic (8 bytes), then a zlib stream of records:
+        length (4 bytes), crc32 of the payload (4), payload
+    and a trailer: 0xffffffff (4), number of records (4)
+
+Each payload is a pickled (key, value, expires) tuple, with expires the
+absolute time the entry's memcached expiry ran out at, so that reloaded
+entries keep their original lifetimes.
+
+A Snapshotter writes snapshots of a process's hottest urls in the
+background, and, given a restore_fn, checks every check_secs whether the
+snapshot should be reloaded (see webcache.restore_after_restart).
+'''
+
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import sketches
+
+SNAPSHOT_MAGIC = b'WCSNAP01'
+_record_header = struct.Struct('>II')
+_TRAILER_LENGTH = 0xffffffff
+
+class SnapshotError(Exception):
+    '''Raised for snapshot files that are damaged or incomplete'''
+    pass
+
+class SnapshotWriter(object):
+    '''Writes records to a snapshot file, which appears at path once the
+    writer is closed'''
+
+    def __init__(self, path, level=6):
+        self.path = path
+        self._temp_path = '%s.%d.tmp' % (path, os.getpid())
+        self._file = open(self._temp_path, 'wb')
+        self._file.write(SNAPSHOT_MAGIC)
+        self._compressor = zlib.compressobj(level)
+        self.records = 0
+
+    def write(self, key, value, expires):
+        payload = pickle.dumps((key, value, expires), 2)
+        self._write(_record_header.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload)
+        self.records += 1
+
+    def _write(self, data):
+        self._file.write(self._compressor.compress(data))
+
+    def close(self):
+        self._write(_record_header.pack(_TRAILER_LENGTH, self.records))
+        self._file.write(self._compressor.flush())
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.rename(self._temp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        os.unlink(self._temp_path)
+
+def read_snapshot(path, chunk_size=65536):
+    '''Generates the (key, value, expires) records of a snapshot file,
+    raising SnapshotError on a damaged record or a missing trailer'''
+    with open(path, 'rb') as snapshot:
+        if snapshot.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise SnapshotError("%s is not a snapshot" % (path,))
+
+        decompressor = zlib.decompressobj()
+        buffered = b''
+        records = 0
+        while True:
+            chunk = snapshot.read(chunk_size)
+            try:
+                buffered += decompressor.decompress(chunk) if chunk else decompressor.flush()
+            except zlib.error as e:
+                raise SnapshotError("%s is damaged: %s" % (path, e))
+
+            offset = 0
+            while len(buffered) - offset >= _record_header.size:
+                length, crc = _record_header.unpack_from(buffered, offset)
+                if length == _TRAILER_LENGTH:
+                    if crc != records:
+                        raise SnapshotError("%s has %d records; trailer says %d" % (path, records, crc))
+                    return
+                start = offset + _record_header.size
+                if len(buffered) < start + length:
+                    break
+
+                payload = buffered[start:start + length]
+                offset = start + length
+                if zlib.crc32(payload) & 0xffffffff != crc:
+                    raise SnapshotError("%s has a damaged record" % (path,))
+                records += 1
+                yield pickle.loads(payload)
+            buffered = buffered[offset:]
+
+            if not chunk:
+                raise SnapshotError("%s is truncated" % (path,))
+
+class Snapshotter(object):
+    '''Counts requests per url, and periodically snapshots the entries of
+    the most requested ones in a background thread.
+
+    save_fn takes the urls to snapshot, hottest first, and the path to
+    write to (see webcache.save_snapshot). restore_fn, if given, takes the
+    path, and reloads it if memcached has restarted, returning the number
+    of entries restored, or None if there was nothing to do.'''
+
+    def __init__(self, save_fn, path, limit=1000, interval_secs=300, capacity=None, restore_fn=None, check_secs=10):
+        self.save_fn = save_fn
+        self.path = path
+        self.limit = limit
+        self.interval_secs = interval_secs
+        self.restore_fn = restore_fn
+        self.check_secs = check_secs
+
+        self._tracker = sketches.SpaceSaving(capacity or 2 * limit)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+
+        self.snapshots = 0
+        self.restores = 0
+        self.failed = 0
+
+    def note_access(self, url):
+        with self._lock:
+            self._tracker.increment(url)
+
+    def hot_urls(self):
+        with self._lock:
+            return [url for url, _, _ in self._tracker.top(self.limit)]
+
+    def snapshot(self):
+        '''Writes a snapshot of the current hot urls; returns the number of
+        records written'''
+        urls = self.hot_urls()
+        try:
+            records = self.save_fn(urls, self.path)
+        except Exception:
+            self.failed += 1
+            logging.exception("Snapshot to %s failed", self.path)
+            return 0
+
+        self.snapshots += 1
+        with self._lock:
+            # age the counts, so the next snapshot follows shifts in traffic
+            self._tracker.decay()
+        return records
+
+    def check_restore(self):
+        '''Reloads the snapshot if restore_fn finds memcached has restarted;
+        returns the number of entries restored, or None'''
+        if self.restore_fn is None:
+            return None
+        try:
+            restored = self.restore_fn(self.path)
+        except Exception:
+            self.failed += 1
+            logging.exception("Restore from %s failed", self.path)
+            return None
+
+        if restored is not None:
+            self.restores += 1
+        return restored
+
+    def start(self):
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="snapshotter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        next_snapshot = time.time() + self.interval_secs
+        while True:
+            self.check_restore()
+            wait_secs = next_snapshot - time.time()
+            if self.restore_fn is not None:
+                wait_secs = min(wait_secs, self.check_secs)
+            if self._stopping.wait(max(wait_secs, 0)):
+                return
+            if time.time() >= next_snapshot:
+                self.snapshot()
+                next_snapshot = time.time() + self.interval_secs
@@ -0,0 +1,200 @@
+'''
+Per-request traces of where the time went
+
+(c) 2018 simzes
+
+A slow request may have waited on memcached, slept through a backoff,
+waited on the origin, or gone around the CAS loop; the request log only
+says that it was slow. A Tracer records a trace for each request: the
+spans (name, start, duration and nesting depth) of the phases the
+request went through. Code marks its phases with:
+
+--@traced(name), on a function
+--with span(name):, around a block
+--add(name, seconds), for time measured by the caller (e.g. hashing,
+spread over the chunks of a body)
+
+These cost a thread-local lookup when the thread isn't tracing a
+request. Finished traces can be summarized for a Server-Timing response
+header, and are written as JSON lines to a file when the request took at
+least slow_secs, or at random with sample_rate.
+'''
+
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+
+_local = threading.local()
+
+def current():
+    '''The trace of the request this thread is handling, if any'''
+    return getattr(_local, 'trace', None)
+
+class Trace(object):
+    '''The spans of one request, as [name, start, duration, depth, error]
+    lists, with times in seconds from the start of the request'''
+
+    def __init__(self, url, clock):
+        self.url = url
+        self.clock = clock
+        self.time = time.time()
+        self.started = clock()
+        self.spans = []
+        self.depth = 0
+
+        self.status = None
+        self.duration = None
+
+    def add(self, name, seconds):
+        '''Records a span of the given length, ending now'''
+        self.spans.append([name, self.clock() - self.started - seconds, seconds, self.depth, None])
+
+    def totals(self):
+        '''(name, total seconds) for each span name, in order of first
+        appearance'''
+        totals = {}
+        order = []
+        for name, _, duration, _, _ in self.spans:
+            if duration is None:
+                continue
+            if name not in totals:
+                order.append(name)
+                totals[name] = 0.0
+            totals[name] += duration
+        return [(name, totals[name]) for name in order]
+
+    def to_json(self):
+        return json.dumps({
+            'time': self.time,
+            'url': self.url,
+            'status': self.status,
+            'duration_ms': _ms(self.duration),
+            'pid': os.getpid(),
+            'thread': threading.current_thread().name,
+            'spans': [dict(name=name, start_ms=_ms(start), duration_ms=_ms(duration), depth=depth, error=error)
+                for name, start, duration, depth, error in self.spans],
+            }, sort_keys=True)
+
+def _ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+class _Span(object):
+
+    __slots__ = ('trace', 'name', 'start', 'record')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        trace = self.trace
+        self.start = trace.clock()
+        self.record = [self.name, self.start - trace.started, None, trace.depth, None]
+        trace.spans.append(self.record)
+        trace.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        trace = self.trace
+        trace.depth -= 1
+        self.record[2] = trace.clock() - self.start
+        if exc_type is not None:
+            self.record[4] = exc_type.__name__
+        return False
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_span = _NullSpan()
+
+def span(name):
+    '''A context manager recording its block as a span of the current
+    trace, if any'''
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        return _null_span
+    return _Span(trace, name)
+
+def traced(name):
+    '''Decorator recording calls of a function as spans'''
+    def decorate(fn):
+        @functools.wraps(fn)
+        def traced_fn(*args, **kwargs):
+            trace = getattr(_local, 'trace', None)
+            if trace is None:
+                return fn(*args, **kwargs)
+            with _Span(trace, name):
+                return fn(*args, **kwargs)
+        return traced_fn
+    return decorate
+
+def add(name, seconds):
+    '''Records time measured by the caller as a span of the current trace'''
+    trace = getattr(_local, 'trace', None)
+    if trace is not None:
+        trace.add(name, seconds)
+
+class Tracer(object):
+    '''Traces requests on any number of threads.
+
+    Traces of requests taking at least slow_secs, and a sample_rate
+    fraction of the others, are appended to the file at path as JSON
+    lines; with path None, none are written. server_timing tells the
+    webcache to send each trace's summary in a Server-Timing header.'''
+
+    def __init__(self, path=None, slow_secs=1.0, sample_rate=0.0, server_timing=False,
+            clock=time.time, rng=None):
+        self.path = path
+        self.slow_secs = slow_secs
+        self.sample_rate = sample_rate
+        self.server_timing = server_timing
+        self.clock = clock
+        self._random = rng or random.Random()
+        self._lock = threading.Lock()
+
+        self.written = 0
+        self.failed = 0
+
+    def begin(self, url):
+        '''Starts tracing a request on this thread'''
+        trace = _local.trace = Trace(url, self.clock)
+        return trace
+
+    def finish(self, trace, status=None):
+        '''Stops tracing the request, writing its trace if it was slow or
+        sampled'''
+        _local.trace = None
+        trace.duration = self.clock() - trace.started
+        trace.status = status
+
+        if self.path is None:
+            return
+        if trace.duration >= self.slow_secs or (self.sample_rate and self._random.random() < self.sample_rate):
+            self.write(trace)
+
+    def write(self, trace):
+        line = trace.to_json() + '\n'
+        try:
+            with self._lock:
+                with open(self.path, 'a') as traces:
+                    traces.write(line)
+            self.written += 1
+        except (IOError, OSError):
+            self.failed += 1
+            logging.exception("Couldn't write trace to %s", self.path)
+
+    def server_timing_header(self, trace):
+        '''The Server-Timing header value summarizing a finished trace, in
+        milliseconds'''
+        metrics = ['%s;dur=%.3f' % (name, seconds * 1000) for name, seconds in trace.totals()]
+        metrics.append('total;dur=%.3f' % (trace.duration * 1000,))
+        return ', '.join(metrics)
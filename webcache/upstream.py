@@ -0,0 +1,180 @@
+'''
+A pool of origin servers for cache misses
+
+(c) 2018 simzes
+
+Misses are sent to one of several origin servers ("upstreams"), each given
+by its base url (http://10.0.0.2:8080). An UpstreamPool picks one per
+request, by one of two policies:
+
+--least_outstanding: the upstream with the fewest requests in flight from
+this process
+--ewma: the upstream with the lowest moving average of response time,
+scaled by its requests in flight, so that a slow upstream is given less
+work before its average catches up
+
+Ties are broken at random. Health is checked passively: an upstream whose
+requests fail (connection errors, timeouts, or 5xx statuses) some number
+of times in a row is ejected for a while, and each further ejection, with
+no success in between, lasts twice as long. If every upstream is ejected,
+requests go to the one that is due back first, rather than failing.
+
+Upstreams can be routed by the request's Host header: routes map host
+names (with or without port) to their own lists of upstreams, and hosts
+without a route use the default list. The Host header is passed on
+unchanged, so name-based virtual hosts on the upstreams see the host the
+client asked for.
+'''
+
+import logging
+import random
+import threading
+import time
+
+POLICIES = ('least_outstanding', 'ewma')
+
+class NoUpstreamError(Exception):
+    '''Raised when a request's host has no upstreams to go to'''
+    pass
+
+class Upstream(object):
+    '''An origin server, and what the pool knows of its health and load'''
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+        self.outstanding = 0
+        # moving average of response times, in seconds; None until measured
+        self.ewma = None
+
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = None
+
+        self.requests = 0
+        self.failed = 0
+
+    def stats(self):
+        return {
+            'url': self.url,
+            'outstanding': self.outstanding,
+            'ewma': self.ewma,
+            'requests': self.requests,
+            'failed': self.failed,
+            'ejected_until': self.ejected_until,
+        }
+
+    def __repr__(self):
+        return "Upstream(%r)" % (self.url,)
+
+class UpstreamPool(object):
+    '''Picks upstreams for requests, and tracks their load and health.
+
+    upstreams is the default list of base urls; routes maps host names to
+    lists of their own. An upstream is ejected after max_failures
+    consecutive failures, for eject_secs, doubling with each further
+    ejection up to max_eject_secs. ewma_decay is the weight of each new
+    response time in the moving average.'''
+
+    def __init__(self, upstreams, routes=None, policy='least_outstanding',
+            max_failures=5, eject_secs=10, max_eject_secs=300, ewma_decay=0.3,
+            failure_statuses=(500, 502, 503, 504), clock=time.time, rng=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown balancing policy: %s (known: %s)" % (policy, ', '.join(POLICIES)))
+
+        self.policy = policy
+        self.max_failures = max_failures
+        self.eject_secs = eject_secs
+        self.max_eject_secs = max_eject_secs
+        self.ewma_decay = ewma_decay
+        self.failure_statuses = frozenset(failure_statuses)
+        self.clock = clock
+        self._random = rng or random.Random()
+        self._lock = threading.Lock()
+
+        # an upstream listed under several hosts is tracked once
+        self._upstreams = {}
+        self._default = self._register(upstreams)
+        self._routes = {}
+        for host, host_upstreams in (routes or {}).items():
+            self._routes[host.lower()] = self._register(host_upstreams)
+
+    def _register(self, urls):
+        registered = []
+        for url in urls:
+            key = url.rstrip('/')
+            if key not in self._upstreams:
+                self._upstreams[key] = Upstream(key)
+            registered.append(self._upstreams[key])
+        return registered
+
+    def upstreams(self):
+        return sorted(self._upstreams.values(), key=lambda u: u.url)
+
+    def candidates(self, host=None):
+        '''The upstreams serving host, per the routes'''
+        if host:
+            host = host.lower()
+            routed = self._routes.get(host)
+            if routed is None and ':' in host:
+                routed = self._routes.get(host.rsplit(':', 1)[0])
+            if routed is not None:
+                return routed
+        if not self._default:
+            raise NoUpstreamError("No upstreams for host %s" % (host,))
+        return self._default
+
+    def _load(self, upstream):
+        if self.policy == 'ewma':
+            # unmeasured upstreams score 0, so each gets tried early on
+            return (upstream.ewma or 0.0) * (upstream.outstanding + 1)
+        return upstream.outstanding
+
+    def acquire(self, host=None):
+        '''The upstream to send a request for host to, counted as having the
+        request in flight until it is released'''
+        candidates = self.candidates(host)
+        with self._lock:
+            now = self.clock()
+            healthy = [u for u in candidates if u.ejected_until is None or u.ejected_until <= now]
+            if healthy:
+                lowest = min(self._load(u) for u in healthy)
+                upstream = self._random.choice([u for u in healthy if self._load(u) == lowest])
+            else:
+                upstream = min(candidates, key=lambda u: u.ejected_until)
+                logging.warning("All upstreams for host %s are ejected; using %s", host, upstream.url)
+
+            upstream.outstanding += 1
+            upstream.requests += 1
+        return upstream
+
+    def release(self, upstream, elapsed, status_code=None):
+        '''Records the end of a request to upstream, which took elapsed
+        seconds, and got a response with status_code (None if the request
+        failed before a response came back)'''
+        failed = status_code is None or status_code in self.failure_statuses
+        with self._lock:
+            upstream.outstanding -= 1
+            if upstream.ewma is None:
+                upstream.ewma = elapsed
+            else:
+                upstream.ewma += self.ewma_decay * (elapsed - upstream.ewma)
+
+            if not failed:
+                upstream.failures = 0
+                upstream.ejections = 0
+                upstream.ejected_until = None
+                return
+
+            upstream.failed += 1
+            upstream.failures += 1
+            if upstream.failures >= self.max_failures:
+                eject_secs = min(self.eject_secs * 2 ** upstream.ejections, self.max_eject_secs)
+                upstream.ejections += 1
+                upstream.failures = 0
+                upstream.ejected_until = self.clock() + eject_secs
+                logging.warning("Ejecting upstream %s for %ss after %d failures", upstream.url, eject_secs, self.max_failures)
+
+    def stats(self):
+        with self._lock:
+            return [u.stats() for u in self.upstreams()]
@@ -0,0 +1,77 @@
+'''
+Normalization of request headers into cache variant keys
+
+(c) 2018 simzes
+
+When the origin's content varies on a request header (Accept-Language,
+Accept-Encoding), each distinct value would otherwise need its own
+variant of the cache entry. Raw header values are nearly unique per
+browser, so each configured header is first reduced to the value that
+actually selects the content (the preferred language, the best supported
+encoding), and the reduced values are joined into the variant key.
+'''
+
+# content codings the origin can produce, in order of preference
+ACCEPT_ENCODING_PREFERENCE = ('br', 'gzip', 'deflate')
+
+def _weighted_tokens(header_value):
+    '''Splits a header like "en-US,en;q=0.9,fr;q=0" into (token, q) pairs,
+    skipping unacceptable (q=0) tokens, ordered by descending q'''
+    tokens = []
+    for position, item in enumerate(header_value.split(',')):
+        token, _, params = item.partition(';')
+        token = token.strip().lower()
+        if not token:
+            continue
+
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            # position keeps the order of equally weighted tokens
+            tokens.append((-quality, position, token))
+
+    return [(token, -quality) for quality, _, token in sorted(tokens)]
+
+def normalize_accept_language(header_value):
+    '''The primary subtag of the most preferred language ("en" for
+    "en-US,fr;q=0.5"), or '' if there is no preference'''
+    for token, _ in _weighted_tokens(header_value):
+        if token != '*':
+            return token.split('-')[0]
+    return ''
+
+def normalize_accept_encoding(header_value):
+    '''The first coding in ACCEPT_ENCODING_PREFERENCE that the client
+    accepts, or "identity"'''
+    accepted = set(token for token, _ in _weighted_tokens(header_value))
+    for coding in ACCEPT_ENCODING_PREFERENCE:
+        if coding in accepted or '*' in accepted:
+            return coding
+    return 'identity'
+
+def normalize_generic(header_value):
+    '''The header's comma-separated tokens, lowercased and sorted'''
+    return ','.join(sorted(
+        token.strip().lower() for token in header_value.split(',') if token.strip()))
+
+header_normalizers = {
+    'Accept-Language': normalize_accept_language,
+    'Accept-Encoding': normalize_accept_encoding,
+}
+
+def make_variant_key(request_headers, vary_headers):
+    '''Builds the variant key for a request, from the normalized values of
+    the vary_headers; '' if no headers are configured'''
+    parts = []
+    for header_name in vary_headers:
+        normalizer = header_normalizers.get(header_name, normalize_generic)
+        value = normalizer(request_headers.get(header_name, ''))
+        parts.append('%s=%s' % (header_name.lower(), value))
+
+    return '&'.join(parts)
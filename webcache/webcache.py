@@ -6,17 +6,45 @@ A small application for caching requests going to a web server
 See the README for detailed information.
 '''
 
-import pylibmc
-import requests
-import hashlib
+import hmac
+import json
 
 import time
 import datetime
 from dateutil import tz
 from random import randint
 
+try:
+    from urlparse import parse_qs
+except ImportError:
+    from urllib.parse import parse_qs
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
 import logging
+import os
 import sys
+import threading
+
+import backends
+import changedetect
+import digests
+import disktier
+import invalidation
+import keynorm
+import lifecycle
+import metrics
+import prefetch
+import refresh
+import requestlog
+import shmcache
+import snapshot
+import tracing
+import upstream
+import variants
 
 # how frequently a sleeping thread checks the cache for updates
 SLEEP_POLL_INTERVAL = 0.5
@@ -34,7 +62,24 @@ UPDATE_MAX_ATTEMPTS = 20
 # how long a cache metadata entry is valid
 EXPIRE_SECS = 30
 
+# how long metadata is kept in memcached past its expiry, so that a refetch
+# can tell whether the content has changed (and keep its Last-Modified)
+METADATA_RETAIN_SECS = 600
+
+# how long content is kept in memcached past its expiry, for requests that
+# loaded the metadata just before it expired
+CONTENT_RETAIN_SECS = 10
+
 HTTP_HEADER_PREFIX = 'HTTP_'
+
+# most header names (and environ keys) remembered by RequestHeaders; past
+# this, made-up headers are decoded on each request rather than remembered
+HEADER_NAME_CACHE_SIZE = 1024
+
+# most request urls whose entries' tags are remembered, so that a hit
+# reads the tags' generations along with the url's; past this, hits on
+# tagged entries of other urls read them separately
+TAG_HINT_CACHE_SIZE = 10000
 HTTP_DATE_PARSE_FORMAT = '%a, %d %b %Y %H:%M:%S %Z'
 HTTP_DATE_DISPLAY_FORMAT = '%a, %d %b %Y %H:%M:%S GMT'
 
@@ -51,6 +96,39 @@ drop_headers = set([
     'Content-Encoding',
 ])
 
+# algorithm of the digests used to tell whether a body changed (see
+# digests.py); entries record the algorithm of their digest, so changing it
+# doesn't make every entry look changed
+DIGEST_ALGORITHM = 'sha256'
+
+# size of the blocks origin responses are read (and hashed) in
+ORIGIN_READ_CHUNK = 65536
+
+# normalizes bodies before their digest is compared, so that volatile
+# regions (timestamps, tokens, ad slots) don't count as changes (a
+# changedetect.ChangeDetector); None compares the raw body
+CHANGE_DETECTOR = None
+
+# flag for replacing the origin's caching headers (Cache-Control, Pragma,
+# Expires, Age) on cached responses with ones derived from the entry's
+# freshness, so that browsers and caches in front of the webcache can reuse
+# the response until the entry expires
+FRESHNESS_HEADERS = False
+
+# flag for adding s-maxage to the derived Cache-Control, for shared caches
+# (Apache mod_cache) in front of the webcache
+FRESHNESS_SHARED_MAX_AGE = False
+
+# caching headers replaced when FRESHNESS_HEADERS is set; lowercase
+# (CacheControl is a misspelling some origins send)
+freshness_header_names = set([
+    'cache-control',
+    'cachecontrol',
+    'pragma',
+    'expires',
+    'age',
+])
+
 # flag for dropping responses from the server that don't have an OK status,
 # and not caching them
 DROP_NOT_OK_STATUS = True
@@ -58,43 +136,203 @@ DROP_NOT_OK_STATUS = True
 # tuple or float passed to the requests library for conn/read timeout
 REQUEST_TIMEOUT = (0.5, 15)
 
+# connections kept open to each origin, for reuse by later misses
+ORIGIN_POOL_SIZE = 10
+
+# origin servers misses are sent to, balanced and health-checked (see
+# upstream.py); e.g. upstream.UpstreamPool(['http://10.0.0.2:8080',
+# 'http://10.0.0.3:8080'], policy='ewma', routes={'static.example.com':
+# ['http://10.0.0.4']})
+UPSTREAM_POOL = upstream.UpstreamPool(['http://127.0.0.1'])
+
+# normalizer mapping request urls onto the urls used for cache keys, so that
+# equivalent spellings of a url share an entry; None uses urls verbatim
+KEY_NORMALIZER = keynorm.KeyNormalizer()
+
+# request headers the origin's content varies on; each distinct combination
+# of their normalized values is cached as a variant under the url's entry
+VARY_HEADERS = []
+
+# maximum number of variants kept per url; the least recently fetched
+# variant is dropped to make room for a new one
+VARY_MAX_VARIANTS = 8
+
+# policy deciding whether a missed url is worth storing in the cache (see
+# admission.FrequencyAdmission); None stores every response. Requests for
+# urls that aren't admitted are passed through to the origin
+ADMISSION_POLICY = None
+
+# background scheduler revalidating frequently requested entries shortly
+# before they expire (see start_refresh_ahead); None disables refresh-ahead
+REFRESHER = None
+
+# flag for folding generation counters into cache keys, so that entries can
+# be invalidated by url, prefix or tag (see invalidation.py); costs one
+# get_multi per request
+INVALIDATION_ENABLED = False
+
+# url prefixes that can be invalidated as a whole
+INVALIDATION_PREFIXES = []
+
+# origin response header listing an entry's (space-separated) tags; not
+# passed on to the client
+SURROGATE_KEY_HEADER = 'Surrogate-Key'
+
+# path under which admin requests are served, and the token they must carry
+# in an X-Webcache-Token header; None disables the admin endpoints
+ADMIN_PATH = '/_webcache/'
+ADMIN_TOKEN = None
+
+# where entries are kept (see backends.py): memcached, using tcp, with
+# nodelay set and the CAS behaviors needed; or, for a single process,
+# backends.InMemoryBackend()
+STORAGE_BACKEND = backends.MemcachedBackend(["127.0.0.1"], binary=True, behaviors={"tcp_nodelay": True, "cas": True})
+
+# deletes bodies superseded by a metadata update, in the background; None
+# leaves them to expire
+CONTENT_REAPER = lifecycle.ContentReaper(lambda: _open_client())
+
+# local disk tier holding large bodies in place of memcached (a
+# disktier.DiskTier); bodies of at least its min_body_bytes are written to
+# disk, and memcached holds only their location. None keeps every body in
+# memcached
+DISK_TIER = None
+
+# block size for sending bodies from the disk tier
+DISK_TIER_BLOCK_SIZE = 65536
+
+# cache shared by the webcache processes on this host (a
+# shmcache.SharedCache), checked before memcached for metadata and for
+# bodies small enough to fit its slots; None disables it
+SHARED_CACHE = None
+
+# longest time metadata is served from the shared cache without checking
+# memcached; bounds how long an update from another host goes unseen
+SHARED_CACHE_METADATA_SECS = 1
+
+# prefetcher warming the resources embedded in pages fetched from the
+# origin (see start_prefetching); None disables prefetching
+PREFETCHER = None
+
+# background writer of snapshots of the hottest entries (see
+# start_snapshots); None disables snapshots
+SNAPSHOTTER = None
+
+# in-process counters and latency histograms (see start_metrics), served in
+# Prometheus text format at ADMIN_PATH + 'metrics'; None disables them
+METRICS = None
+
+# recorder of the phases of each request (a tracing.Tracer), writing the
+# traces of slow or sampled requests and adding Server-Timing headers as
+# configured; None disables tracing
+TRACER = None
+
+# writer of a structured line per request (a requestlog.AccessLog); None
+# disables the access log
+ACCESS_LOG = None
+
+# memcached key under which snapshots publish the urls they were taken of,
+# hottest first, for new processes to warm their SHARED_CACHE with (see
+# warm_up)
+HOT_URLS_KEY = 'webcache_hot_urls'
+
+# memcached key kept without expiry by the snapshotter; finding it gone
+# means memcached has restarted (or been flushed), and the snapshot is
+# restored (see restore_after_restart)
+SNAPSHOT_SENTINEL_KEY = 'webcache_snapshot_sentinel'
+
+# on-demand profiler of this process (a profiling.Profiler; see
+# start_profiler), started and stopped through ADMIN_PATH + 'profile' or a
+# signal; None disables profiling
+PROFILER = None
+
 def parse_http_date(http_date_str):
     return datetime.datetime(*(time.strptime(http_date_str, HTTP_DATE_PARSE_FORMAT)[0:6]), tzinfo=gmt_tz)
 
 def make_http_date(datetime_obj):
     return datetime_obj.strftime(HTTP_DATE_DISPLAY_FORMAT)
 
-def get_request_headers(environ):
+# environ key -> header name, and header name -> environ key
+_header_names = {}
+_environ_keys = {}
+
+# request url -> the tags of the entry last served for it
+_url_tags = {}
+
+def header_name(cgi_header):
     '''cgi/wsgi http headers are encoded like: 'HTTP_CONTENT_LENGTH: <value>'
 
     To recover the original header name, we remove the "HTTP_" prefix,
     lowercase the field name, split on underscores, capitalize each
     split segment, and then rejoin with dashes
     '''
-    http_headers = {}
-    prefix_len = len(HTTP_HEADER_PREFIX)
-
-    for cgi_header, value in environ.iteritems():
-        if cgi_header.startswith(HTTP_HEADER_PREFIX):
-            lc_fieldname = cgi_header[prefix_len:].lower()
-            field_segments = lc_fieldname.split('_')
-            steptyped_segments = [f.capitalize() for f in field_segments]
-            header_name = '-'.join(steptyped_segments)
+    name = _header_names.get(cgi_header)
+    if name is None:
+        lc_fieldname = cgi_header[len(HTTP_HEADER_PREFIX):].lower()
+        field_segments = lc_fieldname.split('_')
+        steptyped_segments = [f.capitalize() for f in field_segments]
+        name = '-'.join(steptyped_segments)
+        if len(_header_names) < HEADER_NAME_CACHE_SIZE:
+            _header_names[cgi_header] = name
+    return name
+
+def environ_key(header):
+    '''The cgi/wsgi environ key of a header name, in any case'''
+    cgi_header = _environ_keys.get(header)
+    if cgi_header is None:
+        cgi_header = HTTP_HEADER_PREFIX + header.upper().replace('-', '_')
+        if len(_environ_keys) < HEADER_NAME_CACHE_SIZE:
+            _environ_keys[header] = cgi_header
+    return cgi_header
+
+class RequestHeaders(Mapping):
+    '''The http headers of a wsgi environ, by header name
+
+    Nothing is decoded up front: a lookup goes straight to the environ key
+    of the name, and names are only recovered from environ keys when the
+    headers are iterated, so a hit, which only reads If-Modified-Since and
+    the VARY_HEADERS, doesn't decode the rest'''
+
+    def __init__(self, environ):
+        self._environ = environ
+
+    def __getitem__(self, header):
+        return self._environ[environ_key(header)]
+
+    def __iter__(self):
+        for cgi_header in self._environ:
+            if cgi_header.startswith(HTTP_HEADER_PREFIX):
+                yield header_name(cgi_header)
+
+    def __len__(self):
+        return sum(1 for cgi_header in self._environ if cgi_header.startswith(HTTP_HEADER_PREFIX))
+
+    def __repr__(self):
+        return repr(dict(self.items()))
 
-            http_headers[header_name] = value
-    return http_headers
+def get_request_headers(environ):
+    '''The http headers of a wsgi environ, as a RequestHeaders mapping'''
+    return RequestHeaders(environ)
 
-def sha256_digest(content):
-    sha2 = hashlib.sha256()
-    sha2.update(content)
-    return sha2.digest()
+def normalize_cache_url(url):
+    '''The url used to key the cache entry for a requested url'''
+    if KEY_NORMALIZER is None:
+        return url
+    return KEY_NORMALIZER.normalize(url)
 
 class WSGIRequest(object):
-    '''Object for encapsulating a WSGI request'''
-    def __init__(self, request_url, request_headers, request_time):
+    '''Object for encapsulating a WSGI request
+
+    The url is passed on to the origin as requested; the cache_url, its
+    normalized form, identifies the request's cache entry'''
+    def __init__(self, request_url, request_headers, request_time, cache_url=None):
         self._time = request_time
         self._headers = request_headers
         self._url = request_url
+        self._cache_url = request_url if cache_url is None else cache_url
+        self._variant = None
+        self._source = None
+        self._tag_generations = None
 
     def __str__(self):
         return "WSGIRequest[url: %s, headers: %s]" % (self._url, str(self._headers),)
@@ -103,6 +341,21 @@ class WSGIRequest(object):
     def url(self):
         return self._url
 
+    @property
+    def cache_url(self):
+        return self._cache_url
+
+    @cache_url.setter
+    def cache_url(self, cache_url):
+        self._cache_url = cache_url
+
+    @property
+    def variant(self):
+        '''The key of the cache variant selected by the request's headers'''
+        if self._variant is None:
+            self._variant = variants.make_variant_key(self._headers, VARY_HEADERS)
+        return self._variant
+
     @property
     def headers(self):
         return self._headers
@@ -111,12 +364,34 @@ class WSGIRequest(object):
     def time(self):
         return self._time
 
+    @property
+    def source(self):
+        '''How the request was served: hit, not_modified, parallel_update,
+        miss or pass; None until it is'''
+        return self._source
+
+    @source.setter
+    def source(self, source):
+        self._source = source
+
+    @property
+    def tag_generations(self):
+        '''Table of tag -> current generation, for the tags the request's
+        entry had when last served; read along with the url's generations,
+        with invalidation enabled. None if they weren't read'''
+        return self._tag_generations
+
+    @tag_generations.setter
+    def tag_generations(self, tag_generations):
+        self._tag_generations = tag_generations
+
 class WSGIResponse(object):
     '''Object for encapsulating a WSGI response'''
 
     def __init__(self):
         self._headers = []
         self._content = []
+        self._disk_body = None
 
     def __str__(self):
         return "WSGIResponse[status: %s, headers: %s]" % (self._status, self._headers,)
@@ -127,32 +402,95 @@ class WSGIResponse(object):
 
     @property
     def headers(self):
+        '''The origin's headers; for entries read from cache, only the
+        response_headers'''
         return self._headers
 
     @property
     def content(self):
         return self._content
 
+    @property
+    def disk_body(self):
+        return self._disk_body
+
     def add_header(self, header_name, header_value):
         self.headers.append((header_name, header_value,))
 
     def set_content_body(self, body):
+        if isinstance(body, disktier.DiskBody):
+            self._disk_body = body
         self._content = [body]
 
+    def iter_content(self, environ):
+        '''The response body, as returned to the wsgi server. Bodies on the
+        disk tier are sent with the server's file_wrapper if it has one
+        (letting it use sendfile), or else read from the mapping in blocks'''
+        if self._disk_body is None:
+            return self._content
+
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if file_wrapper is not None:
+            return file_wrapper(self._disk_body.open_file(), DISK_TIER_BLOCK_SIZE)
+        return self._disk_body.chunks(DISK_TIER_BLOCK_SIZE)
+
+    def add_freshness_headers(self, cache_metadata):
+        '''Adds caching headers for the time left until the entry expires:
+        max-age is the entry's lifetime, and Age the time since it was
+        fetched, so clients reuse the response for the remaining time'''
+        now = unixtime()
+        expires = cache_metadata.fetched + EXPIRE_SECS
+
+        cache_control = 'public, max-age=%d' % (EXPIRE_SECS,)
+        if FRESHNESS_SHARED_MAX_AGE:
+            cache_control += ', s-maxage=%d' % (EXPIRE_SECS,)
+        self.add_header('Cache-Control', cache_control)
+        self.add_header('Expires', make_http_date(datetime.datetime.fromtimestamp(expires, tz=gmt_tz)))
+        self.add_header('Age', str(int(max(0, min(now - cache_metadata.fetched, EXPIRE_SECS)))))
+
     @staticmethod
-    def from_cache_metadata(cache_metadata):
+    def from_cache_metadata(cache_metadata, freshness=True):
+        '''Builds a response from a cache entry. Unless freshness is unset,
+        caching headers are derived from the entry (with FRESHNESS_HEADERS)'''
         response = WSGIResponse()
 
+        content = cache_metadata.content_entry.content
+        on_disk = isinstance(content, disktier.DiskBody)
+        freshness = freshness and FRESHNESS_HEADERS
+
         response.add_header('Last-Modified', cache_metadata.last_modified)
-        for header, value in cache_metadata.content_entry.headers.iteritems():
-            if header not in drop_headers:
+        if on_disk or freshness:
+            for header, value in cache_metadata.content_entry.response_headers:
+                if on_disk and header.lower() == 'content-length':
+                    continue
+                if freshness and header.lower() in freshness_header_names:
+                    continue
                 response.add_header(header, value)
+        else:
+            response.headers.extend(cache_metadata.content_entry.response_headers)
+        if freshness:
+            response.add_freshness_headers(cache_metadata)
+        if on_disk:
+            # servers stop sending a file_wrapper's file at the content length
+            response.add_header('Content-Length', str(len(content)))
+        if VARY_HEADERS:
+            response.add_header('Vary', ', '.join(VARY_HEADERS))
 
         response._status = cache_metadata.content_entry.status
-        response.set_content_body(cache_metadata.content_entry.content)
+        response.set_content_body(content)
 
         return response
 
+    @staticmethod
+    def from_server_response(mc_client, wsgi_request, server_response):
+        '''Builds a response directly from the server's response, without
+        storing anything in the cache'''
+        content_entry = EntryContent.from_server_response(server_response, wsgi_request.cache_url, mc_client, (wsgi_request.time, 0))
+        cache_metadata = EntryMetadata.from_server_response(mc_client, wsgi_request.cache_url, content_entry, wsgi_request.variant,
+            stored=False)
+
+        return WSGIResponse.from_cache_metadata(cache_metadata, freshness=False)
+
     @staticmethod
     def from_internal_error():
         response = WSGIResponse()
@@ -175,6 +513,12 @@ class EntryMetadata(object):
     response (from_server_response factory). If there is a cache hit, or if
     the cache has an entry that may be expired, we update the metadata to
     reflect the new server content or the new access details.
+
+    The content fields (fetched, last_modified, digest, content_key)
+    belong to the variant the entry was loaded for. The default variant ('')
+    keeps them at the top level of the stored data; any other variant keeps
+    them in a record under "variants", so that all variants of a url share
+    one metadata entry and one set of reservation fields.
     '''
 
     _data_fields = set([
@@ -183,10 +527,21 @@ class EntryMetadata(object):
         "url",
         "fetched",
         "last_modified",
-        "sha256_digest",
+        "digest",
+        "digest_algorithm",
         "reservation",
         "last_noted",
-        "content_key"
+        "content_key",
+        "tags"
+    ])
+
+    _variant_fields = set([
+        "fetched",
+        "last_modified",
+        "digest",
+        "digest_algorithm",
+        "content_key",
+        "tags"
     ])
 
     def __init__(self):
@@ -194,32 +549,82 @@ class EntryMetadata(object):
         self._content_entry = None
         self._mc_client = None
         self._etag = None
+        self._variant = ''
+        self._superseded = []
+        self._shared = False
 
     def __str__(self):
         return str(self._data)
 
     def __getattr__(self, attr):
+        if attr in self._variant_fields:
+            return self._variant_record().get(attr)
         return self._data[attr]
 
     def __setattr__(self, attrname, value):
         '''sets internal data object or properties'''
-        if attrname in self._data_fields:
+        if attrname in self._variant_fields:
+            self._variant_record(create=True)[attrname] = value
+        elif attrname in self._data_fields:
             self._data[attrname] = value
         else:
             object.__setattr__(self, attrname, value)
 
+    def _variant_record(self, create=False):
+        '''The dict holding the content fields of the selected variant'''
+        if self._variant == '':
+            return self._data
+
+        variant_records = self._data.get('variants', {})
+        if create:
+            variant_records = self._data.setdefault('variants', variant_records)
+            return variant_records.setdefault(self._variant, {})
+        return variant_records.get(self._variant, {})
+
+    @property
+    def digest(self):
+        '''The digest of the current body, by digest_algorithm; entries
+        stored before the field was renamed hold it as sha256_digest'''
+        record = self._variant_record()
+        return record.get('digest', record.get('sha256_digest'))
+
+    @property
+    def has_variant(self):
+        '''Whether content has been fetched for the selected variant'''
+        return self.fetched is not None
+
+    def limit_variants(self):
+        '''Drops the least recently fetched variants beyond VARY_MAX_VARIANTS,
+        keeping the selected one'''
+        variant_records = self._data.get('variants', {})
+        while len(variant_records) > VARY_MAX_VARIANTS:
+            oldest = min(
+                (v for v in variant_records if v != self._variant),
+                key=lambda v: variant_records[v].get('fetched') or 0)
+            logging.debug("Dropping variant %s of %s", oldest, self.url)
+            self._superseded.append(variant_records.pop(oldest).get('content_key'))
+
+    @property
+    def superseded_content_keys(self):
+        '''Content keys this entry referred to before it was updated'''
+        return self._superseded
+
+    @staticmethod
+    def metadata_ttl():
+        return int(EXPIRE_SECS + METADATA_RETAIN_SECS)
+
     @property
     def metadata_key(self):
         return EntryMetadata.make_metadata_key(self.url)
 
     @staticmethod
     def make_metadata_key(url):
-        return "metadata_%s" % (url,)
+        return keynorm.hash_long_key("metadata_%s" % (url,))
 
     @staticmethod
     def make_content_key(url, reservation_token):
         session, reservation = reservation_token
-        return "body_%s_%f-%d" % (url, session, reservation,)
+        return keynorm.hash_long_key("body_%s_%f-%d" % (url, session, reservation,))
 
     @property
     def content_entry(self):
@@ -230,6 +635,11 @@ class EntryMetadata(object):
             self._content_entry = EntryContent.from_cache(self)
         return self._content_entry
 
+    @content_entry.setter
+    def content_entry(self, content_entry):
+        self._content_entry = content_entry
+
+    @tracing.traced('metadata_store')
     def store_metadata(self):
         '''Commits this metadata to cache, using the CAS token from loading,
         or inserting if the entry doesn't exist
@@ -240,11 +650,11 @@ class EntryMetadata(object):
 
         if self._etag is not None:
             try:
-                return self._mc_client.cas(self.metadata_key, self._data, self._etag)
-            except pylibmc.NotFound:
+                return self._mc_client.cas(self.metadata_key, self._data, self._etag, time=self.metadata_ttl())
+            except backends.NotFound:
                 # entry could have been evicted since creation--try insert once
                 pass
-        return self._mc_client.add(self.metadata_key, self._data)
+        return self._mc_client.add(self.metadata_key, self._data, time=self.metadata_ttl())
 
     def delete_metadata(self):
         '''Removes the metadata entry from the cache'''
@@ -252,22 +662,52 @@ class EntryMetadata(object):
         self._mc_client.delete(self.metadata_key)
 
     @staticmethod
-    def from_cache_or_none(mc_client, url):
-        '''Build an EntryMetadata object with the contents from cache, if any.
+    @tracing.traced('metadata_get')
+    def from_cache_or_none(mc_client, url, variant='', shared=False):
+        '''Build an EntryMetadata object with the contents from cache, if any,
+        selecting the given variant.
+
+        If shared is set, the entry may come from the host's SHARED_CACHE, in
+        which case it has no CAS token, and must not be stored back.
 
         Returns None if no entry could be found.
         '''
-        cache_entry, etag = mc_client.gets(EntryMetadata.make_metadata_key(url))
+        metadata_key = EntryMetadata.make_metadata_key(url)
+        if shared and SHARED_CACHE is not None:
+            cache_entry = SHARED_CACHE.get(metadata_key)
+            if cache_entry is not None:
+                entry = EntryMetadata.from_cache_entry(mc_client, cache_entry, None, variant)
+                entry._shared = True
+                return entry
+
+        cache_entry, etag = mc_client.gets(metadata_key)
         if cache_entry is None:
             return None
 
+        return EntryMetadata.from_cache_entry(mc_client, cache_entry, etag, variant)
+
+    @staticmethod
+    def from_cache_entry(mc_client, cache_entry, etag, variant=''):
+        '''Build an EntryMetadata object from a metadata entry read from
+        cache, with the CAS token it was read with'''
         entry = EntryMetadata()
         entry._mc_client = mc_client
         entry._data = cache_entry
         entry._etag = etag
+        entry._variant = variant
 
         return entry
 
+    @property
+    def cas_token(self):
+        '''The CAS token the entry was read with, or None for a new entry'''
+        return self._etag
+
+    @property
+    def cache_entry(self):
+        '''The metadata entry, as stored in cache'''
+        return self._data
+
     @staticmethod
     def new_reservation(mc_client, url):
         '''
@@ -287,7 +727,7 @@ class EntryMetadata(object):
         entry.valid = False
 
         entry.url = url
-        entry.sha256_digest = None
+        entry.digest = None
 
         entry.session = unixtime()
         # reservation is one, as this thread is the first in line
@@ -297,25 +737,30 @@ class EntryMetadata(object):
         return entry
 
     @staticmethod
-    def from_server_response(mc_client, url, content_entry):
+    def from_server_response(mc_client, url, content_entry, variant='', stored=True):
         '''Builds a new EntryMetadata object from a response object from the
-        server'''
+        server, for the given variant. Tags are only recorded for entries
+        that will be stored (stored is set)'''
 
         entry = EntryMetadata()
 
         entry._mc_client = mc_client
         entry._etag = None
+        entry._variant = variant
         entry.valid = True
 
         entry.url = url
         entry.fetched = entry.session = unixtime()
         entry.last_modified = EntryMetadata.time_or_last_modified_header(entry.fetched, content_entry)
-        entry.sha256_digest = sha256_digest(content_entry.content)
+        entry.digest = content_entry.digest
+        entry.digest_algorithm = DIGEST_ALGORITHM
         entry.reservation = 0
         entry.last_noted = 0
 
         entry.content_key = content_entry.content_key
         entry._content_entry = content_entry
+        if stored:
+            entry.record_tags(content_entry)
 
         return entry
 
@@ -329,16 +774,34 @@ class EntryMetadata(object):
         self.last_noted = self.reservation
 
         self.valid = True
+        if self.content_key not in (None, content_entry.content_key):
+            self._superseded.append(self.content_key)
         self.content_key = content_entry.content_key
 
-        if self.sha256_digest != content_entry.digest:
-            # contents have changed; need to update hash, modified date, and key
+        # compare with the algorithm the stored digest was taken with; a
+        # digest this process can't compute counts as a changed body
+        recorded_algorithm = self.digest_algorithm or digests.LEGACY_ALGORITHM
+        if (self.digest is None or not digests.available(recorded_algorithm)
+                or self.digest != content_entry.digest_for(recorded_algorithm)):
+            # contents have changed; need to update modified date, and key
             self.last_modified = EntryMetadata.time_or_last_modified_header(update_time, content_entry)
-            self.sha256_digest = content_entry.digest
             self.content_key = content_entry.content_key
 
+        # the digest is always stored under the current algorithm
+        self.digest = content_entry.digest
+        self.digest_algorithm = DIGEST_ALGORITHM
+        self._variant_record().pop('sha256_digest', None)
+
+        self.record_tags(content_entry)
+        self.limit_variants()
         self._content_entry = content_entry
 
+    def record_tags(self, content_entry):
+        '''Records the current generation of each of the content's tags'''
+        if INVALIDATION_ENABLED:
+            tags = invalidation.parse_tags(content_entry.headers.get(SURROGATE_KEY_HEADER))
+            self.tags = invalidation.tag_generations(self._mc_client, tags)
+
     @staticmethod
     def time_or_last_modified_header(unixtime, content_entry):
         '''The given unixtime, or the content_entry's last-modified header,
@@ -355,17 +818,27 @@ class EntryMetadata(object):
 class EntryContent(object):
     '''Object for representing a server's response at rest in the cache
 
-    Lazily computes the sha256 digest of the response's content
+    Lazily computes the digest of the response's content (with the
+    DIGEST_ALGORITHM), after normalization by the CHANGE_DETECTOR, if any
     '''
 
     def __init__(self):
-        self.__digest = None
+        # algorithm -> digest
+        self._digests = {}
+        self._response_headers = None
 
     @property
     def digest(self):
-        if self.__digest is None:
-            self.__digest = sha256_digest(self.content)
-        return self.__digest
+        return self.digest_for(DIGEST_ALGORITHM)
+
+    def digest_for(self, algorithm):
+        if algorithm not in self._digests:
+            with tracing.span('hash'):
+                content = self.content
+                if CHANGE_DETECTOR is not None:
+                    content = CHANGE_DETECTOR.normalize(self.url, content)
+                self._digests[algorithm] = digests.digest(algorithm, content)
+        return self._digests[algorithm]
 
     @property
     def content_key(self):
@@ -381,41 +854,96 @@ class EntryContent(object):
 
     @property
     def headers(self):
+        '''The origin's headers; for entries read from cache, only the
+        response_headers'''
         return self._headers
 
     @property
     def content(self):
         return self._content
 
+    @property
+    def response_headers(self):
+        '''The headers passed on to clients with the content (all but the
+        drop_headers and the SURROGATE_KEY_HEADER), as a list of (name,
+        value); built once, when the entry is stored, and stored with it'''
+        if self._response_headers is None:
+            self._response_headers = [(header, value) for header, value in self._headers.items()
+                if header not in drop_headers and header != SURROGATE_KEY_HEADER]
+        return self._response_headers
+
+    @tracing.traced('body_store')
     def store_content(self):
         '''Commits the entry to cache, returning success'''
+        logging.debug("cache[%s] = [...]", self._content_key)
+        return self._mc_client.set(self._content_key, self.to_cache_entry(), time=self.content_ttl())
+
+    def to_cache_entry(self):
+        '''The entry, as stored in cache; bodies accepted by the DISK_TIER
+        are written to it, and the entry holds their location'''
         cache_entry = {}
         cache_entry['status'] = self._status
         cache_entry['url'] = self._url
-        cache_entry['headers'] = self._headers
-        cache_entry['content'] = self._content
+        # only the headers passed on to clients; the rest are only read
+        # from fresh responses
+        cache_entry['response_headers'] = self.response_headers
+        if DISK_TIER is not None and DISK_TIER.accepts(self._content):
+            cache_entry['content'] = None
+            cache_entry['disk_location'] = DISK_TIER.put(self._content_key, self._content)
+        else:
+            cache_entry['content'] = self._content
+        return cache_entry
 
-        logging.debug("cache[%s] = [...]", self._content_key)
-        return self._mc_client.set(self._content_key, cache_entry)
+    @staticmethod
+    def content_ttl():
+        return int(EXPIRE_SECS + CONTENT_RETAIN_SECS)
 
     def delete_content(self):
         logging.debug("cache[%s] deleted", self._content_key)
         self._mc_client.delete(self._content_key)
 
     @staticmethod
+    @tracing.traced('body_get')
     def from_cache(entry_metadata):
         cache_key = entry_metadata.content_key
-        cache_entry = entry_metadata._mc_client.get(cache_key)
+        cache_entry = SHARED_CACHE.get(cache_key) if SHARED_CACHE is not None else None
         if cache_entry is None:
-            return None
+            cache_entry = entry_metadata._mc_client.get(cache_key)
+            if cache_entry is None:
+                return None
+            # bodies never change under a content key, so can be shared for
+            # as long as memcached keeps them
+            if SHARED_CACHE is not None and len(cache_entry['content'] or '') < SHARED_CACHE.slot_bytes:
+                SHARED_CACHE.set(cache_key, cache_entry, EntryContent.content_ttl())
+
+        return EntryContent.from_cache_entry(cache_key, cache_entry)
+
+    @staticmethod
+    def from_cache_entry(cache_key, cache_entry):
+        '''Builds an EntryContent object from an entry read from cache under
+        cache_key, reading its body from the DISK_TIER if it is there.
+        Returns None if the body is missing'''
+        content = cache_entry['content']
+        location = cache_entry.get('disk_location')
+        if location is not None:
+            # the body is on disk; a location on another host, or one the
+            # disk tier has reclaimed, counts as a missing body
+            content = DISK_TIER.get(location) if DISK_TIER is not None else None
+            if content is None:
+                logging.debug("cache[%s] body not on the disk tier", cache_key)
+                return None
 
         entry = EntryContent()
         entry._content_key = cache_key
 
         entry._status = cache_entry['status']
         entry._url = cache_entry['url']
-        entry._headers = cache_entry['headers']
-        entry._content = cache_entry['content']
+        # entries stored before the response headers were hold all the
+        # headers, and build the response headers on first use
+        response_headers = cache_entry.get('response_headers')
+        entry._headers = cache_entry['headers'] if response_headers is None else dict(response_headers)
+        entry._response_headers = response_headers
+        entry._content = content
 
         return entry
 
@@ -430,6 +958,13 @@ class EntryContent(object):
         entry._headers = response.headers
         entry._content = response.content
 
+        # a digest taken while the response was read holds, unless the
+        # content is normalized first
+        read_digest = getattr(response, 'webcache_digest', None)
+        if read_digest is not None and (CHANGE_DETECTOR is None or not CHANGE_DETECTOR.applies(url)):
+            algorithm, digest = read_digest
+            entry._digests[algorithm] = digest
+
         return entry
 
 class ConsistencyError(Exception):
@@ -441,59 +976,118 @@ def handle_application(environ, start_response):
     wsgi_request = WSGIRequest(
         request_url=environ['REQUEST_URI'],
         request_headers=get_request_headers(environ),
-        request_time=unixtime()
+        request_time=unixtime(),
+        cache_url=normalize_cache_url(environ['REQUEST_URI'])
         )
 
-    logging.info("Received request: %s", wsgi_request)
+    if ADMIN_TOKEN is not None and wsgi_request.url.startswith(ADMIN_PATH):
+        return handle_admin(environ, start_response)
+
+    requestlog.begin(wsgi_request.url)
+    logging.debug("Received request: %s", wsgi_request)
 
+    trace = TRACER.begin(wsgi_request.url) if TRACER is not None else None
+    profiled = PROFILER.begin() if PROFILER is not None else None
+    wsgi_response = None
+    started = time.time()
     try:
         wsgi_response = handle_request(wsgi_request)
-        logging.info("Issuing response: %s", wsgi_response)
+        logging.debug("Issuing response: %s", wsgi_response)
     except ConsistencyError:
         logging.warn("Couldn't update cache due to contention--bailing early")
+        _count('webcache_consistency_errors_total')
         wsgi_response = WSGIResponse.from_internal_error()
+    finally:
+        if trace is not None:
+            TRACER.finish(trace, wsgi_response.status if wsgi_response is not None else None)
+        if PROFILER is not None:
+            PROFILER.finish(profiled, time.time() - started)
+        requestlog.end()
+    elapsed = time.time() - started
+    _observe('webcache_request_seconds', elapsed)
+    if ACCESS_LOG is not None:
+        ACCESS_LOG.write(wsgi_request, wsgi_response.status, elapsed, wsgi_request.source)
+
+    if trace is not None and TRACER.server_timing:
+        wsgi_response.add_header('Server-Timing', TRACER.server_timing_header(trace))
     # other exceptions are caught and logged by the wsgi handler,
     # into the apache error logs
 
     start_response(wsgi_response.status, wsgi_response.headers)
 
-    return wsgi_response.content
+    return wsgi_response.iter_content(environ)
 
-def handle_request(wsgi_request):
-    '''Handles a request, converting a WSGIRequest to a WSGIResponse'''
+def handle_request(wsgi_request, prefetch=True):
+    '''Handles a request, converting a WSGIRequest to a WSGIResponse.
+    Unless prefetch is unset, an html page fetched from the origin is
+    handed to the PREFETCHER'''
     mc = _open_client()
 
+    # admission counts requests by url, across invalidations
+    admission_key = wsgi_request.cache_url
+    if ADMISSION_POLICY is not None:
+        ADMISSION_POLICY.record(admission_key)
+    if METRICS is not None:
+        METRICS.note_url(wsgi_request.cache_url)
+
+    if INVALIDATION_ENABLED:
+        wsgi_request.cache_url, wsgi_request.tag_generations = invalidation.generation_url_and_tags(
+            mc, wsgi_request.cache_url, INVALIDATION_PREFIXES, _url_tags.get(wsgi_request.url, ()))
+
     # check if we can serve the request from cache
-    cached_response = check_for_cache_response(mc, wsgi_request)
+    started = time.time()
+    cached_response = check_for_cache_response(mc, wsgi_request, shared=True)
+    _observe_phase('lookup', started)
 
     if cached_response:
         logging.debug("Serving from cache")
+        _count_response(wsgi_request, 'not_modified' if cached_response.status.startswith('304') else 'hit')
         return cached_response
 
+    if ADMISSION_POLICY is not None and not ADMISSION_POLICY.admit(admission_key):
+        logging.debug("Not admitted to cache--passing request through to the origin")
+        _count_response(wsgi_request, 'pass')
+        return WSGIResponse.from_server_response(mc, wsgi_request, _issue_origin_request(wsgi_request))
+
     # can't serve from the cache -- compete for cache update
+    started = time.time()
     won, reservation_token = compete_for_cache_update(wsgi_request, mc)
+    _observe_phase('compete', started)
     if not won:
         # check cache again to see if a competing thread has updated the entry
         cached_response = check_for_cache_response(mc, wsgi_request)
         if cached_response:
             logging.debug("Serving parallel-update from cache")
+            _count_response(wsgi_request, 'parallel_update')
             return cached_response
 
     logging.debug("Can't serve from cache--issuing new request to the origin")
+    _count_response(wsgi_request, 'miss')
 
     # update the cache and fulfill the request with our own request to the server
-    server_response = _issue_server_request(wsgi_request)
+    server_response = _issue_origin_request(wsgi_request)
+    started = time.time()
     cache_metadata = update_cache(mc, wsgi_request, server_response, reservation_token)
+    _observe_phase('update', started)
+    if cache_metadata.tags:
+        _note_url_tags(wsgi_request.url, cache_metadata.tags)
+
+    if prefetch and PREFETCHER is not None:
+        _prefetch_embedded(wsgi_request, cache_metadata.content_entry)
 
-    return WSGIResponse.from_cache_metadata(cache_metadata)
+    # responses that weren't cached mustn't be reused downstream either
+    stored = server_response.ok or not DROP_NOT_OK_STATUS
+    return WSGIResponse.from_cache_metadata(cache_metadata, freshness=stored)
 
-def check_for_cache_response(mc_client, wsgi_request, cache_metadata=None):
+@tracing.traced('lookup')
+def check_for_cache_response(mc_client, wsgi_request, cache_metadata=None, shared=False):
     '''
     Checks the cache to see if a response can be served from the current cache
     contents.
 
     Takes an optional EntryMetadata (cache_metadata) object, and retrieves and
-    makes its own otherwise.
+    makes its own otherwise (from the SHARED_CACHE, if shared is set and the
+    entry is there).
 
     Returns a WSGIResponse object if there is a valid response. Otherwise,
     returns None.
@@ -504,43 +1098,104 @@ def check_for_cache_response(mc_client, wsgi_request, cache_metadata=None):
     --the metadata is valid and the object's body is present
     '''
     if cache_metadata is None:
-        cache_metadata = EntryMetadata.from_cache_or_none(mc_client, wsgi_request.url)
+        cache_metadata = EntryMetadata.from_cache_or_none(mc_client, wsgi_request.cache_url, wsgi_request.variant, shared=shared)
 
-    logging.debug("Checking cache metadata for url: %s", wsgi_request.url)
+    logging.debug("Checking cache metadata for url: %s", wsgi_request.cache_url)
 
-    if cache_metadata is None:
-        logging.debug("No cache entry")
-        return None
-
-    if not cache_metadata.valid:
-        logging.debug("No valid cache entry")
+    if not entry_servable(wsgi_request, cache_metadata):
         return None
 
-    if wsgi_request.time > (cache_metadata.fetched + EXPIRE_SECS):
-        logging.debug("Expired cache entry; can't serve")
+    if cache_metadata.tags and not tags_current(mc_client, wsgi_request, cache_metadata.tags):
+        logging.debug("Cache entry invalidated by tag; can't serve")
         return None
 
-    # check for client-side caching headers
-    if 'If-Modified-Since' in wsgi_request.headers:
-        client_datetime = parse_http_date(wsgi_request.headers['If-Modified-Since'])
-        cache_datetime = parse_http_date(cache_metadata.last_modified)
-        if client_datetime >= cache_datetime:
-            logging.debug("Client's If-Modified-Since valid for client-side cache")
-            response = WSGIResponse()
-            response._status = '304 Not Modified'
-
-            return response
-        else:
-            logging.debug("Client's If-Modified-Since too old for client-side cache")
+    response = not_modified_response(wsgi_request, cache_metadata)
+    if response is not None:
+        _note_hit(wsgi_request, cache_metadata)
+        return response
 
     if cache_metadata.content_entry is not None:
         logging.debug("Have valid cache body")
+        _note_hit(wsgi_request, cache_metadata)
         return WSGIResponse.from_cache_metadata(cache_metadata)
 
     logging.debug("No cache body; can't serve from cache")
 
     return None
 
+def tags_current(mc_client, wsgi_request, recorded):
+    '''invalidation.tags_current, for the recorded tag generations of the
+    request's entry. Uses the generations read along with the url's, if
+    they cover the entry's tags, and remembers the tags for the url's
+    next request'''
+    read = wsgi_request.tag_generations
+    if read is not None and all(tag in read for tag in recorded):
+        return all(read[tag] == generation for tag, generation in recorded.items())
+
+    _note_url_tags(wsgi_request.url, recorded)
+    return invalidation.tags_current(mc_client, recorded)
+
+def _note_url_tags(url, tags):
+    '''Remembers the tags of url's entry, for tags_current'''
+    if url in _url_tags or len(_url_tags) < TAG_HINT_CACHE_SIZE:
+        _url_tags[url] = tuple(tags)
+
+def entry_servable(wsgi_request, cache_metadata):
+    '''Whether the metadata is a valid, unexpired entry for the request's
+    variant (tags aside)'''
+    if cache_metadata is None:
+        logging.debug("No cache entry")
+        return False
+
+    if not cache_metadata.valid:
+        logging.debug("No valid cache entry")
+        return False
+
+    if not cache_metadata.has_variant:
+        logging.debug("No cache entry for variant: %s", wsgi_request.variant)
+        return False
+
+    if wsgi_request.time > (cache_metadata.fetched + EXPIRE_SECS):
+        logging.debug("Expired cache entry; can't serve")
+        return False
+
+    return True
+
+def not_modified_response(wsgi_request, cache_metadata):
+    '''A 304 response, if the request's If-Modified-Since covers the entry's
+    Last-Modified; None otherwise'''
+    if 'If-Modified-Since' not in wsgi_request.headers:
+        return None
+
+    # check for client-side caching headers
+    client_datetime = parse_http_date(wsgi_request.headers['If-Modified-Since'])
+    cache_datetime = parse_http_date(cache_metadata.last_modified)
+    if client_datetime < cache_datetime:
+        logging.debug("Client's If-Modified-Since too old for client-side cache")
+        return None
+
+    logging.debug("Client's If-Modified-Since valid for client-side cache")
+    response = WSGIResponse()
+    response._status = '304 Not Modified'
+    if FRESHNESS_HEADERS:
+        response.add_freshness_headers(cache_metadata)
+    return response
+
+def _note_hit(wsgi_request, cache_metadata):
+    '''Lets the refresh-ahead scheduler count a request served from cache,
+    and shares the entry's metadata with the host's other processes'''
+    expires = cache_metadata.fetched + EXPIRE_SECS
+    if REFRESHER is not None:
+        REFRESHER.note_access(wsgi_request.cache_url, _background_request(wsgi_request), expires)
+    if SNAPSHOTTER is not None:
+        SNAPSHOTTER.note_access(wsgi_request.cache_url)
+
+    if SHARED_CACHE is not None and not cache_metadata._shared:
+        ttl = min(SHARED_CACHE_METADATA_SECS, expires - wsgi_request.time)
+        if ttl > 0:
+            SHARED_CACHE.set(EntryMetadata.make_metadata_key(wsgi_request.cache_url), cache_metadata._data, ttl)
+
+@tracing.traced('compete')
 def compete_for_cache_update(wsgi_request, mc_client):
     '''Run to coordinate updates whenever a request cannot be served from cache
 
@@ -561,37 +1216,51 @@ def compete_for_cache_update(wsgi_request, mc_client):
     fields.
 
     During sleep, the thread will poll the cache entry at some interval to see
-    if it's changed and become valid
+    if it's changed and become valid for the request's variant
     '''
-    cache_metadata, won = update_reservation(mc_client, wsgi_request.url)
+    cache_metadata, won = update_reservation(mc_client, wsgi_request.cache_url)
     reservation_token = (cache_metadata.session, cache_metadata.reservation,)
 
     if won:
         logging.debug("Won cache update, with reservation: %s", reservation_token)
+        _count('webcache_reservations_total', labels=(('result', 'won'),))
         return (True, reservation_token,)
 
-    # backoff by picking a random time between 0 and backoff *
-    # SLEEP_MULTIPLY_SECONDS, up to a maximum of SLEEP_MAX_SECONDS
-    backoff = (cache_metadata.reservation - cache_metadata.last_noted)
-    stop = unixtime() + randint(0, min(backoff * SLEEP_MULTIPLY_INTERVAL, SLEEP_MAX_SECONDS))
+    _count('webcache_reservations_total', labels=(('result', 'lost'),))
+    slept = time.time()
+
+    stop = backoff_deadline(cache_metadata)
 
     logging.debug("Lost cache update, backing off until: %d, now: %d, reservation: %s", int(stop), int(unixtime()), reservation_token)
 
-    while stop > unixtime():
-        time.sleep(
-            min(
-                SLEEP_POLL_INTERVAL,
-                max(stop - unixtime(), 0)
-            ))
+    with tracing.span('backoff'):
+        while stop > unixtime():
+            time.sleep(
+                min(
+                    SLEEP_POLL_INTERVAL,
+                    max(stop - unixtime(), 0)
+                ))
 
-        cache_metadata = EntryMetadata.from_cache_or_none(mc_client, wsgi_request.url)
-        if (cache_metadata is None) or cache_metadata.valid:
-            break
+            cache_metadata = EntryMetadata.from_cache_or_none(mc_client, wsgi_request.cache_url, wsgi_request.variant)
+            # the url is valid as soon as any variant is cached; wait for the
+            # winner's update to this one
+            if (cache_metadata is None) or (cache_metadata.valid and cache_metadata.has_variant):
+                break
 
     logging.debug("Finished cache backoff")
+    _observe('webcache_backoff_seconds', time.time() - slept)
 
     return (False, reservation_token,)
 
+def backoff_deadline(cache_metadata):
+    '''The time until which a request that lost the reservation on
+    cache_metadata waits for the winner's update'''
+    # backoff by picking a random time between 0 and backoff *
+    # SLEEP_MULTIPLY_SECONDS, up to a maximum of SLEEP_MAX_SECONDS
+    backoff = (cache_metadata.reservation - cache_metadata.last_noted)
+    return unixtime() + randint(0, min(backoff * SLEEP_MULTIPLY_INTERVAL, SLEEP_MAX_SECONDS))
+
+@tracing.traced('reserve')
 def update_reservation(mc_client, url):
     '''Updates the metadata in cache, s.t. the reservation field is
     incremented if the entry exists, or set as reservation = last_noted = 0,
@@ -600,7 +1269,9 @@ def update_reservation(mc_client, url):
     Returns the (EntryMetadata, won flag) tuple.
     '''
 
-    for _ in range(UPDATE_MAX_ATTEMPTS):
+    for attempt in range(UPDATE_MAX_ATTEMPTS):
+        if attempt:
+            _count('webcache_cas_retries_total', labels=(('operation', 'reservation'),))
         cache_metadata = EntryMetadata.from_cache_or_none(mc_client, url)
         if cache_metadata:
             cache_metadata.reservation += 1
@@ -613,10 +1284,12 @@ def update_reservation(mc_client, url):
 
     raise ConsistencyError()
 
-def update_cache(mc_client, wsgi_request, server_response, reservation_token):
+@tracing.traced('update')
+def update_cache(mc_client, wsgi_request, server_response, reservation_token, refresh=False):
     '''Tries to update the cache to reflect the given server response.
 
-    If the cache has a valid entry, then we use this.
+    If the cache has a valid entry, then we use this, unless we are
+    refreshing that entry ahead of its expiry (refresh is set).
 
     If there is no cache content, or if the content differs, then the
     server response is stored into the cache as metadata and content.
@@ -630,11 +1303,12 @@ def update_cache(mc_client, wsgi_request, server_response, reservation_token):
 
     Finally, we bail after some number of tries to update the cache
     '''
-    content_entry = EntryContent.from_server_response(server_response, wsgi_request.url, mc_client, reservation_token)
+    content_entry = EntryContent.from_server_response(server_response, wsgi_request.cache_url, mc_client, reservation_token)
+    variant = wsgi_request.variant
 
     if DROP_NOT_OK_STATUS and (not server_response.ok):
         logging.debug("Server response not OK -- invalidating cache")
-        cache_metadata = EntryMetadata.from_server_response(mc_client, wsgi_request.url, content_entry)
+        cache_metadata = EntryMetadata.from_server_response(mc_client, wsgi_request.cache_url, content_entry, variant, stored=False)
 
         # delete metadata as a way of notifying other, waiting threads that the
         # blocking thread has given up
@@ -645,10 +1319,12 @@ def update_cache(mc_client, wsgi_request, server_response, reservation_token):
     if not content_entry.store_content():
         raise ConsistencyError()
 
-    for _ in range(UPDATE_MAX_ATTEMPTS):
-        cache_metadata = EntryMetadata.from_cache_or_none(mc_client, wsgi_request.url)
+    for attempt in range(UPDATE_MAX_ATTEMPTS):
+        if attempt:
+            _count('webcache_cas_retries_total', labels=(('operation', 'update'),))
+        cache_metadata = EntryMetadata.from_cache_or_none(mc_client, wsgi_request.cache_url, variant)
         if cache_metadata:
-            if check_for_cache_response(mc_client, wsgi_request, cache_metadata=cache_metadata):
+            if not refresh and check_for_cache_response(mc_client, wsgi_request, cache_metadata=cache_metadata):
                 # can already serve from cache--return response
                 # delete server body we stored unnecessarily
                 content_entry.delete_content()
@@ -657,27 +1333,572 @@ def update_cache(mc_client, wsgi_request, server_response, reservation_token):
             cache_metadata.update_for_server_response(content_entry)
         else:
             # no existing entry--insert new one
-            cache_metadata = EntryMetadata.from_server_response(mc_client, wsgi_request.url, content_entry)
+            cache_metadata = EntryMetadata.from_server_response(mc_client, wsgi_request.cache_url, content_entry, variant)
         if cache_metadata.store_metadata():
+            if CONTENT_REAPER is not None:
+                CONTENT_REAPER.delete_later(cache_metadata.superseded_content_keys)
             return cache_metadata
 
     raise ConsistencyError()
 
+def refresh_entry(wsgi_request, expires):
+    '''Revalidates the cache entry for a request before it expires, on
+    behalf of the refresh-ahead scheduler; wsgi_request is the request made
+    by _background_request when the hit was noted.
+
+    The entry is left alone if it has been refreshed since the refresh was
+    scheduled (it now expires later than expires), or has already expired.
+    Otherwise, the refresh competes for the reservation like a request
+    would, and only fetches from the origin if it wins. A failed origin
+    request releases the reservation, and leaves the current entry in place
+    until it expires.
+
+    Returns whether the entry was refreshed.
+    '''
+    wsgi_request = WSGIRequest(
+        request_url=wsgi_request.url,
+        request_headers=wsgi_request.headers,
+        request_time=unixtime(),
+        cache_url=wsgi_request.cache_url
+        )
+    mc = _open_client()
+
+    cache_metadata = EntryMetadata.from_cache_or_none(mc, wsgi_request.cache_url, wsgi_request.variant)
+    if cache_metadata is None or not cache_metadata.valid or not cache_metadata.has_variant:
+        return False
+    if cache_metadata.fetched + EXPIRE_SECS > expires or wsgi_request.time > expires:
+        return False
+
+    cache_metadata, won = update_reservation(mc, wsgi_request.cache_url)
+    if not won:
+        logging.debug("Lost refresh reservation for %s", wsgi_request.cache_url)
+        return False
+    reservation_token = (cache_metadata.session, cache_metadata.reservation,)
+
+    logging.debug("Refreshing %s ahead of expiry", wsgi_request.cache_url)
+    try:
+        server_response = _issue_origin_request(wsgi_request)
+    except Exception:
+        release_reservation(mc, wsgi_request.cache_url, reservation_token)
+        raise
+    if not server_response.ok:
+        logging.warn("Refresh of %s failed with status %d", wsgi_request.cache_url, server_response.status_code)
+        release_reservation(mc, wsgi_request.cache_url, reservation_token)
+        return False
+
+    update_cache(mc, wsgi_request, server_response, reservation_token, refresh=True)
+    return True
+
+def release_reservation(mc_client, url, reservation_token):
+    '''Gives up a reservation won without updating the entry, leaving the
+    entry as it is, so that the next request competing for it wins rather
+    than backing off behind the reservation. Nothing is changed if the
+    entry has been replaced since (its session differs)'''
+    session, _ = reservation_token
+    for attempt in range(UPDATE_MAX_ATTEMPTS):
+        if attempt:
+            _count('webcache_cas_retries_total', labels=(('operation', 'release'),))
+        cache_metadata = EntryMetadata.from_cache_or_none(mc_client, url)
+        if cache_metadata is None or cache_metadata.session != session:
+            return
+        if cache_metadata.last_noted >= cache_metadata.reservation:
+            return
+        cache_metadata.last_noted = cache_metadata.reservation
+        if cache_metadata.store_metadata():
+            return
+
+    raise ConsistencyError()
+
+def _background_request(wsgi_request):
+    '''A request for wsgi_request's entry, to be issued later in the
+    background: its url, cache url and _forwarded_headers only, so that the
+    client's environ isn't kept alive with it'''
+    return WSGIRequest(
+        request_url=wsgi_request.url,
+        request_headers=_forwarded_headers(wsgi_request),
+        request_time=None,
+        cache_url=wsgi_request.cache_url
+        )
+
+def _forwarded_headers(wsgi_request):
+    '''The headers for a background request made on behalf of wsgi_request:
+    only those that select the entry, not the (possibly personalized)
+    headers of whichever client made the original request'''
+    forwarded = VARY_HEADERS + ['Host']
+    return dict((h, v) for h, v in wsgi_request.headers.items() if h in forwarded)
+
+def start_refresh_ahead(**options):
+    '''Starts a refresh-ahead scheduler for this process; options are passed
+    to refresh.RefreshAhead'''
+    global REFRESHER
+
+    REFRESHER = refresh.RefreshAhead(refresh_entry, clock=lambda: unixtime(), **options)
+    REFRESHER.start()
+    return REFRESHER
+
+def _prefetch_embedded(wsgi_request, content_entry):
+    '''Hands an html page fetched from the origin to the prefetcher'''
+    if content_entry is None or not content_entry.status.startswith('200'):
+        return
+    content_type = [v for h, v in content_entry.headers.items() if h.lower() == 'content-type']
+    if not content_type or not content_type[0].startswith('text/html'):
+        return
+    if isinstance(content_entry.content, (str, bytes)):
+        PREFETCHER.page_fetched(wsgi_request, content_entry.content)
+
+def uncached_urls(page_request, urls):
+    '''The urls, requested along with page_request, that have no fresh
+    entry for its variant. Checks them all with a single get_multi (plus
+    one for generations, with invalidation enabled)'''
+    mc = _open_client()
+    cache_urls = [normalize_cache_url(url) for url in urls]
+    if INVALIDATION_ENABLED:
+        cache_urls = invalidation.generation_urls(mc, cache_urls, INVALIDATION_PREFIXES)
+
+    metadata_keys = [EntryMetadata.make_metadata_key(url) for url in cache_urls]
+    found = mc.get_multi(metadata_keys)
+    now = unixtime()
+
+    missing = []
+    for url, key in zip(urls, metadata_keys):
+        data = found.get(key)
+        if data is not None:
+            cache_metadata = EntryMetadata()
+            cache_metadata._data = data
+            cache_metadata._variant = page_request.variant
+            if cache_metadata.valid and cache_metadata.has_variant and now <= cache_metadata.fetched + EXPIRE_SECS:
+                continue
+        missing.append(url)
+
+    return missing
+
+def warm_url(page_request, url):
+    '''Requests url into the cache, as if requested along with page_request'''
+    wsgi_request = WSGIRequest(
+        request_url=url,
+        request_headers=_forwarded_headers(page_request),
+        request_time=unixtime(),
+        cache_url=normalize_cache_url(url)
+        )
+    # warming a page doesn't warm what it references in turn
+    handle_request(wsgi_request, prefetch=False)
+
+def start_prefetching(patterns, **options):
+    '''Starts prefetching the resources embedded in pages, for references
+    matching any of patterns; options are passed to prefetch.Prefetcher'''
+    global PREFETCHER
+
+    PREFETCHER = prefetch.Prefetcher(uncached_urls, warm_url, patterns, **options)
+    PREFETCHER.start()
+    return PREFETCHER
+
+def save_snapshot(cache_urls, path, mc_client=None, batch_size=100):
+    '''Writes the metadata and content entries of the given urls to a
+    snapshot file, with the times their memcached expiry runs out. Returns
+    the number of entries written'''
+    mc = mc_client or _open_client()
+    writer = snapshot.SnapshotWriter(path)
+    try:
+        for start in range(0, len(cache_urls), batch_size):
+            metadata_keys = [EntryMetadata.make_metadata_key(url) for url in cache_urls[start:start + batch_size]]
+            metadata = mc.get_multi(metadata_keys)
+
+            metadata_expires = {}
+            content_expires = {}
+            for key, data in metadata.items():
+                if not data.get('valid'):
+                    continue
+                records = [data] + list(data.get('variants', {}).values())
+                fetched = [r['fetched'] for r in records if r.get('fetched') is not None]
+                if not fetched:
+                    continue
+
+                metadata_expires[key] = max(fetched) + EXPIRE_SECS + METADATA_RETAIN_SECS
+                for record in records:
+                    if record.get('content_key'):
+                        content_expires[record['content_key']] = record['fetched'] + EXPIRE_SECS + CONTENT_RETAIN_SECS
+
+            # bodies go first, so a restore never has metadata pointing at
+            # bodies it hasn't loaded yet
+            for key, value in mc.get_multi(list(content_expires)).items():
+                writer.write(key, value, content_expires[key])
+            for key, expires in metadata_expires.items():
+                writer.write(key, metadata[key], expires)
+    except Exception:
+        writer.abort()
+        raise
+
+    writer.close()
+    mc.set(HOT_URLS_KEY, list(cache_urls))
+    return writer.records
+
+def restore_snapshot(path, mc_client=None, batch_size=100):
+    '''Loads the entries of a snapshot file into memcached, in batches of
+    set_multi requests, skipping entries memcached already holds.
+
+    Metadata that has expired since the snapshot is restored stale, for at
+    least METADATA_RETAIN_SECS: the first request for it refetches the
+    body through the reservation protocol, and keeps its Last-Modified if
+    the body hasn't changed. Bodies that have expired are skipped, as their
+    metadata has too. Returns the number of entries restored'''
+    mc = mc_client or _open_client()
+    restored = 0
+
+    batch = []
+    for record in snapshot.read_snapshot(path):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            restored += _restore_batch(mc, batch)
+            batch = []
+    if batch:
+        restored += _restore_batch(mc, batch)
+
+    return restored
+
+def _restore_batch(mc, batch):
+    now = unixtime()
+    present = mc.get_multi([key for key, _, _ in batch])
+
+    # one set_multi per expiry time; times are rounded down to 10 seconds to
+    # keep the number of requests low
+    by_ttl = {}
+    for key, value, expires in batch:
+        if key in present:
+            continue
+        ttl = int(expires - now)
+        if 'last_noted' in value:
+            # a reservation held when the snapshot was taken went with the
+            # restart; left in place, every request would back off behind it
+            value = dict(value, last_noted=value['reservation'])
+            ttl = max(ttl, METADATA_RETAIN_SECS)
+        elif ttl <= 0:
+            continue
+        if ttl > 10:
+            ttl -= ttl % 10
+        by_ttl.setdefault(ttl, {})[key] = value
+
+    restored = 0
+    for ttl, mapping in by_ttl.items():
+        failed = mc.set_multi(mapping, time=ttl)
+        restored += len(mapping) - len(failed or ())
+    return restored
+
+def restore_after_restart(path, mc_client=None):
+    '''Restores the snapshot at path if memcached has restarted since the
+    last check, which is when SNAPSHOT_SENTINEL_KEY is missing. Of the
+    processes finding it missing, the one that adds it back restores.
+    Returns the number of entries restored, or None if memcached hasn't
+    restarted'''
+    mc = mc_client or _open_client()
+    if mc.get(SNAPSHOT_SENTINEL_KEY) is not None or not mc.add(SNAPSHOT_SENTINEL_KEY, unixtime()):
+        return None
+    if not os.path.exists(path):
+        return 0
+
+    restored = restore_snapshot(path, mc)
+    logging.info("Restored %d entries from %s after a memcached restart", restored, path)
+    return restored
+
+def start_snapshots(path, **options):
+    '''Starts writing periodic snapshots of this process's most requested
+    entries to path, and restoring the latest one after memcached restarts;
+    options are passed to snapshot.Snapshotter'''
+    global SNAPSHOTTER
+
+    options.setdefault('restore_fn', restore_after_restart)
+    SNAPSHOTTER = snapshot.Snapshotter(save_snapshot, path, **options)
+    SNAPSHOTTER.start()
+    return SNAPSHOTTER
+
+def start_profiler(directory, signum=None, **options):
+    '''Sets up a profiler for this process, writing to directory, idle
+    until started through the profile admin path, or by signum, if given
+    (a second signal stops it); options are passed to profiling.Profiler'''
+    global PROFILER
+    # cProfile and pstats are only imported by processes that profile
+    import profiling
+
+    PROFILER = profiling.Profiler(directory, **options)
+    if signum is not None:
+        PROFILER.toggle_on(signum)
+    return PROFILER
+
+def warm_up(clients=4, origin_path='/', prime_urls=1000):
+    '''Readies a new process to serve, before its first request: opens
+    clients connections to memcached, opens a connection to each origin
+    (with a HEAD request for origin_path; None skips this), and loads the
+    bodies of up to prime_urls of the urls published under HOT_URLS_KEY
+    into the SHARED_CACHE, if there is one. Failures are logged, and left
+    for requests to run into. Returns what was done, and how long it took'''
+    started = time.time()
+    done = {'memcached_clients': 0, 'origins': 0, 'primed': 0}
+
+    # time.strptime imports a module on its first call, which can fail if
+    # threads race to do it
+    parse_http_date(make_http_date(datetime.datetime.now(gmt_tz)))
+
+    try:
+        done['memcached_clients'] = STORAGE_BACKEND.warm(clients)
+    except Exception:
+        logging.warn("Couldn't connect to memcached", exc_info=True)
+
+    session = _origin_session()
+    if origin_path is not None:
+        for origin in UPSTREAM_POOL.upstreams():
+            try:
+                session.head(origin.url + origin_path, timeout=REQUEST_TIMEOUT).close()
+                done['origins'] += 1
+            except Exception:
+                logging.warn("Couldn't connect to origin %s", origin.url, exc_info=True)
+
+    if SHARED_CACHE is not None and prime_urls:
+        try:
+            mc = _open_client()
+            done['primed'] = prime_shared_cache((mc.get(HOT_URLS_KEY) or [])[:prime_urls], mc)
+        except Exception:
+            logging.warn("Couldn't load the hot entries", exc_info=True)
+
+    done['seconds'] = round(time.time() - started, 3)
+    logging.info("Warmed up: %s", done)
+    return done
+
+def prime_shared_cache(cache_urls, mc_client=None, batch_size=100):
+    '''Loads the content entries of the given urls (of every variant) from
+    memcached into the SHARED_CACHE, where they fit. Returns the number of
+    entries loaded'''
+    mc = mc_client or _open_client()
+    primed = 0
+    for start in range(0, len(cache_urls), batch_size):
+        metadata_keys = [EntryMetadata.make_metadata_key(url) for url in cache_urls[start:start + batch_size]]
+        content_keys = []
+        for data in mc.get_multi(metadata_keys).values():
+            if not data.get('valid'):
+                continue
+            records = [data] + list(data.get('variants', {}).values())
+            content_keys.extend(r['content_key'] for r in records if r.get('content_key'))
+
+        for key, cache_entry in mc.get_multi(content_keys).items():
+            if len(cache_entry['content'] or '') < SHARED_CACHE.slot_bytes:
+                SHARED_CACHE.set(key, cache_entry, EntryContent.content_ttl())
+                primed += 1
+    return primed
+
+def new_metrics(**options):
+    '''A metrics.Metrics with the webcache's metrics declared; options are
+    passed to metrics.Metrics'''
+    registry = metrics.Metrics(**options)
+    registry.counter('webcache_responses_total', 'Requests by how they were served: hit, not_modified (304), parallel_update (after losing a reservation), miss, pass (not admitted)')
+    registry.counter('webcache_reservations_total', 'Reservations for updating an entry, won or lost')
+    registry.counter('webcache_cas_retries_total', 'Metadata updates retried after a CAS conflict, by operation')
+    registry.counter('webcache_consistency_errors_total', 'Requests that gave up on updating the cache through contention')
+    registry.histogram('webcache_request_seconds', 'Time to handle a request')
+    registry.histogram('webcache_phase_seconds', 'Time spent in each phase of a request: lookup, compete, origin, update')
+    registry.histogram('webcache_backoff_seconds', 'Time requests that lost a reservation waited for the winner')
+    return registry
+
+def start_metrics(**options):
+    '''Starts counting requests in this process; options are passed to
+    metrics.Metrics'''
+    global METRICS
+
+    METRICS = new_metrics(**options)
+    return METRICS
+
+def _count(name, amount=1, labels=()):
+    if METRICS is not None:
+        METRICS.inc(name, amount, labels)
+
+def _observe(name, value, labels=()):
+    if METRICS is not None:
+        METRICS.observe(name, value, labels)
+
+def _count_response(wsgi_request, source):
+    wsgi_request.source = source
+    if METRICS is not None:
+        METRICS.inc('webcache_responses_total', 1, (('source', source),))
+
+def _observe_phase(phase, started):
+    if METRICS is not None:
+        METRICS.observe('webcache_phase_seconds', time.time() - started, (('phase', phase),))
+
+def handle_admin(environ, start_response):
+    '''Serves a request under ADMIN_PATH, dispatching on the rest of the path
+    to a handler in admin_handlers'''
+    path, _, query = environ['REQUEST_URI'][len(ADMIN_PATH):].partition('?')
+
+    handler = admin_handlers.get(path)
+    if not hmac.compare_digest(environ.get('HTTP_X_WEBCACHE_TOKEN', ''), ADMIN_TOKEN):
+        status, content_type, body = '403 Forbidden', 'text/plain', 'Forbidden\n'
+    elif handler is None:
+        status, content_type, body = '404 Not Found', 'text/plain', 'Not Found\n'
+    else:
+        status, content_type, body = handler(environ, parse_qs(query))
+
+    logging.info("Admin request: %s, %s", path, status)
+    start_response(status, [
+        ('Content-Type', content_type),
+        ('Content-Length', str(len(body))),
+        ])
+    return [body]
+
+def handle_invalidate(environ, params):
+    '''Admin handler invalidating the urls, prefixes and tags given as url,
+    prefix and tag parameters of a POST request'''
+    if environ.get('REQUEST_METHOD') != 'POST':
+        return '405 Method Not Allowed', 'text/plain', 'Use POST\n'
+    if not INVALIDATION_ENABLED:
+        return '400 Bad Request', 'text/plain', 'Invalidation is not enabled\n'
+
+    unknown = [p for p in params.get('prefix', []) if p not in INVALIDATION_PREFIXES]
+    if unknown:
+        return '400 Bad Request', 'text/plain', 'Not a configured prefix: %s\n' % (', '.join(unknown),)
+
+    mc = _open_client()
+    invalidated = {}
+    for url in params.get('url', []):
+        invalidated.setdefault('url', []).append(invalidate_url(mc, url))
+    for prefix in params.get('prefix', []):
+        invalidation.bump_generation(mc, invalidation.prefix_generation_key(prefix))
+        invalidated.setdefault('prefix', []).append(prefix)
+    for tag in params.get('tag', []):
+        invalidation.bump_generation(mc, invalidation.tag_generation_key(tag))
+        invalidated.setdefault('tag', []).append(tag)
+
+    logging.info("Invalidated: %s", invalidated)
+    return '200 OK', 'application/json', json.dumps({'invalidated': invalidated})
+
+def handle_metrics(environ, params):
+    '''Admin handler serving the METRICS, in Prometheus text format'''
+    if METRICS is None:
+        return '400 Bad Request', 'text/plain', 'Metrics are not enabled\n'
+    return '200 OK', 'text/plain; version=0.0.4', METRICS.render()
+
+def handle_profile(environ, params):
+    '''Admin handler for the PROFILER: a POST starts profiling (with the
+    mode, seconds, interval and sample_rate parameters, if given), or stops
+    it with stop=1; either way, the profiler's status is returned'''
+    if PROFILER is None:
+        return '400 Bad Request', 'text/plain', 'Profiling is not enabled\n'
+
+    if environ.get('REQUEST_METHOD') == 'POST':
+        if params.get('stop'):
+            PROFILER.stop()
+        else:
+            options = {}
+            try:
+                for name, convert in (('seconds', float), ('interval', float), ('sample_rate', float)):
+                    if name in params:
+                        options[name] = convert(params[name][0])
+                mode = params.get('mode', [None])[0]
+                if not PROFILER.start(mode, **options):
+                    return '409 Conflict', 'application/json', json.dumps(PROFILER.status())
+            except ValueError as e:
+                return '400 Bad Request', 'text/plain', '%s\n' % (e,)
+
+    return '200 OK', 'application/json', json.dumps(PROFILER.status())
+
+def invalidate_url(mc_client, url):
+    '''Invalidates the entry for a url, returning its cache url'''
+    cache_url = normalize_cache_url(url)
+    current_url = invalidation.generation_url(mc_client, cache_url, INVALIDATION_PREFIXES)
+
+    invalidation.bump_generation(mc_client, invalidation.url_generation_key(cache_url))
+    # not needed for correctness, but frees the entry now, and keeps it from
+    # resurfacing if the url's counter is evicted
+    mc_client.delete(EntryMetadata.make_metadata_key(current_url))
+
+    return cache_url
+
+admin_handlers = {
+    'invalidate': handle_invalidate,
+    'metrics': handle_metrics,
+    'profile': handle_profile,
+}
+
 def _open_client():
-    '''Creates a memcached client using tcp; nodelay is set and CAS behaviors are needed'''
-    return pylibmc.Client(
-        ["127.0.0.1"],
-        binary=True,
-        behaviors = {"tcp_nodelay": True, "cas": True}
-    )
+    '''Returns the storage backend holding the cache entries'''
+    return STORAGE_BACKEND
+
+@tracing.traced('origin')
+def _issue_origin_request(wsgi_request):
+    '''Issues a request to the origin, timing it as the origin phase'''
+    started = time.time()
+    try:
+        return _issue_server_request(wsgi_request)
+    finally:
+        _observe_phase('origin', started)
+
+_session = None
+_session_lock = threading.Lock()
+
+def _origin_session():
+    '''The requests session misses are sent through, keeping up to
+    ORIGIN_POOL_SIZE connections open to each origin. It keeps no cookies,
+    as it is shared by every client's requests. requests is imported here,
+    on first use, as hits don't need it (warm_up imports it up front)'''
+    global _session
+
+    if _session is not None:
+        return _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.compat import cookielib
+
+            session = requests.Session()
+            session.cookies.set_policy(cookielib.DefaultCookiePolicy(allowed_domains=[]))
+            adapter = requests.adapters.HTTPAdapter(pool_connections=len(UPSTREAM_POOL.upstreams()) or 1,
+                pool_maxsize=ORIGIN_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+    return _session
+
+class OriginResponse(object):
+    '''A response read from the origin, with the attributes of a
+    requests.Response that the webcache uses, and the digest of the body
+    taken while reading it'''
+
+    def __init__(self, status_code, reason, headers, content, digest):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+        self.webcache_digest = digest
+
+    @property
+    def ok(self):
+        return self.status_code < 400
 
 def _issue_server_request(wsgi_request):
     logging.debug("Issuing request to origin server: %s", wsgi_request)
 
-    response = requests.get("http://127.0.0.1" + wsgi_request.url, headers=wsgi_request.headers)
-    logging.debug("Server response--status: %d, reason: %s", response.status_code, response.reason)
-
-    return response
+    # the Host header goes to the origin as the client sent it, and picks
+    # which of the pool's routes serves the request
+    origin = UPSTREAM_POOL.acquire(wsgi_request.headers.get('Host'))
+    started = time.time()
+    status_code = None
+    try:
+        response = _origin_session().get(origin.url + wsgi_request.url, headers=wsgi_request.headers, stream=True, timeout=REQUEST_TIMEOUT)
+        logging.debug("Server response from %s--status: %d, reason: %s", origin.url, response.status_code, response.reason)
+
+        # hash the body as it is read, rather than in another pass afterwards
+        hasher = digests.new(DIGEST_ALGORITHM)
+        hashing = 0
+        chunks = []
+        for chunk in response.iter_content(ORIGIN_READ_CHUNK):
+            hash_started = time.time()
+            hasher.update(chunk)
+            hashing += time.time() - hash_started
+            chunks.append(chunk)
+        tracing.add('hash', hashing)
+        response.close()
+        status_code = response.status_code
+    finally:
+        UPSTREAM_POOL.release(origin, time.time() - started, status_code)
+
+    return OriginResponse(response.status_code, response.reason, response.headers, b''.join(chunks),
+        (DIGEST_ALGORITHM, hasher.digest()))
 
 def unixtime():
     return time.time()